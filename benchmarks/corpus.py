@@ -0,0 +1,172 @@
+"""Synthetic DICOM corpus generator."""
+
+import argparse
+from pathlib import Path
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+
+FAMILY_NAMES = ["Rossi", "Verdi", "Bianchi", "Russo", "Ferrari", "Esposito", "Romano", "Colombo"]
+GIVEN_NAMES = ["Mario", "Antonio", "Giulia", "Francesca", "Luca", "Sara", "Marco", "Elena"]
+
+TRANSFER_SYNTAXES = {"explicit": ExplicitVRLittleEndian, "implicit": ImplicitVRLittleEndian}
+
+
+def image_template(
+    rows: int, columns: int, frames: int = 1, transfer_syntax: str = "explicit"
+) -> FileDataset:
+    """
+    Create a CT image template.
+
+    :param rows: number of rows of each frame
+    :param columns: number of columns of each frame
+    :param frames: number of frames (more than one for multi-frame objects)
+    :param transfer_syntax: explicit or implicit (VR little endian)
+    :return: pydicom dataset
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    file_meta.TransferSyntaxUID = TRANSFER_SYNTAXES[transfer_syntax]
+
+    ds = FileDataset("template", {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.Modality = "CT"
+    ds.Rows = rows
+    ds.Columns = columns
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = bytes(range(256)) * (rows * columns * 2 * frames // 256) + bytes(
+        rows * columns * 2 * frames % 256
+    )
+    return ds
+
+
+def generate_corpus(
+    output_dir: Path,
+    patients: int = 10,
+    studies: int = 2,
+    slices: int = 50,
+    rows: int = 256,
+    columns: int = 256,
+    multiframe: int = 0,
+    frames: int = 50,
+    depth: int = 1,
+    transfer_syntax: str = "explicit",
+) -> dict:
+    """
+    Write a synthetic corpus.
+
+    Images are written in OUTPUT/level_1/.../level_depth/LAST^FIRST_ID/STUDY_n/,
+    mimicking the layout of a PACS export.
+
+    :param output_dir: Path of the corpus
+    :param patients: number of patients
+    :param studies: number of studies per patient
+    :param slices: number of single frame images per study
+    :param rows: rows of each frame
+    :param columns: columns of each frame
+    :param multiframe: number of multi-frame images per study
+    :param frames: number of frames of each multi-frame image
+    :param depth: number of directory levels above the patient directories
+    :param transfer_syntax: explicit or implicit (VR little endian)
+    :return: dictionary describing the corpus (files, bytes and parameters)
+    """
+    templates = [(image_template(rows, columns, 1, transfer_syntax), "slice", slices)]
+    if multiframe:
+        templates.append(
+            (image_template(rows, columns, frames, transfer_syntax), "multiframe", multiframe)
+        )
+
+    root = output_dir.joinpath(*[f"level_{level + 1}" for level in range(depth)])
+    files = 0
+    size = 0
+    for p in range(patients):
+        family_name = FAMILY_NAMES[p % len(FAMILY_NAMES)]
+        given_name = GIVEN_NAMES[(p // len(FAMILY_NAMES)) % len(GIVEN_NAMES)]
+        patient_id = f"{100000 + p}"
+        for s in range(studies):
+            study_dir = root / f"{family_name.upper()}^{given_name.upper()}_{patient_id}" / (
+                f"STUDY_2022-01-{s % 28 + 1:02}_{s}"
+            )
+            study_dir.mkdir(parents=True, exist_ok=True)
+            study_uid = generate_uid()
+            series_uid = generate_uid()
+            for template, prefix, count in templates:
+                template.PatientName = f"{family_name}^{given_name}"
+                template.PatientID = patient_id
+                template.PatientBirthDate = f"19{p % 100:02}0101"
+                template.PatientSex = "MF"[p % 2]
+                template.StudyDate = f"202201{s % 28 + 1:02}"
+                template.StudyTime = "120000"
+                template.AccessionNumber = f"ACC{p}{s}"
+                template.ReferringPhysicianName = "Bianchi^Luigi"
+                template.StudyInstanceUID = study_uid
+                template.SeriesInstanceUID = series_uid
+                for i in range(count):
+                    sop_uid = generate_uid()
+                    template.file_meta.MediaStorageSOPInstanceUID = sop_uid
+                    template.SOPInstanceUID = sop_uid
+                    template.InstanceNumber = i + 1
+                    path = study_dir / f"{prefix}-{i:05}.dcm"
+                    template.save_as(path)
+                    files += 1
+                    size += path.stat().st_size
+
+    return {
+        "patients": patients,
+        "studies": studies,
+        "slices": slices,
+        "rows": rows,
+        "columns": columns,
+        "multiframe": multiframe,
+        "frames": frames,
+        "depth": depth,
+        "transfer_syntax": transfer_syntax,
+        "files": files,
+        "bytes": size,
+    }
+
+
+def add_corpus_arguments(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the corpus parameters to a command line parser.
+
+    :param arg_parser: argparse parser
+    :return: None
+    """
+    arg_parser.add_argument("--patients", type=int, default=10)
+    arg_parser.add_argument("--studies", type=int, default=2, help="studies per patient")
+    arg_parser.add_argument("--slices", type=int, default=50, help="single frame images per study")
+    arg_parser.add_argument("--rows", type=int, default=256)
+    arg_parser.add_argument("--columns", type=int, default=256)
+    arg_parser.add_argument(
+        "--multiframe", type=int, default=0, help="multi-frame images per study"
+    )
+    arg_parser.add_argument("--frames", type=int, default=50, help="frames per multi-frame image")
+    arg_parser.add_argument("--depth", type=int, default=1, help="directory levels above patients")
+    arg_parser.add_argument(
+        "--transfer_syntax", choices=sorted(TRANSFER_SYNTAXES), default="explicit"
+    )
+
+
+def main():
+    """
+    Main function.
+
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser(__doc__)
+    arg_parser.add_argument("output_directory", type=Path)
+    add_corpus_arguments(arg_parser)
+    arguments = vars(arg_parser.parse_args())
+    print(generate_corpus(arguments.pop("output_directory"), **arguments))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Benchmark of the anonymization stages on a synthetic corpus."""
+
+from typing import Dict, List
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydicom
+from pathlib import Path
+
+from corpus import add_corpus_arguments, generate_corpus
+from dicomanonymize import __version__
+from dicomanonymize.functions import iter_anonymize
+from dicomanonymize.metrics import Metrics
+
+
+MODES = {
+    "serial": {"parallel": False},
+    "threads": {"parallel": True, "processes": 1},
+    "parallel": {"parallel": True},
+    "pipeline": {"parallel": True, "backend": "pipeline"},
+}
+# fixed key: runs of every mode give the same anonymized ids
+KEY = b"benchmark"
+
+
+def peak_rss() -> Dict[str, int]:
+    """
+    Peak resident set size of this process and of its terminated children.
+
+    :return: dictionary of peak RSS in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def run_mode(corpus: Path, output: Path, mode: str) -> dict:
+    """
+    Time every stage of an anonymization run.
+
+    :param corpus: Path of the synthetic corpus
+    :param output: Path of the output directory, removed before the run
+    :param mode: one of MODES
+    :return: dictionary with the duration of the run and of each stage and the peak RSS
+    """
+    shutil.rmtree(output, ignore_errors=True)
+    output.mkdir(parents=True)
+
+    metrics = Metrics()
+    patients = set()
+    for result in iter_anonymize(corpus, output, key=KEY, metrics=metrics, **MODES[mode]):
+        patients.add(result.anonymized_id)
+    snapshot = metrics.snapshot()
+
+    return {
+        "mode": mode,
+        "patients": len(patients),
+        "outputs": sum(1 for _ in output.rglob("*.dcm")),
+        "elapsed": snapshot["elapsed"],
+        "stages": snapshot["stages"],
+        "peak_rss": peak_rss(),
+    }
+
+
+def run_isolated(corpus: Path, output: Path, mode: str) -> dict:
+    """
+    Run a mode in a new interpreter, so that peak RSS is not shared between modes.
+
+    :param corpus: Path of the synthetic corpus
+    :param output: Path of the output directory
+    :param mode: one of MODES
+    :return: dictionary returned by run_mode
+    """
+    result = subprocess.run(
+        [sys.executable, __file__, "--run_mode", mode, "--corpus", str(corpus), str(output)],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return json.loads(result.stdout.decode().splitlines()[-1])
+
+
+def summarize(result: dict, files: int, size: int) -> dict:
+    """
+    Add throughputs to the result of a mode.
+
+    :param result: dictionary returned by run_mode
+    :param files: number of images in the corpus
+    :param size: size of the corpus in bytes
+    :return: result with total time, files/s and MB/s
+    """
+    total = result["elapsed"]
+    rewrite = result["stages"].get("anonymize_patients", 0.0)
+    result["total"] = total
+    result["files_per_second"] = files / total if total else None
+    result["anonymization_files_per_second"] = files / rewrite if rewrite else None
+    result["megabytes_per_second"] = size / 1e6 / total if total else None
+    return result
+
+
+def environment() -> dict:
+    """
+    Describe the machine and the software versions.
+
+    :return: dictionary describing the environment
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=Path(__file__).parent,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "dicomanonymize": __version__,
+        "commit": commit,
+        "pydicom": pydicom.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def print_results(results: List[dict]) -> None:
+    """
+    Print a table of the results.
+
+    :param results: list of summarized results
+    :return: None
+    """
+    print(f"{'mode':<10}{'total s':>10}{'files/s':>12}{'MB/s':>10}{'peak RSS MB':>14}")
+    for result in results:
+        rss = max(result["peak_rss"].values()) / 1e6
+        print(
+            f"{result['mode']:<10}{result['total']:>10.2f}{result['files_per_second']:>12.1f}"
+            + f"{result['megabytes_per_second']:>10.1f}{rss:>14.1f}"
+        )
+        for stage, duration in result["stages"].items():
+            print(f"  {stage:<28}{duration:>10.3f} s")
+
+
+def main():
+    """
+    Main function.
+
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser(__doc__)
+    arg_parser.add_argument(
+        "results", type=Path, help="JSON file of the results (output directory with --run_mode)"
+    )
+    arg_parser.add_argument(
+        "--modes", nargs="+", choices=sorted(MODES), default=["serial", "parallel"]
+    )
+    arg_parser.add_argument("--repeat", type=int, default=1, help="runs of each mode")
+    arg_parser.add_argument("--corpus", type=Path, help="reuse an existing corpus")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    arg_parser.add_argument("--run_mode", choices=sorted(MODES), help=argparse.SUPPRESS)
+    add_corpus_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.run_mode is not None:
+        print(json.dumps(run_mode(args.corpus, args.results, args.run_mode)))
+        return
+
+    work_directory = Path(tempfile.mkdtemp(prefix="dicomanonymize-benchmark-"))
+    corpus = args.corpus
+    if corpus is None:
+        corpus = work_directory / "corpus"
+        print(f"Generating corpus in {corpus}...")
+        generate_corpus(
+            corpus,
+            args.patients,
+            args.studies,
+            args.slices,
+            args.rows,
+            args.columns,
+            args.multiframe,
+            args.frames,
+            args.depth,
+            args.transfer_syntax,
+        )
+    images = list(corpus.rglob("*.dcm"))
+    files = len(images)
+    size = sum(path.stat().st_size for path in images)
+    print(f"Corpus: {files} files, {size / 1e6:.1f} MB")
+
+    results = []
+    try:
+        for mode in args.modes:
+            for _ in range(args.repeat):
+                result = run_isolated(corpus, work_directory / "output", mode)
+                results.append(summarize(result, files, size))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    print_results(results)
+    corpus_parameters = {
+        name: getattr(args, name)
+        for name in (
+            "patients",
+            "studies",
+            "slices",
+            "rows",
+            "columns",
+            "multiframe",
+            "frames",
+            "depth",
+            "transfer_syntax",
+        )
+    }
+    if args.corpus is not None:
+        corpus_parameters = {"path": str(args.corpus)}
+    corpus_parameters.update({"files": files, "bytes": size})
+    with open(args.results, "w") as f:
+        json.dump(
+            {"environment": environment(), "corpus": corpus_parameters, "results": results},
+            f,
+            indent=2,
+        )
+    print(f"Results written to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
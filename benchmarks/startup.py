@@ -0,0 +1,130 @@
+"""Benchmark of the startup time of the library and of the command line interface."""
+
+from typing import Dict, List
+import argparse
+import json
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from corpus import generate_corpus
+from run_benchmarks import environment
+
+
+SCRIPT = "dicomanonymize.scripts.dicomanonymize_script"
+# modules that no command should import unless it uses them
+LAZY_MODULES = ["asyncio", "sqlite3", "pyarrow", "pynetdicom", "dicomanonymize.watch"]
+
+
+def commands(corpus: Path, output: Path) -> Dict[str, List[str]]:
+    """
+    Commands timed by the benchmark, each one in a new interpreter.
+
+    :param corpus: Path of a small corpus, anonymized by the "small_drop" command
+    :param output: Path of the output directory of the "small_drop" command
+    :return: dictionary from name to command line
+    """
+    return {
+        "python": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import dicomanonymize"],
+        "import_functions": [sys.executable, "-c", "import dicomanonymize.functions"],
+        "cli_help": [sys.executable, "-m", SCRIPT, "-h"],
+        "small_drop": [
+            sys.executable,
+            "-m",
+            SCRIPT,
+            "-i",
+            str(corpus),
+            "-o",
+            str(output),
+            "--key",
+            "benchmark",
+            "--progress",
+            "0",
+        ],
+    }
+
+
+def time_command(command: List[str], repeat: int, output: Path) -> dict:
+    """
+    Time a command run several times.
+
+    :param command: command line
+    :param repeat: number of runs
+    :param output: Path of a directory removed before each run
+    :return: dictionary with the median, minimum and maximum duration in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        shutil.rmtree(output, ignore_errors=True)
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(durations),
+        "min": min(durations),
+        "max": max(durations),
+    }
+
+
+def imported_modules(command: str) -> List[str]:
+    """
+    Modules of LAZY_MODULES imported by a statement run in a new interpreter.
+
+    :param command: Python statement
+    :return: list of module names
+    """
+    check = f"{command}; import sys; print(*(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], check=True, stdout=subprocess.PIPE)
+    return result.stdout.decode().split()
+
+
+def main():
+    """
+    Main function.
+
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser(__doc__)
+    arg_parser.add_argument("results", type=Path, help="JSON file of the results")
+    arg_parser.add_argument("--repeat", type=int, default=20, help="runs of each command")
+    arg_parser.add_argument("--slices", type=int, default=4, help="images of the small drop")
+    args = arg_parser.parse_args()
+
+    work_directory = Path(tempfile.mkdtemp(prefix="dicomanonymize-startup-"))
+    corpus = work_directory / "corpus"
+    output = work_directory / "output"
+    results = {}
+    try:
+        generate_corpus(corpus, patients=1, studies=1, slices=args.slices, rows=64, columns=64)
+        for name, command in commands(corpus, output).items():
+            results[name] = time_command(command, args.repeat, output)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    lazy = {
+        "import dicomanonymize": imported_modules("import dicomanonymize"),
+        "import dicomanonymize.functions": imported_modules("import dicomanonymize.functions"),
+    }
+
+    print(f"{'command':<18}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<18}{result['median'] * 1000:>12.1f}{result['min'] * 1000:>10.1f}"
+            + f"{result['max'] * 1000:>10.1f}"
+        )
+    for statement, modules in lazy.items():
+        print(f"{statement} imports: {', '.join(modules) or 'none of ' + ', '.join(LAZY_MODULES)}")
+    with open(args.results, "w") as f:
+        json.dump(
+            {"environment": environment(), "results": results, "lazy_modules": lazy}, f, indent=2
+        )
+    print(f"Results written to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -46,7 +46,11 @@ setup(
     classifiers=[],
     python_requires=">=3.6",
     install_requires=requirements,
-    extras_require={"test": ["prospector", "pytest"]},
+    extras_require={
+        "test": ["prospector", "pytest"],
+        "parquet": ["pyarrow"],
+        "receiver": ["pynetdicom"],
+    },
     entry_points={
         "console_scripts": [
             "dicomanonymize = dicomanonymize.scripts.dicomanonymize_script:main",
@@ -1,6 +1,40 @@
 """ dicomanonymize """
 
-from dicomanonymize.functions import anonymize, read_patients  # noqa: F401
-from dicomanonymize.classes import Patient  # noqa: F401
+import importlib
+import sys
 
 __version__ = "0.0.4"
+
+# public functions, imported from their module only when first used: importing the package,
+# or any of its modules, does not load the whole library
+_EXPORTS = {
+    "anonymize": "dicomanonymize.functions",
+    "iter_anonymize": "dicomanonymize.functions",
+    "read_patients": "dicomanonymize.functions",
+    "Patient": "dicomanonymize.classes",
+    "anonymize_bytes": "dicomanonymize.inmemory",
+    "anonymize_stream": "dicomanonymize.inmemory",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    """Import the public functions on first use."""
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """List the public functions along with the attributes already set."""
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ (PEP 562) is ignored before Python 3.7: import them eagerly
+    for _name, _module in _EXPORTS.items():
+        globals()[_name] = getattr(importlib.import_module(_module), _name)
@@ -0,0 +1,225 @@
+"""Adaptive choice of the number of worker processes and threads."""
+
+from typing import Callable, Dict, Optional
+import threading
+import time
+
+
+# upper bound of the threads of each worker process: threads mostly wait for I/O
+MAX_THREADS = 64
+# seconds of work measured before each adjustment
+ADJUST_INTERVAL = 2.0
+# relative throughput change considered significant
+TOLERANCE = 0.05
+# measurement intervals without probing once both limits have settled
+SETTLED_INTERVALS = 5
+
+
+class AdaptiveController:
+    """
+    Hill climbing controller of the concurrency of a run.
+
+    Two limits are tuned separately: threads, the images read and written at once by
+    each worker process (I/O bound), and processes, the worker processes parsing and
+    serializing headers at once (CPU bound). Every interval the throughput is measured;
+    a change that improves it by more than the tolerance is repeated, one that does not
+    is reverted and the other limit is probed. Increases that bring no improvement are
+    reverted too, so that the run settles on the smallest efficient settings.
+    """
+
+    def __init__(
+        self,
+        max_processes: int,
+        max_threads: int = MAX_THREADS,
+        processes: Optional[int] = None,
+        threads: Optional[int] = None,
+        interval: float = ADJUST_INTERVAL,
+        tolerance: float = TOLERANCE,
+        log: Optional[Callable[[str], None]] = print,
+    ) -> None:
+        """
+        Create the controller.
+
+        :param max_processes: maximum number of active worker processes
+        :param max_threads: maximum number of threads of each worker process
+        :param processes: initial number of active processes, half of the maximum by default
+        :param threads: initial number of threads, a quarter of the maximum by default
+        :param interval: seconds of work measured before each adjustment
+        :param tolerance: relative throughput change considered significant
+        :param log: function printing the chosen settings, None to be silent
+        """
+        self._lock = threading.Lock()
+        self._limits = {"processes": max(max_processes, 1), "threads": max(max_threads, 1)}
+        self._values = {
+            "processes": processes or max(self._limits["processes"] // 2, 1),
+            "threads": threads or max(self._limits["threads"] // 4, 1),
+        }
+        for name, value in self._values.items():
+            self._values[name] = min(max(value, 1), self._limits[name])
+        self._accepted = dict(self._values)
+        self.interval = interval
+        self.tolerance = tolerance
+        self.log = log
+
+        self._knob = "threads"
+        self._direction = 1
+        self._last_move: Optional[Dict[str, int]] = None
+        self._baseline: Optional[float] = None
+        self._settled = 0
+        self._failed_probes = 0
+        self._window_start = time.monotonic()
+        self._window_files = 0
+        self._window_latency = 0.0
+        self.throughput = 0.0
+        self.latency = 0.0
+
+    @property
+    def processes(self) -> int:
+        """Number of worker processes allowed to run at once."""
+        return self._values["processes"]
+
+    @property
+    def threads(self) -> int:
+        """Number of threads of each worker process allowed to run at once."""
+        return self._values["threads"]
+
+    def settings(self) -> Dict[str, int]:
+        """
+        Get the current settings.
+
+        :return: dictionary with processes and threads
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def observe(self, files: int, seconds: float = 0.0) -> None:
+        """
+        Record completed images, adjusting the settings once the interval is over.
+
+        :param files: number of images completed
+        :param seconds: time spent by the workers on these images
+        :return: None
+        """
+        with self._lock:
+            self._window_files += files
+            self._window_latency += seconds
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.interval or not self._window_files:
+                return
+            self.throughput = self._window_files / elapsed
+            self.latency = self._window_latency / self._window_files
+            self._window_start = now
+            self._window_files = 0
+            self._window_latency = 0.0
+            self._adjust(self.throughput)
+
+    def _move(self, knob: str, direction: int) -> bool:
+        """
+        Change a limit, doubling or halving threads and adding or removing a process.
+
+        :param knob: processes or threads
+        :param direction: 1 to increase, -1 to decrease
+        :return: False if the limit cannot move in that direction
+        """
+        value = self._values[knob]
+        if knob == "threads":
+            new_value = value * 2 if direction > 0 else value // 2
+        else:
+            new_value = value + direction
+        new_value = min(max(new_value, 1), self._limits[knob])
+        if new_value == value:
+            return False
+        self._last_move = {knob: value}
+        self._values[knob] = new_value
+        return True
+
+    def _probe(self) -> None:
+        """
+        Try a new setting, switching limit or direction when one cannot move.
+
+        :return: None
+        """
+        for _ in range(4):
+            if self._move(self._knob, self._direction):
+                return
+            self._next_probe()
+        self._last_move = None
+
+    def _next_probe(self) -> None:
+        """
+        Probe the other direction, then the other limit.
+
+        :return: None
+        """
+        if self._direction > 0:
+            self._direction = -1
+        else:
+            self._direction = 1
+            self._knob = "processes" if self._knob == "threads" else "threads"
+
+    def _adjust(self, throughput: float) -> None:
+        """
+        Compare the throughput of the last interval with the previous one.
+
+        :param throughput: images per second in the last interval
+        :return: None
+        """
+        if self._settled:
+            self._settled -= 1
+            if not self._settled:
+                self._baseline = None
+            return
+
+        if self._baseline is None or self._last_move is None:
+            self._baseline = throughput
+            self._accepted = dict(self._values)
+            self._probe()
+            return
+
+        increased = self._direction > 0
+        if throughput > self._baseline * (1 + self.tolerance) or (
+            not increased and throughput >= self._baseline * (1 - self.tolerance)
+        ):
+            # better, or as good with fewer resources: keep going
+            self._baseline = max(throughput, self._baseline) if increased else throughput
+            self._failed_probes = 0
+            self._accepted = dict(self._values)
+            self._report()
+            self._probe()
+            return
+
+        # worse, or no better with more resources: revert and probe something else
+        self._values.update(self._last_move)
+        self._accepted = dict(self._values)
+        self._last_move = None
+        self._failed_probes += 1
+        self._next_probe()
+        if self._failed_probes >= 4:
+            # every direction of both limits has been tried: stay here for a while
+            self._failed_probes = 0
+            self._settled = SETTLED_INTERVALS
+            self._report()
+
+    def _report(self) -> None:
+        """
+        Log the current settings.
+
+        :return: None
+        """
+        if self.log is not None:
+            self.log(
+                f"Adaptive concurrency: {self._values['processes']} processes,"
+                + f" {self._values['threads']} threads ({self.throughput:.1f} images/s,"
+                + f" {self.latency * 1000:.1f} ms per image)"
+            )
+
+    def summary(self) -> str:
+        """
+        Command line options reproducing the best settings found, not those being probed.
+
+        :return: str
+        """
+        with self._lock:
+            settings = self._accepted
+        return f"--processes {settings['processes']} --threads {settings['threads']}"
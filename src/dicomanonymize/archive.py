@@ -0,0 +1,382 @@
+"""Anonymization of images read from, or written to, ZIP and TAR archives."""
+
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+from contextlib import contextmanager
+from functools import partial
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import os
+import tarfile
+import time
+import zipfile
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+from .classes import Patient, relative_directory
+from .crawler import DicomDirectory, _print_error, iter_dicom_directories
+from .fileio import atomic_output, parse_header
+from .inmemory import BufferReader, write_anonymized
+from .scheduler import DEFAULT_THREADS, IN_FLIGHT_PER_WORKER, ImageResult, imap_ordered
+
+from pathlib import Path, PurePosixPath
+
+
+# archive writing mode of each file name suffix
+ARCHIVE_MODES = {
+    ".zip": "zip",
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tar.xz": "w:xz",
+}
+
+
+class Member(NamedTuple):
+    """
+    Image to be anonymized.
+
+    name: path of the image inside the archive, or relative to the input directory (str)
+    load: function returning the content of the image (Callable[[], bytes]).
+    """
+
+    name: str
+    load: Callable[[], bytes]
+
+
+def archive_mode(path: Path) -> Optional[str]:
+    """
+    Archive format of a file name.
+
+    :param path: Path of the archive
+    :return: "zip", a tarfile writing mode, or None if path is not an archive name
+    """
+    name = path.name.lower()
+    for suffix, mode in ARCHIVE_MODES.items():
+        if name.endswith(suffix):
+            return mode
+    return None
+
+
+def is_archive(path: Path) -> bool:
+    """
+    Check whether a path is an existing ZIP or TAR archive.
+
+    :param path: Path
+    :return: True if path is a ZIP or TAR archive
+    """
+    return path.is_file() and (zipfile.is_zipfile(path) or tarfile.is_tarfile(str(path)))
+
+
+def member_path(name: str) -> PurePosixPath:
+    """
+    Relative path of an archive member, rejecting names that escape the archive root.
+
+    :param name: name of the member
+    :return: PurePosixPath of the member
+    :raise ValueError: if the name is absolute or contains ".." parts
+    """
+    path = PurePosixPath(name.replace("\\", "/"))
+    if path.is_absolute() or ".." in path.parts or not path.parts:
+        raise ValueError(f"Unsafe archive member name {name!r}")
+    return path
+
+
+def _loaded(data: bytes) -> bytes:
+    """
+    Content of an image already read.
+
+    :param data: content of the image
+    :return: data
+    """
+    return data
+
+
+@contextmanager
+def open_archive_members(path: Path) -> Iterator[Iterator[Member]]:
+    """
+    Open an archive, iterating over its dicom images in archive order.
+
+    ZIP members are read when loaded, possibly by several threads at once, so the
+    archive stays open until the context is left. TAR archives can only be read
+    sequentially: each member is read before being yielded.
+
+    :param path: Path of the archive
+    :return: context manager yielding an iterator of Member
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            yield (
+                Member(info.filename, partial(archive.read, info))
+                for info in archive.infolist()
+                if not info.is_dir() and info.filename.endswith(".dcm")
+            )
+        return
+
+    with tarfile.open(str(path), "r|*") as archive:
+        yield (
+            Member(info.name, partial(_loaded, archive.extractfile(info).read()))
+            for info in archive
+            if info.isfile() and info.name.endswith(".dcm")
+        )
+
+
+def iter_directory_members(root: Path, threads: Optional[int] = None) -> Iterator[Member]:
+    """
+    Iterate over the dicom images of a directory tree.
+
+    Names are made of the image name and of the path of its directory relative to the root,
+    as the output paths of anonymized directories (see relative_directory).
+
+    :param root: Path of the input directory
+    :param threads: number of threads scanning directories
+    :return: iterator of Member
+    """
+    for directory in iter_dicom_directories(root, threads):
+        prefix = PurePosixPath(*relative_directory(directory.path, root).parts)
+        for image in directory.images:
+            yield Member(str(prefix / image), (directory.path / image).read_bytes)
+
+
+def iter_archive_directories(
+    path: Path,
+    keywords: Iterable[str],
+    on_error: Optional[Callable[[Path, Exception], None]] = None,
+) -> Iterator[DicomDirectory]:
+    """
+    Read the header of the first readable image of each directory of an archive.
+
+    Directories with no readable image are reported to on_error once the whole archive
+    has been read, as the crawler does.
+
+    :param path: Path of the archive
+    :param keywords: keywords of the header elements to be read
+    :param on_error: function called with the Path of each directory skipped and the
+        error of its first image, printing it by default
+    :return: iterator of DicomDirectory, whose path is the archive path joined to the directory
+    """
+    keywords = list(keywords)
+    if on_error is None:
+        on_error = _print_error
+    seen = set()
+    failed: Dict[PurePosixPath, Exception] = {}
+    with open_archive_members(path) as members:
+        for member in members:
+            try:
+                directory = member_path(member.name).parent
+            except ValueError:
+                continue
+            if directory in seen:
+                continue
+            try:
+                header = dcmread(
+                    BufferReader(member.load()), stop_before_pixels=True, specific_tags=keywords
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                failed.setdefault(directory, e)
+                continue
+            seen.add(directory)
+            failed.pop(directory, None)
+            yield DicomDirectory(path / directory, [PurePosixPath(member.name).name], header)
+    for directory, error in failed.items():
+        on_error(path / directory, error)
+
+
+class DirectoryWriter:
+    """Write anonymized images to a directory."""
+
+    def __init__(self, root: Path) -> None:
+        """
+        Create the writer.
+
+        :param root: Path of the output directory
+        """
+        self.root = root
+        self._resolved_root = root.resolve()
+
+    def write(self, name: str, data: bytes) -> Path:
+        """
+        Write an image.
+
+        :param name: relative path of the image
+        :param data: content of the image
+        :return: Path of the image
+        :raise ValueError: if the image would be written outside the output directory
+        """
+        path = self.root / member_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # symbolic links inside the output directory must not lead outside of it either
+        try:
+            path.parent.resolve().relative_to(self._resolved_root)
+        except ValueError:
+            raise ValueError(f"{name} is outside of {self.root}") from None
+        with atomic_output(path) as f:
+            f.write(data)
+        return path
+
+
+class ArchiveWriter:
+    """Write anonymized images to a ZIP or TAR archive, in the order they are given."""
+
+    def __init__(self, path: Path, destination: BinaryIO) -> None:
+        """
+        Create the writer.
+
+        :param path: Path of the archive, whose name gives its format
+        :param destination: binary file the archive is written to
+        """
+        self.path = path
+        mode = archive_mode(path)
+        if mode is None:
+            raise ValueError(f"Unknown archive format {path.name}")
+        if mode == "zip":
+            self._zip = zipfile.ZipFile(destination, "w", zipfile.ZIP_STORED, allowZip64=True)
+            self._tar = None
+        else:
+            self._zip = None
+            self._tar = tarfile.open(fileobj=destination, mode=mode)
+
+    def write(self, name: str, data: bytes) -> Path:
+        """
+        Append an image to the archive.
+
+        :param name: path of the image inside the archive
+        :param data: content of the image
+        :return: archive Path joined to the member path
+        """
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, BytesIO(data))
+        return self.path / name
+
+    def close(self) -> None:
+        """
+        Write the archive index.
+
+        :return: None
+        """
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+
+
+@contextmanager
+def open_writer(output: Path) -> Iterator:
+    """
+    Open the destination of anonymized images.
+
+    Archives are written to a temporary file, replacing output only once complete.
+
+    :param output: Path of an archive, or of a directory
+    :return: context manager yielding an ArchiveWriter or a DirectoryWriter
+    """
+    if archive_mode(output) is None:
+        yield DirectoryWriter(output)
+        return
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_output(output) as destination:
+        writer = ArchiveWriter(output, destination)
+        yield writer
+        writer.close()
+
+
+def anonymize_member(
+    resolve: Callable[[Dataset], Optional[Patient]],
+    only_directory: bool,
+    source_root: Path,
+    member: Member,
+) -> Tuple[Optional[str], Optional[bytes], Optional[ImageResult]]:
+    """
+    Anonymize a single image and its path.
+
+    :param resolve: function returning the patient of a header with its anonymized id,
+        None if the image must be skipped
+    :param only_directory: anonymize only the path, leaving the image unchanged (bool)
+    :param source_root: Path of the input archive or directory
+    :param member: Member to be anonymized
+    :return: output name, anonymized image (None if anonymization failed) and ImageResult
+        (None if the image has been skipped)
+    """
+    source = source_root / member.name
+    worker = str(os.getpid())
+    data = b""
+    size = 0
+    anonymized_id = ""
+    try:
+        name = member_path(member.name)
+        data = member.load()
+        size = len(data)
+        reader = BufferReader(data)
+        dataset, offset = parse_header(reader)
+        patient = resolve(dataset)
+        if patient is None:
+            return None, None, None
+        anonymized_id = patient.anonymized_id
+
+        directory = patient.anonymize_path(name.parent)
+        output_name = str(directory / name.name)
+        if not only_directory:
+            destination = BytesIO()
+            write_anonymized(
+                reader,
+                dataset,
+                offset,
+                destination,
+                anonymized_id,
+                patient.profile,
+                patient.deflate_level,
+            )
+            data = destination.getvalue()
+    except Exception as e:  # pylint: disable=broad-except
+        result = ImageResult(source, None, anonymized_id, size, error=type(e).__name__)
+        return None, None, result._replace(worker=worker)
+    return output_name, data, ImageResult(source, None, anonymized_id, size, worker=worker)
+
+
+def iter_anonymize_members(
+    members: Iterable[Member],
+    writer,
+    resolve: Callable[[Dataset], Optional[Patient]],
+    only_directory: bool = False,
+    source_root: Path = Path(),
+    threads: Optional[int] = None,
+    max_in_flight: Optional[int] = None,
+) -> Iterator[ImageResult]:
+    """
+    Anonymize images concurrently, writing them in the order of members.
+
+    :param members: iterable of Member
+    :param writer: ArchiveWriter or DirectoryWriter
+    :param resolve: function returning the patient of a header with its anonymized id,
+        None if the image must be skipped
+    :param only_directory: anonymize only the paths, leaving images unchanged (bool)
+    :param source_root: Path of the input archive or directory
+    :param threads: number of threads anonymizing images
+    :param max_in_flight: number of images read but not yet written
+    :return: iterator of ImageResult, in the order of members
+    """
+    if threads is None:
+        threads = DEFAULT_THREADS
+    threads = max(threads, 1)
+    if max_in_flight is None:
+        max_in_flight = IN_FLIGHT_PER_WORKER * threads
+    function = partial(anonymize_member, resolve, only_directory, source_root)
+
+    with ThreadPool(threads) as pool:
+        results = map(function, members)
+        if threads > 1:
+            results = imap_ordered(pool, function, members, max(max_in_flight, 1))
+        for output_name, data, result in results:
+            if result is None:
+                continue
+            if data is not None:
+                result = result._replace(
+                    output=writer.write(output_name, data), written=len(data)
+                )
+            yield result
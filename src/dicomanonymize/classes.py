@@ -1,33 +1,60 @@
 """Patient class and anonymization functions."""
 
-from typing import List
+from typing import Iterator, List, Optional, Tuple, TypeVar
 from dataclasses import dataclass
-from pydicom import dcmread
 import re
-from multiprocessing.pool import ThreadPool
-from functools import partial
 
 from pydicom.dataset import Dataset
-from pathlib import Path
-
-
-VALUES_TO_ANONYMIZE = [
-    "PatientName",
-    "PatientID",
-    "PatientBirthDate",
-    "PatientSex",
-    "PatientAge",
-    "AcquisitionDate",
-    "SeriesDate",
-    "StudyDate",
-    "ContentDate",
-    "StudyTime",
-    "SeriesTime",
-    "AcquisitionTime",
-    "ContentTime",
-    "AccessionNumber",
-    "ReferringPhysicianName",
-]
+from pathlib import Path, PurePath
+
+from .fileio import copy_file, rewrite_image
+from .metrics import Metrics
+from .rules import VALUES_TO_ANONYMIZE, Profile, builtin_profile  # noqa: F401
+
+
+DATE_PATTERN = re.compile("_[0-9]{4}-[0-9]{2}-[0-9]{2}_")
+
+AnyPath = TypeVar("AnyPath", bound=PurePath)
+
+
+def anonymize_dataset(
+    dataset: Dataset, anonymized_id: str, profile: Optional[Profile] = None
+) -> None:
+    """
+    Replace patient information in the dataset with the anonymized id.
+
+    :param dataset: pydicom dataset of the image
+    :param anonymized_id: anonymized id of the patient
+    :param profile: de-identification Profile, by default the basic one replacing each of
+        VALUES_TO_ANONYMIZE with the anonymized id
+    :return: None
+    """
+    if profile is None:
+        profile = builtin_profile("basic")
+    profile.apply(dataset, anonymized_id)
+
+
+def relative_directory(directory: Path, root: Optional[Path] = None) -> Path:
+    """
+    Get the path of an image directory kept in the output.
+
+    Directories keep their path relative to the input directory, so that directories of
+    different patients with the same names do not collide. Directories directly inside
+    the input directory, and all directories if root is None, keep their parent name too.
+
+    :param directory: Path of the image directory
+    :param root: Path of the input directory
+    :return: relative Path
+    """
+    if root is not None:
+        try:
+            relative = directory.relative_to(root)
+        except ValueError:
+            pass
+        else:
+            if len(relative.parts) >= 2:
+                return relative
+    return Path(directory.parent.name) / directory.name
 
 
 @dataclass
@@ -38,13 +65,18 @@ class Patient:
     patient_data: dictionary containing patient information (dict)
     source_directories: directories where patient files are located (list[Path])
     destination_directories: destinations for converted files (list[Path])
-    anonymized_id: anonymized id for the patient (str).
+    anonymized_id: anonymized id for the patient (str)
+    profile: de-identification profile, the basic one if None (Profile)
+    deflate_level: zlib compression level of the images written with the Deflated Explicit
+        VR Little Endian transfer syntax, None to keep their transfer syntax (int).
     """
 
     patient_data: dict
     source_directories: List[Path]
     destination_directories: List[Path]
     anonymized_id: str = ""
+    profile: Optional[Profile] = None
+    deflate_level: Optional[int] = None
 
     def generate_anonymized_id(self, index: int) -> None:
         """
@@ -56,7 +88,13 @@ class Patient:
         self.anonymized_id = str(index)
 
     def anonymize(
-        self, output_dir: Path, parallel: bool = True, only_directory: bool = False
+        self,
+        output_dir: Path,
+        parallel: bool = True,
+        only_directory: bool = False,
+        threads: Optional[int] = None,
+        hardlink: bool = False,
+        metrics: Optional[Metrics] = None,
     ) -> None:
         """
         Anonymize all patient data.
@@ -64,85 +102,193 @@ class Patient:
         :param output_dir: output directory
         :param parallel: use CPU multithreading
         :param only_directory: anonymize only the destination directory (bool)
+        :param threads: number of worker threads (int)
+        :param hardlink: with only_directory, hard link images instead of copying them (bool)
+        :param metrics: Metrics collecting timings and counters
         :return: None
         """
+        from .scheduler import iter_image_tasks, run_tasks
 
-        def anonymize_directory(output_directory: Path) -> Path:
-            """
-            Anonymize the directory.
+        if metrics is None:
+            metrics = Metrics()
+        with metrics.stage("anonymize_patients"):
+            run_tasks(
+                iter_image_tasks([self], output_dir),
+                only_directory,
+                processes=1,
+                threads=threads if parallel else 1,
+                hardlink=hardlink,
+                metrics=metrics,
+            )
+
+    def output_directories(
+        self, output_dir: Path, input_dir: Optional[Path] = None
+    ) -> List[Path]:
+        """
+        Anonymized output directory of each source directory.
+
+        :param output_dir: Path of the output directory
+        :param input_dir: Path of the input directory (see relative_directory)
+        :return: list of Paths, in the same order as source_directories
+        """
+        return [
+            output_dir / self.anonymize_path(relative_directory(directory, input_dir))
+            for directory in self.destination_directories
+        ]
+
+    def iter_images(
+        self, output_dir: Path, input_dir: Optional[Path] = None
+    ) -> Iterator[Tuple[Path, Path]]:
+        """
+        Iterate over the patient images and their output paths.
 
-            :param output_directory: Path of the output directory
-            :return: Path of the anonymized directory
-            """
-            temp_dir = output_directory.name
-            temp_dir = re.sub(self.last_name().lower(), self.anonymized_id, temp_dir.lower())
-            temp_dir = re.sub(self.given_name().lower(), self.anonymized_id, temp_dir.lower())
-            temp_dir = re.sub("_[0-9]{4}-[0-9]{2}-[0-9]{2}_", f"_{self.anonymized_id}_", temp_dir)
-            output_directory = output_directory.parent / temp_dir
+        Output paths are computed once per directory, and output directories are created
+        before their first image is yielded.
 
-            temp_dir = output_directory.parent.name
+        :param output_dir: Path of the output directory
+        :param input_dir: Path of the input directory (see relative_directory)
+        :return: iterator of (image path, output image path) tuples
+        """
+        for source_directory, output_directory in zip(
+            self.source_directories, self.output_directories(output_dir, input_dir)
+        ):
+            created = False
+            for f in source_directory.iterdir():
+                if f.name.endswith(".dcm"):
+                    if not created:
+                        output_directory.mkdir(parents=True, exist_ok=True)
+                        created = True
+                    yield f, output_directory / f.name
+
+    def anonymize_name(self, name: str) -> str:
+        """
+        Replace the names of the patient, and dates, in the name of a directory.
+
+        :param name: name of the directory
+        :return: anonymized name, in lower case
+        """
+        temp_dir = name.lower()
+        for patient_name in (self.last_name(), self.given_name()):
+            if patient_name:
+                temp_dir = re.sub(
+                    re.escape(patient_name.lower()), lambda _: self.anonymized_id, temp_dir
+                )
+        return DATE_PATTERN.sub(f"_{self.anonymized_id}_", temp_dir)
+
+    def anonymize_path(self, directory: AnyPath) -> AnyPath:
+        """
+        Anonymize every component of the relative path of a directory.
+
+        The last two components are anonymized by anonymize_directory, the ones above them
+        by anonymize_name.
+
+        :param directory: relative path of the directory
+        :return: anonymized path
+        """
+        anonymized = self.anonymize_directory(directory)
+        leading = [self.anonymize_name(part) for part in directory.parts[:-2]]
+        return type(directory)(*leading, *anonymized.parts[-2:])
+
+    def anonymize_directory(self, output_directory: AnyPath) -> AnyPath:
+        """
+        Anonymize the directory.
+
+        :param output_directory: Path of the output directory
+        :return: Path of the anonymized directory
+        """
+        last_name = re.escape(self.last_name().lower())
+        output_directory = output_directory.parent / self.anonymize_name(output_directory.name)
+
+        temp_dir = output_directory.parent.name.lower()
+        if last_name:
             temp_dir = re.sub(
-                rf"{self.last_name().lower()}(\^|$)",
-                rf"{self.anonymized_id}\g<1>",
-                temp_dir.lower(),
+                rf"{last_name}(\^|$)",
+                lambda match: self.anonymized_id + match.group(1),
+                temp_dir,
             )
-            output = output_directory.parent.parent / temp_dir / output_directory.name
-
-            return output
-
-        def anonymize_image(
-            input_directory: Path, output_directory: Path, only_dir: bool, path: Path
-        ) -> None:
-            """
-            Anonymize a single image.
-
-            :param input_directory: Path of the input directory
-            :param output_directory: Path of the output directory
-            :param only_dir: anonymize only the destination directory (bool)
-            :param path: pathlib Path to the image
-            :return: None
-            """
-            try:
-                dicom_slice = dcmread(path)
-                if only_dir is False:
-                    for val in VALUES_TO_ANONYMIZE:
-                        try:
-                            dicom_slice[val].value = self.anonymized_id
-                        except Exception:
-                            pass
-                            # print(f"{val} not found in {path}")
-                output_path = output_directory / input_directory.parent.name / input_directory.name
-                output_path = anonymize_directory(output_path) / path.name
-                self.write_image(dicom_slice, output_path)
-            except Exception:
-                pass
-                # print(f"Could not open {path}")
-
-        images = []
-        for i, source_directory in enumerate(self.source_directories):
-            files = list(source_directory.iterdir())
-            for f in files:
-                if f.name.endswith(".dcm"):
-                    images.append(f)
-
-            # anonymize all images
-            if parallel:
-                num_threads = max(len(images), 1)
-                with ThreadPool(num_threads) as p:
-                    p.map(
-                        partial(
-                            anonymize_image,
-                            self.destination_directories[i],
-                            output_dir,
-                            only_directory,
-                        ),
-                        images,
-                    )
-            else:
-                for image in images:
-                    anonymize_image(
-                        self.destination_directories[i], output_dir, only_directory, image
-                    )
+        output = output_directory.parent.parent / temp_dir / output_directory.name
+
+        return output
+
+    def anonymize_image(
+        self,
+        input_directory: Path,
+        output_directory: Path,
+        only_dir: bool,
+        path: Path,
+        hardlink: bool = False,
+        root: Optional[Path] = None,
+    ) -> Optional[Path]:
+        """
+        Anonymize a single image.
+
+        :param input_directory: Path of the directory of the image
+        :param output_directory: Path of the output directory
+        :param only_dir: anonymize only the destination directory (bool)
+        :param path: pathlib Path to the image
+        :param hardlink: with only_dir, hard link images instead of copying them (bool)
+        :param root: Path of the input directory (see relative_directory)
+        :return: Path of the anonymized image, None if it could not be anonymized
+        """
+        relative = relative_directory(input_directory, root)
+        output_path = output_directory / self.anonymize_path(relative) / path.name
+        try:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return None
+        return self.anonymize_file(path, output_path, only_dir, hardlink)
+
+    def anonymize_file(
+        self, path: Path, output_path: Path, only_dir: bool = False, hardlink: bool = False
+    ) -> Optional[Path]:
+        """
+        Anonymize a single image to an already computed output path.
+
+        :param path: pathlib Path to the image
+        :param output_path: Path of the output image, whose directory must exist
+        :param only_dir: anonymize only the destination directory (bool)
+        :param hardlink: with only_dir, hard link images instead of copying them (bool)
+        :return: Path of the anonymized image, None if it could not be anonymized
+        """
+        try:
+            return self.write_file(path, output_path, only_dir, hardlink)
+        except Exception:
+            return None
+            # print(f"Could not open {path}")
+
+    def write_file(
+        self, path: Path, output_path: Path, only_dir: bool = False, hardlink: bool = False
+    ) -> Path:
+        """
+        Anonymize a single image to an already computed output path, raising on failure.
+
+        :param path: pathlib Path to the image
+        :param output_path: Path of the output image, whose directory must exist
+        :param only_dir: anonymize only the destination directory (bool)
+        :param hardlink: with only_dir, hard link images instead of copying them (bool)
+        :return: Path of the anonymized image
+        """
+        if only_dir is False:
+            rewrite_image(
+                path,
+                output_path,
+                self.anonymize_dataset,
+                self.deflate_level,
+                self.profile is not None and self.profile.needs_trailer,
+            )
+        else:
+            # the header is left untouched: there is no need to parse the image
+            copy_file(path, output_path, hardlink)
+        return output_path
+
+    def anonymize_dataset(self, dataset: Dataset) -> None:
+        """
+        Replace patient information in the dataset with the anonymized id.
+
+        :param dataset: pydicom dataset of the image
+        :return: None
+        """
+        anonymize_dataset(dataset, self.anonymized_id, self.profile)
 
     def given_name(self) -> str:
         """
@@ -150,6 +296,8 @@ class Patient:
 
         :return: str containing patient's given name
         """
+        if not self.patient_data["PatientName"]:
+            return ""
         return self.patient_data["PatientName"].given_name.title()
 
     def last_name(self) -> str:
@@ -158,6 +306,8 @@ class Patient:
 
         :return: str containing patient's last name
         """
+        if not self.patient_data["PatientName"]:
+            return ""
         return self.patient_data["PatientName"].family_name.title()
 
     @staticmethod
@@ -0,0 +1,199 @@
+"""Concurrent crawler of directories containing dicom images."""
+
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+
+from pydicom.dataset import Dataset
+
+from .fileio import read_header
+
+from pathlib import Path
+
+if TYPE_CHECKING:
+    # sqlite3 is imported only by the runs using an index
+    from .index import DiscoveryIndex
+
+
+# directories are mostly read over the network: use more threads than CPUs
+DEFAULT_CRAWLER_THREADS = 16
+
+
+class DicomDirectory(NamedTuple):
+    """
+    Directory containing dicom images.
+
+    path: Path of the directory (Path)
+    images: names of the dicom images inside the directory, sorted (list[str])
+    header: header elements of the first image, if requested (Dataset).
+    """
+
+    path: Path
+    images: List[str]
+    header: Optional[Dataset] = None
+
+
+def first_header(directory: Path, images: List[str], keywords: Iterable[str]) -> Dataset:
+    """
+    Read the header of the first readable image of a directory.
+
+    :param directory: Path of the directory
+    :param images: names of the images, in the order they are tried
+    :param keywords: keywords of the header elements to be read
+    :return: pydicom dataset containing the requested elements
+    :raise Exception: the error of the first image, if no image can be read
+    """
+    error = None
+    for image in images:
+        try:
+            return read_header(directory / image, keywords)
+        except Exception as e:  # pylint: disable=broad-except
+            if error is None:
+                error = e
+    raise error
+
+
+def scan_directory(
+    directory: Path,
+    keywords: Optional[Iterable[str]] = None,
+    index: Optional["DiscoveryIndex"] = None,
+) -> Tuple[Optional[DicomDirectory], List[Tuple[Path, bool]], Optional[Exception]]:
+    """
+    Scan a single directory.
+
+    Subdirectories are returned even when no header of the directory can be read, so
+    that a broken image never hides the rest of the tree.
+
+    :param directory: Path of the directory
+    :param keywords: keywords of the header elements of the first image to be read
+    :param index: index of the headers read by previous runs
+    :return: DicomDirectory (None if there are no images, or their headers cannot be read),
+        list of subdirectories, each one with whether it is a symbolic link, and error
+        raised reading the headers, if any
+    """
+    # taken before listing: changes made while scanning invalidate the index entry
+    stat = os.stat(directory) if index is not None else None
+    images = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # DirEntry caches the file type: no stat is needed on most file systems
+            try:
+                if entry.is_dir():
+                    subdirectories.append((Path(entry.path), entry.is_symlink()))
+                elif entry.name.endswith(".dcm") and entry.is_file():
+                    images.append(entry.name)
+            except OSError:
+                pass
+
+    if not images:
+        return None, subdirectories, None
+
+    images.sort()
+    header = None
+    if keywords is not None:
+        if index is not None:
+            header = index.get(directory, stat)
+        if header is None:
+            try:
+                header = first_header(directory, images, keywords)
+            except Exception as e:  # pylint: disable=broad-except
+                return None, subdirectories, e
+            if index is not None:
+                index.put(directory, stat, header)
+    return DicomDirectory(directory, images, header), subdirectories, None
+
+
+def _identity(directory: Path) -> Tuple[int, int]:
+    """
+    Identity of a directory on disk.
+
+    :param directory: Path of the directory
+    :return: device and inode of the directory
+    """
+    stat = directory.stat()
+    return stat.st_dev, stat.st_ino
+
+
+def _print_error(directory: Path, error: Exception) -> None:
+    """
+    Print the error of a directory that cannot be read.
+
+    :param directory: Path of the directory
+    :param error: exception raised
+    :return: None
+    """
+    print(f"Could not read {directory}: {type(error).__name__}")
+
+
+def iter_dicom_directories(
+    root: Path,
+    threads: Optional[int] = None,
+    keywords: Optional[Iterable[str]] = None,
+    index: Optional["DiscoveryIndex"] = None,
+    on_error: Optional[Callable[[Path, Exception], None]] = None,
+) -> Iterator[DicomDirectory]:
+    """
+    Walk the directory tree concurrently, yielding directories with dicom images.
+
+    Directories are scanned at any depth by a pool of threads and are yielded as soon as
+    they are found, so that the caller can start working before the walk is over.
+    Images directly inside root are not considered. The header of a directory is read
+    from its first readable image; directories that cannot be listed, or with no readable
+    image, are reported to on_error and skipped, without affecting their subdirectories.
+
+    :param root: Path of the root directory
+    :param threads: number of threads scanning directories
+    :param keywords: keywords of the header elements of the first image to be read
+    :param index: index of the headers read by previous runs, updated with new ones
+    :param on_error: function called with the Path of each directory skipped and the
+        error, printing it by default
+    :return: iterator of DicomDirectory
+    """
+    if threads is None:
+        threads = DEFAULT_CRAWLER_THREADS
+    if keywords is not None:
+        keywords = list(keywords)
+    if on_error is None:
+        on_error = _print_error
+
+    visited: Set[Tuple[int, int]] = {_identity(root)}
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        pending = {executor.submit(scan_directory, root): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    dicom_directory, subdirectories, error = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    on_error(directory, e)
+                    continue
+                if error is not None:
+                    on_error(directory, error)
+
+                for subdirectory, is_symlink in subdirectories:
+                    # avoid loops through symbolic links
+                    if is_symlink:
+                        try:
+                            identity = _identity(subdirectory)
+                        except OSError:
+                            continue
+                        if identity in visited:
+                            continue
+                        visited.add(identity)
+                    future = executor.submit(scan_directory, subdirectory, keywords, index)
+                    pending[future] = subdirectory
+
+                if dicom_directory is not None and directory != root:
+                    yield dicom_directory
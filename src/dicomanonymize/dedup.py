@@ -0,0 +1,266 @@
+"""Deduplication of repeated images, anonymized once and linked, copied or skipped."""
+
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+from multiprocessing.pool import ThreadPool
+import hashlib
+import os
+import threading
+
+from .fileio import copy_file, read_header
+from .metrics import Metrics
+from .scheduler import DEFAULT_THREADS, ImageResult, ImageTask, imap_ordered
+
+from pathlib import Path
+
+
+# how duplicates are identified
+DEDUP_METHODS = ["uid", "content"]
+# what is written for duplicates: a hard link to, or a copy of, the output of the first
+# image, or nothing (the journal and the results then point to the output of the first image)
+DEDUP_POLICIES = ["link", "copy", "skip"]
+# bytes hashed at each end of an image before comparing whole images
+SAMPLE_SIZE = 1 << 16
+# bytes read at once when hashing whole images
+BLOCK_SIZE = 1 << 20
+# images whose key is computed ahead by each thread
+KEYS_PER_THREAD = 4
+
+
+def _sample_hash(path: Path) -> Tuple[int, bytes]:
+    """
+    Size and hash of the first and last SAMPLE_SIZE bytes of a file.
+
+    :param path: Path of the file
+    :return: (size, digest)
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        digest = hashlib.blake2b(f.read(SAMPLE_SIZE), digest_size=16)
+        if size > 2 * SAMPLE_SIZE:
+            f.seek(-SAMPLE_SIZE, os.SEEK_END)
+        digest.update(f.read())
+    return size, digest.digest()
+
+
+def _full_hash(path: Path) -> bytes:
+    """
+    Hash of a whole file.
+
+    :param path: Path of the file
+    :return: digest
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+class _Original:
+    """
+    First image with a given key, and the duplicates waiting for its result.
+
+    task: ImageTask of the image (ImageTask)
+    full_hash: hash of the whole image, computed only when another image has the same
+        sample hash (bytes)
+    result: ImageResult of the image, None until it is done (ImageResult)
+    duplicates: ImageTasks of the duplicates not written yet (list[ImageTask]).
+    """
+
+    def __init__(self, task: ImageTask) -> None:
+        """
+        Track an image.
+
+        :param task: ImageTask
+        """
+        self.task = task
+        self.full_hash: Optional[bytes] = None
+        self.result: Optional[ImageResult] = None
+        self.duplicates: List[ImageTask] = []
+
+
+class Deduplicator:
+    """
+    Anonymize each distinct image once, and write the outputs of its duplicates from it.
+
+    With the "uid" method, images of the same patient with the same SOPInstanceUID are
+    duplicates: only the first bytes of each image are read. With the "content" method,
+    images with the same bytes are duplicates: images of the same size whose first and
+    last bytes have the same hash are compared by the hash of their whole content, so
+    images are read twice only when they are likely duplicates. Keys are computed ahead
+    by a pool of threads.
+
+    Duplicates are held back from the workers until the first image with the same key is
+    done, then linked to its output, copied from it, or skipped, according to the policy.
+    Tasks and results can be iterated by different threads.
+    """
+
+    def __init__(
+        self,
+        method: str = "uid",
+        policy: str = "link",
+        threads: Optional[int] = None,
+        metrics: Optional[Metrics] = None,
+    ) -> None:
+        """
+        Create the deduplicator.
+
+        :param method: one of DEDUP_METHODS
+        :param policy: one of DEDUP_POLICIES
+        :param threads: number of threads computing the keys
+        :param metrics: Metrics counting the duplicates and the bytes saved
+        :raise ValueError: if the method or the policy is unknown
+        """
+        if method not in DEDUP_METHODS:
+            raise ValueError(
+                f"Unknown deduplication method {method}: expected one of"
+                + f" {', '.join(DEDUP_METHODS)}"
+            )
+        if policy not in DEDUP_POLICIES:
+            raise ValueError(
+                f"Unknown deduplication policy {policy}: expected one of"
+                + f" {', '.join(DEDUP_POLICIES)}"
+            )
+        self.method = method
+        self.policy = policy
+        self.threads = threads or DEFAULT_THREADS
+        self.metrics = Metrics() if metrics is None else metrics
+        self._lock = threading.Lock()
+        self._originals: Dict[Hashable, List[_Original]] = {}
+        self._sources: Dict[Path, _Original] = {}
+        # duplicates of images already done, written with the next result
+        self._ready: List[Tuple[_Original, ImageTask]] = []
+
+    def _key(self, task: ImageTask) -> Tuple[ImageTask, Optional[Hashable]]:
+        """
+        Key of an image: images with different keys are never duplicates.
+
+        :param task: ImageTask
+        :return: the task, and its key (None if it cannot be computed)
+        """
+        try:
+            if self.method == "uid":
+                uid = read_header(task.image, ["SOPInstanceUID"]).get("SOPInstanceUID")
+                if not uid:
+                    return task, None
+                return task, (task.patient.anonymized_id, str(uid))
+            return task, _sample_hash(task.image)
+        except Exception:  # pylint: disable=broad-except
+            # unreadable images are left to the workers, which report the failure
+            return task, None
+
+    def _original(self, task: ImageTask, key: Hashable) -> Optional[_Original]:
+        """
+        Find the first image a task is a duplicate of.
+
+        :param task: ImageTask
+        :param key: key of the image
+        :return: _Original of the first image, None if the image is not a duplicate
+        """
+        candidates = self._originals.get(key, [])
+        if self.method == "uid" or not candidates:
+            return candidates[0] if candidates else None
+        # same size and sample hash: compare whole images
+        full_hash = _full_hash(task.image)
+        for candidate in candidates:
+            if candidate.full_hash is None:
+                candidate.full_hash = _full_hash(candidate.task.image)
+            if candidate.full_hash == full_hash:
+                return candidate
+        return None
+
+    def unique(self, tasks: Iterable[ImageTask]) -> Iterator[ImageTask]:
+        """
+        Hold back the duplicates of earlier images.
+
+        :param tasks: iterable of ImageTask
+        :return: iterator of the ImageTasks of distinct images
+        """
+        with ThreadPool(self.threads) as pool:
+            for task, key in imap_ordered(
+                pool, self._key, tasks, self.threads * KEYS_PER_THREAD
+            ):
+                if key is None:
+                    yield task
+                    continue
+                try:
+                    original = self._original(task, key)
+                except OSError:
+                    yield task
+                    continue
+                with self._lock:
+                    if original is None:
+                        original = _Original(task)
+                        self._originals.setdefault(key, []).append(original)
+                        self._sources[task.image] = original
+                    elif original.result is None:
+                        original.duplicates.append(task)
+                        continue
+                    else:
+                        self._ready.append((original, task))
+                        continue
+                yield task
+
+    def complete(self, results: Iterable[ImageResult]) -> Iterator[ImageResult]:
+        """
+        Write the outputs of the duplicates as the images they duplicate are done.
+
+        :param results: iterator of the ImageResults of the tasks yielded by unique
+        :return: iterator of the same ImageResults, and of the ImageResults of duplicates
+        """
+        for result in results:
+            yield result
+            with self._lock:
+                original = self._sources.pop(result.source, None)
+                if original is not None:
+                    original.result = result
+                    self._ready.extend((original, task) for task in original.duplicates)
+                    original.duplicates = []
+            yield from self._write_ready()
+        yield from self._write_ready()
+
+    def _write_ready(self) -> Iterator[ImageResult]:
+        """
+        Write the outputs of the duplicates of images already done.
+
+        :return: iterator of ImageResult
+        """
+        with self._lock:
+            ready, self._ready = self._ready, []
+        for original, task in ready:
+            yield self._write(original.result, task)
+
+    def _write(self, original: ImageResult, task: ImageTask) -> ImageResult:
+        """
+        Write the output of a duplicate.
+
+        :param original: ImageResult of the image it duplicates
+        :param task: ImageTask of the duplicate
+        :return: ImageResult of the duplicate
+        """
+        try:
+            stat = os.stat(task.image)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            size = mtime_ns = 0
+        if original.output is None:
+            # the duplicate would have failed as well
+            return ImageResult(
+                task.image, None, task.patient.anonymized_id, size, mtime_ns, original.error
+            )
+        output = original.output
+        written = 0
+        try:
+            if self.policy != "skip":
+                copy_file(original.output, task.output, hardlink=self.policy == "link")
+                output = task.output
+                if self.policy == "copy":
+                    written = original.written
+        except OSError as e:
+            return ImageResult(
+                task.image, None, task.patient.anonymized_id, size, mtime_ns, type(e).__name__
+            )
+        self.metrics.deduplicated(size)
+        return ImageResult(
+            task.image, output, task.patient.anonymized_id, size, mtime_ns, written=written
+        )
@@ -0,0 +1,526 @@
+"""Low level reading, writing and copying of dicom files."""
+
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import chain
+import errno
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pydicom import dcmread
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset, read_partial
+from pydicom.filewriter import write_dataset, write_file_meta_info
+from pydicom.tag import Tag
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+from pathlib import Path
+
+
+# maximum number of bytes copied by a single system call
+COPY_BLOCK_SIZE = 1 << 30
+
+# number of bytes read at first when probing the header of an image
+PROBE_SIZE = 16384
+
+# bytes of pixel data compressed at once when deflating an image
+DEFLATE_BLOCK_SIZE = 1 << 20
+
+# tag ending the items of encapsulated pixel data
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+# explicit VRs whose length takes 4 bytes, after 2 reserved bytes
+_LONG_VRS = set(b"OB OD OF OL OV OW SQ SV UC UN UR UT UV".split())
+
+# Linux ioctl cloning a whole file on copy-on-write file systems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors meaning that a copy strategy is not available for the given files
+_UNSUPPORTED_ERRORS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EBADF,
+    errno.ENOTSOCK,
+    getattr(errno, "EOPNOTSUPP", errno.EINVAL),
+    getattr(errno, "ENOTSUP", errno.EINVAL),
+}
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """
+    Copy bytes with os.copy_file_range.
+
+    :param source_fd: file descriptor of the source file
+    :param destination_fd: file descriptor of the destination file
+    :param offset: position of the first byte in the source file
+    :param count: number of bytes to be copied
+    :return: number of copied bytes
+    """
+    return os.copy_file_range(source_fd, destination_fd, count, offset_src=offset)
+
+
+def _sendfile(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """
+    Copy bytes with os.sendfile.
+
+    :param source_fd: file descriptor of the source file
+    :param destination_fd: file descriptor of the destination file
+    :param offset: position of the first byte in the source file
+    :param count: number of bytes to be copied
+    :return: number of copied bytes
+    """
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+def _copy_mmap(source_fd: int, destination_fd: int, offset: int, count: int) -> int:
+    """
+    Copy bytes through a memory map of the source file.
+
+    :param source_fd: file descriptor of the source file
+    :param destination_fd: file descriptor of the destination file
+    :param offset: position of the first byte in the source file
+    :param count: number of bytes to be copied
+    :return: number of copied bytes
+    """
+    # mmap offsets must be a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(source_fd, offset + count - start, offset=start, access=mmap.ACCESS_READ) as m:
+        with memoryview(m) as view:
+            return os.write(destination_fd, view[offset - start :])
+
+
+_COPY_STRATEGIES = [
+    strategy
+    for strategy, available in (
+        (_copy_file_range, hasattr(os, "copy_file_range")),
+        (_sendfile, hasattr(os, "sendfile")),
+        (_copy_mmap, True),
+    )
+    if available
+]
+
+
+def copy_range(source_fd: int, destination_fd: int, offset: int, count: int) -> None:
+    """
+    Copy a range of bytes between two files without reading them into Python objects.
+
+    Bytes are appended at the current position of the destination file, using the
+    first strategy supported by the platform and file system among copy_file_range,
+    sendfile and mmap.
+
+    :param source_fd: file descriptor of the source file
+    :param destination_fd: file descriptor of the destination file
+    :param offset: position of the first byte in the source file
+    :param count: number of bytes to be copied
+    :return: None
+    """
+    strategies = iter(_COPY_STRATEGIES)
+    strategy = next(strategies)
+    while count > 0:
+        try:
+            copied = strategy(source_fd, destination_fd, offset, min(count, COPY_BLOCK_SIZE))
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRORS or strategy is _copy_mmap:
+                raise
+            strategy = next(strategies)
+            continue
+        if copied == 0:
+            raise EOFError(f"Unexpected end of file at byte {offset}")
+        offset += copied
+        count -= copied
+
+
+def _temporary_path(output_path: Path) -> Path:
+    """
+    Temporary path next to output_path, unique to the calling process and thread.
+
+    :param output_path: Path of the output file
+    :return: Path of the temporary file
+    """
+    return output_path.with_name(
+        f".{output_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+
+
+@contextmanager
+def atomic_output(output_path: Path) -> Iterator[BinaryIO]:
+    """
+    Open a temporary file replacing output_path only once it has been fully written.
+
+    Partially written images never appear at output_path and output_path can safely be
+    the source file itself.
+
+    :param output_path: Path of the output file
+    :return: context manager yielding the binary file to be written
+    """
+    temp_path = _temporary_path(output_path)
+    try:
+        with open(temp_path, "wb") as destination:
+            yield destination
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+
+def _reflink(source_fd: int, destination_fd: int) -> bool:
+    """
+    Clone a file sharing its blocks, if the file system supports it.
+
+    :param source_fd: file descriptor of the source file
+    :param destination_fd: file descriptor of the destination file
+    :return: True if the file has been cloned
+    """
+    try:
+        import fcntl  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _same_file(path: Path, output_path: Path) -> bool:
+    """
+    Check whether the two paths point to the same file.
+
+    :param path: Path of the first file
+    :param output_path: Path of the second file
+    :return: True if output_path exists and is the same file as path
+    """
+    try:
+        return os.path.samefile(path, output_path)
+    except OSError:
+        return False
+
+
+def copy_file(path: Path, output_path: Path, hardlink: bool = False) -> None:
+    """
+    Copy a file without parsing it.
+
+    The file is cloned where the file system supports it (reflink), otherwise it is
+    copied in the kernel. With hardlink the output is a hard link to the source file,
+    falling back to a copy when a link cannot be created (e.g. across file systems).
+
+    :param path: Path of the source file
+    :param output_path: Path of the output file
+    :param hardlink: hard link the output to the source file
+    :return: None
+    """
+    if _same_file(path, output_path):
+        return
+
+    if hardlink:
+        temp_path = _temporary_path(output_path)
+        try:
+            os.link(path, temp_path)
+        except OSError:
+            pass
+        else:
+            os.replace(temp_path, output_path)
+            return
+
+    with open(path, "rb") as source, atomic_output(output_path) as destination:
+        if not _reflink(source.fileno(), destination.fileno()):
+            copy_range(
+                source.fileno(), destination.fileno(), 0, os.fstat(source.fileno()).st_size
+            )
+
+
+def parse_header(source: BinaryIO) -> Tuple[Dataset, Optional[int]]:
+    """
+    Parse the header of a dicom image to be rewritten.
+
+    Parsing stops before the pixel data, which can be passed through unchanged from the
+    returned offset. Deflated images are compressed as a whole, so they are fully parsed.
+
+    :param source: binary file positioned at the start of the image
+    :return: dataset and offset of the pixel data in source, None if fully parsed
+    """
+    start = source.tell()
+    dataset = dcmread(source, stop_before_pixels=True)
+    if dataset.file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian:
+        # the whole dataset is compressed: there are no raw bytes to pass through
+        source.seek(start)
+        return dcmread(source), None
+    return dataset, source.tell()
+
+
+def original_encoding(dataset: Dataset) -> Tuple[bool, bool, Union[str, List[str]]]:
+    """
+    Get the encoding a dataset was read with.
+
+    pydicom 2, the last version supporting Python 3.6, has no original_encoding.
+
+    :param dataset: pydicom dataset read from a file
+    :return: whether the dataset is implicit VR and little endian, and its character set
+    """
+    if hasattr(dataset, "original_encoding"):
+        return (*dataset.original_encoding, dataset.original_character_set)
+    return dataset.read_implicit_vr, dataset.read_little_endian, dataset.read_encoding
+
+
+def _read_exactly(source: BinaryIO, size: int) -> bytes:
+    """
+    Read a number of bytes, failing at the end of the file.
+
+    :param source: binary file
+    :param size: number of bytes
+    :return: bytes read
+    :raise EOFError: if the file ends first
+    """
+    data = source.read(size)
+    if len(data) < size:
+        raise EOFError(f"Unexpected end of file at byte {source.tell()}")
+    return data
+
+
+def pixel_data_end(
+    source: BinaryIO, offset: int, is_implicit_vr: bool, is_little_endian: bool
+) -> int:
+    """
+    Find the end of the pixel data element, without reading its value.
+
+    :param source: seekable binary file
+    :param offset: offset of the pixel data element, as returned by parse_header
+    :param is_implicit_vr: the image is encoded with implicit VRs
+    :param is_little_endian: the image is encoded in little endian
+    :return: offset of the first byte following the pixel data element
+    """
+    endian = "<" if is_little_endian else ">"
+    source.seek(offset + 4)
+    if is_implicit_vr:
+        (length,) = struct.unpack(endian + "L", _read_exactly(source, 4))
+    elif _read_exactly(source, 2) in _LONG_VRS:
+        (length,) = struct.unpack(endian + "2xL", _read_exactly(source, 6))
+    else:
+        (length,) = struct.unpack(endian + "H", _read_exactly(source, 2))
+    if length != 0xFFFFFFFF:
+        return source.tell() + length
+    # encapsulated pixel data: items up to the sequence delimiter
+    while True:
+        group, element, length = struct.unpack(endian + "HHL", _read_exactly(source, 8))
+        if group << 16 | element == SEQUENCE_DELIMITER:
+            return source.tell()
+        source.seek(length, os.SEEK_CUR)
+
+
+def modify_image(
+    source: BinaryIO,
+    dataset: Dataset,
+    offset: Optional[int],
+    modify: Callable[[Dataset], None],
+    trailer: bool = False,
+) -> Tuple[Optional[int], bytes]:
+    """
+    Modify the header of an image, and optionally the elements following its pixel data.
+
+    parse_header stops before the pixel data, so the elements following it (trailing
+    padding, digital signatures, private elements of groups above 7FE0) are passed through
+    unchanged, unless trailer is set: they are then parsed, modified along with the header,
+    and returned encoded as in the source, to be written after the pixel data.
+
+    :param source: binary file the header has been parsed from
+    :param dataset: header returned by parse_header
+    :param offset: offset of the pixel data in source, None if the dataset is complete
+    :param modify: function modifying the dataset in place
+    :param trailer: modify the elements following the pixel data too
+    :return: end of the pixel data in source (None to copy the source up to its end), and
+        the modified elements following it
+    """
+    if not trailer or offset is None:
+        modify(dataset)
+        return None, b""
+    is_implicit_vr, is_little_endian, character_set = original_encoding(dataset)
+    end = pixel_data_end(source, offset, is_implicit_vr, is_little_endian)
+    source.seek(end)
+    elements = read_dataset(source, is_implicit_vr, is_little_endian)
+    tags = list(elements.keys())
+    dataset.update(elements)
+    modify(dataset)
+    trailing = Dataset()
+    for tag in tags:
+        if tag in dataset:
+            trailing[tag] = dataset[tag]
+            del dataset[tag]
+    encoded = DicomBytesIO()
+    encoded.is_implicit_VR = is_implicit_vr
+    encoded.is_little_endian = is_little_endian
+    write_dataset(encoded, trailing, character_set)
+    return end, encoded.getvalue()
+
+
+def iter_range(source: BinaryIO, start: int, end: Optional[int]) -> Iterator[bytes]:
+    """
+    Read a range of a file in blocks of DEFLATE_BLOCK_SIZE bytes.
+
+    :param source: seekable binary file
+    :param start: offset of the first byte
+    :param end: offset following the last byte, None to read up to the end of the file
+    :return: iterator of bytes
+    """
+    source.seek(start)
+    if end is None:
+        yield from iter(lambda: source.read(DEFLATE_BLOCK_SIZE), b"")
+        return
+    remaining = end - start
+    while remaining > 0:
+        block = _read_exactly(source, min(remaining, DEFLATE_BLOCK_SIZE))
+        remaining -= len(block)
+        yield block
+
+
+def can_deflate(dataset: Dataset) -> bool:
+    """
+    Check whether an image can be re-encoded with the Deflated Explicit VR transfer syntax.
+
+    Encapsulated (JPEG, RLE, ...) pixel data is already compressed: those images are
+    written with their own transfer syntax. Images without transfer syntax are native,
+    images with an unknown or private one are written with it.
+
+    :param dataset: header of the image
+    :return: True if the pixel data is native
+    """
+    syntax = dataset.file_meta.get("TransferSyntaxUID")
+    if syntax is None:
+        return True
+    try:
+        return not syntax.is_encapsulated
+    except ValueError:
+        # pydicom knows only the encoding of the standard transfer syntaxes
+        return False
+
+
+def write_deflated(
+    destination: BinaryIO, dataset: Dataset, tail: Iterable[bytes], level: int
+) -> None:
+    """
+    Write an image with the Deflated Explicit VR Little Endian transfer syntax.
+
+    The file meta information is written as is, the dataset is encoded as Explicit VR
+    Little Endian and compressed with zlib. Pixel data of Explicit VR Little Endian images
+    is compressed straight from the source bytes, block by block; the pixel data of other
+    images is decoded first, to be encoded again.
+
+    :param destination: writable binary file
+    :param dataset: header of the image, whose transfer syntax must not be encapsulated
+    :param tail: blocks of the source bytes following the header (empty if the dataset is
+        complete)
+    :param level: zlib compression level, from 0 (none) to 9 (best)
+    :return: None
+    """
+    is_implicit_vr, is_little_endian, _ = original_encoding(dataset)
+    if is_implicit_vr or not is_little_endian:
+        rest = BytesIO(b"".join(tail))
+        dataset.update(read_dataset(rest, is_implicit_vr, is_little_endian))
+        tail = []
+    dataset.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+    header = DicomBytesIO()
+    header.write(getattr(dataset, "preamble", None) or b"\0" * 128)
+    header.write(b"DICM")
+    write_file_meta_info(header, dataset.file_meta)
+    destination.write(header.getvalue())
+
+    body = DicomBytesIO()
+    body.is_little_endian = True
+    body.is_implicit_VR = False
+    write_dataset(body, dataset)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    written = destination.write(compressor.compress(body.getvalue()))
+    for block in tail:
+        written += destination.write(compressor.compress(block))
+    written += destination.write(compressor.flush())
+    if written % 2:
+        # the deflated bit stream is padded to an even length
+        destination.write(b"\0")
+
+
+def rewrite_image(
+    path: Path,
+    output_path: Path,
+    modify: Callable[[Dataset], None],
+    deflate_level: Optional[int] = None,
+    trailer: bool = False,
+) -> None:
+    """
+    Rewrite the header of a dicom image, passing pixel data through unchanged.
+
+    Only the header is parsed; the modified header is written to the output file and
+    the pixel data (and everything following it) is copied from the source file
+    byte by byte. With deflate_level, images with native pixel data are compressed with
+    the Deflated Explicit VR Little Endian transfer syntax instead, by the calling process.
+
+    :param path: Path of the source image
+    :param output_path: Path of the output image
+    :param modify: function modifying the header dataset in place
+    :param deflate_level: zlib compression level of the output, None to keep the transfer
+        syntax of the source
+    :param trailer: modify the elements following the pixel data too (see modify_image)
+    :return: None
+    """
+    with open(path, "rb") as source:
+        dataset, offset = parse_header(source)
+        end, trailing = modify_image(source, dataset, offset, modify, trailer)
+        with atomic_output(output_path) as destination:
+            if deflate_level is not None and can_deflate(dataset):
+                tail: Iterable[bytes] = []
+                if offset is not None:
+                    tail = chain(iter_range(source, offset, end), [trailing])
+                write_deflated(destination, dataset, tail, deflate_level)
+                return
+            dataset.save_as(destination)
+            if offset is None:
+                return
+            if end is None:
+                end = os.fstat(source.fileno()).st_size
+            destination.flush()
+            copy_range(source.fileno(), destination.fileno(), offset, end - offset)
+            destination.write(trailing)
+
+
+def read_header(path: Path, keywords: Iterable[str], probe_size: int = PROBE_SIZE) -> Dataset:
+    """
+    Read only some elements of the header of a dicom image.
+
+    Parsing stops right after the last requested element. The first probe_size bytes
+    are read at once and parsed in memory; the file is read again only if the requested
+    elements do not fit in them.
+
+    :param path: Path of the image
+    :param keywords: keywords of the elements to be read
+    :param probe_size: number of bytes read at first
+    :return: pydicom dataset containing the requested elements, if present
+    """
+    tags = [Tag(tag_for_keyword(keyword)) for keyword in keywords]
+    last_tag = max(tags)
+    stopped = []
+
+    def after_last_tag(tag, vr, length) -> bool:  # pylint: disable=unused-argument
+        """Stop reading once all requested elements have been read."""
+        if tag > last_tag:
+            stopped.append(tag)
+            return True
+        return False
+
+    with open(path, "rb") as f:
+        data = f.read(probe_size)
+        if len(data) < probe_size:
+            # the whole file has been read
+            return read_partial(BytesIO(data), after_last_tag, specific_tags=tags)
+        try:
+            dataset = read_partial(BytesIO(data), after_last_tag, specific_tags=tags)
+            if stopped:
+                return dataset
+        except Exception:
+            # the probe ended in the middle of an element
+            pass
+        f.seek(0)
+        return read_partial(f, after_last_tag, specific_tags=tags)
@@ -1,182 +1,603 @@
 """Anonymization and path acquisition functions."""
 
-from typing import List
-from pydicom import dcmread
-import pandas as pd
-import datetime
-from multiprocessing.pool import Pool, ThreadPool
-from multiprocessing import cpu_count
-from functools import partial
-import numpy as np
-import random
-from numba import jit, int32, void
-
-from .classes import Patient, VALUES_TO_ANONYMIZE
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from contextlib import ExitStack
+import secrets
+import threading
+
+from pydicom.dataset import Dataset
+
+from .adaptive import AdaptiveController
+from .archive import (
+    archive_mode,
+    is_archive,
+    iter_anonymize_members,
+    iter_archive_directories,
+    iter_directory_members,
+    open_archive_members,
+    open_writer,
+)
+from .classes import Patient, Profile, VALUES_TO_ANONYMIZE
+from .crawler import DicomDirectory, iter_dicom_directories
+from .dedup import Deduplicator
+from .fileio import read_header
+from .journal import Journal, is_done, read_journal
+from .metrics import Metrics
+from .pseudonym import DEFAULT_ID_SPACE, KEY_NAME, Pseudonymizer, load_key, shard_of
+from .rules import DEFAULT_PROFILE, load_profile
+from .scheduler import (
+    ImageResult,
+    PatientTracker,
+    default_processes,
+    iter_image_tasks,
+    iter_results,
+)
+from .table import TABLE_NAME, ConversionTableWriter, conversion_table_path, shard_table_name
 
 from pathlib import Path
 
 
+# execution backends of directory runs
+BACKENDS = ("pool", "pipeline")
+
+
 def anonymize(
     input_directory: Path,
     output_directory: Path = None,
     patients: List[Patient] = None,
     parallel: bool = True,
     destination_directories: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+    index: Optional[Path] = None,
+    journal: Optional[Path] = None,
+    resume: bool = False,
+    key: Optional[Union[bytes, str]] = None,
+    id_space: int = DEFAULT_ID_SPACE,
+    table_format: str = "csv",
+    table_compression: Optional[str] = None,
+    metrics: Optional[Metrics] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    adaptive: bool = False,
+    backend: str = "pool",
+    profile: Union[str, Path] = DEFAULT_PROFILE,
+    uid_map: Optional[Path] = None,
+    dedup: Optional[str] = None,
+    dedup_policy: str = "link",
+    deflate_level: Optional[int] = None,
 ) -> None:
     """
     Anonymize patients data.
 
+    See iter_anonymize, which yields the result of each image as soon as it is done.
+
     :param input_directory: Path of the input directory (Path)
     :param output_directory: Path of the output directory (Path)
     :param patients: list of Patient objects (list[Patient])
     :param parallel: use CPU multithreading (bool)
     :param destination_directories: anonymize only destination directories (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs (int)
+    :param threads: number of threads per worker process (int)
+    :param hardlink: with destination_directories, hard link images instead of copying them
+    :param index: Path of the discovery index file, reused by later runs (Path)
+    :param journal: Path of the journal of anonymized images (Path)
+    :param resume: skip images already in the journal (bool)
+    :param key: secret key of the anonymized ids, by default the one kept in the key file
+        next to the conversion table, created with a random key by the first run (bytes)
+    :param id_space: number of possible anonymized ids (int)
+    :param table_format: format of the conversion table: csv, arrow or parquet (str)
+    :param table_compression: compression of the conversion table (str)
+    :param metrics: Metrics collecting timings, counters and reporting progress (Metrics)
+    :param shard: (i, N) to anonymize only the i-th of N disjoint sets of patients
+    :param adaptive: adjust the processes and threads in use to the measured throughput
+    :param backend: execution backend, "pool" or "pipeline" (str)
+    :param profile: de-identification profile, built-in name or Path of a JSON profile
+    :param uid_map: Path of the directory where the UIDs remapped by the profile are
+        recorded, to be read with uids.read_uid_map
+    :param dedup: anonymize repeated images once, identified by "uid" or "content"
+    :param dedup_policy: output of repeated images: "link", "copy" or "skip"
+    :param deflate_level: zlib compression level (0-9) of the images, written with the
+        Deflated Explicit VR Little Endian transfer syntax; None keeps their transfer syntax
     :return: None
     """
+    for _ in iter_anonymize(
+        input_directory,
+        output_directory,
+        patients,
+        parallel,
+        destination_directories,
+        processes,
+        threads,
+        hardlink,
+        index,
+        journal,
+        resume,
+        key,
+        id_space,
+        table_format,
+        table_compression,
+        metrics,
+        shard=shard,
+        adaptive=adaptive,
+        backend=backend,
+        profile=profile,
+        uid_map=uid_map,
+        dedup=dedup,
+        dedup_policy=dedup_policy,
+        deflate_level=deflate_level,
+    ):
+        pass
+
+
+def iter_anonymize(
+    input_directory: Path,
+    output_directory: Path = None,
+    patients: Optional[Iterable[Patient]] = None,
+    parallel: bool = True,
+    destination_directories: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+    index: Optional[Path] = None,
+    journal: Optional[Path] = None,
+    resume: bool = False,
+    key: Optional[Union[bytes, str]] = None,
+    id_space: int = DEFAULT_ID_SPACE,
+    table_format: str = "csv",
+    table_compression: Optional[str] = None,
+    metrics: Optional[Metrics] = None,
+    max_in_flight: Optional[int] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    adaptive: bool = False,
+    backend: str = "pool",
+    profile: Union[str, Path] = DEFAULT_PROFILE,
+    uid_map: Optional[Path] = None,
+    dedup: Optional[str] = None,
+    dedup_policy: str = "link",
+    deflate_level: Optional[int] = None,
+) -> Iterator[ImageResult]:
+    """
+    Anonymize patients data, yielding the result of each image as soon as it is done.
+
+    Images are anonymized while the input directory is still being walked, and more
+    directories are read only when the workers need more images: memory does not grow
+    with the number of images, and a slow consumer slows down the whole pipeline.
+    Each patient is appended to the conversion table as soon as it is found, before any
+    of its images is written.
+
+    The input can be a ZIP or TAR archive, and the output an archive name (.zip, .tar,
+    .tar.gz, .tgz, .tar.bz2 or .tar.xz): images are then anonymized in memory by a pool
+    of threads and written in order, with the paths anonymized as directories are.
+    The conversion table is written next to an output archive, never inside it. Member
+    names that would escape the output directory (absolute, or with ".." parts) are
+    rejected, and such runs cannot be resumed.
+
+    With shard=(i, N), only the patients whose PatientID hashes to the i-th of N shards
+    are anonymized: N runs, possibly on different hosts sharing the input and output
+    directories, anonymize every patient exactly once. Anonymized ids depend only on the
+    key and on the PatientID, so they agree between shards; each shard writes its own
+    conversion table, to be combined with merge_conversion_tables.
+
+    With adaptive, processes is the largest number of worker processes, threads the
+    initial number of threads of each one, and the number of processes and threads in use
+    is adjusted while the run is going to the most efficient point; the chosen settings
+    are printed, to be pinned with processes and threads by later runs. Archives are
+    always anonymized with a fixed number of threads.
+
+    The "pool" backend runs every image on a pool of processes, each one reading, rewriting
+    and writing images on its own threads. The "pipeline" backend separates the stages:
+    images are read ahead and written in batches by threads, while worker processes only
+    rewrite headers, so that the CPU is kept busy while waiting for slow storage. Both
+    give the same output.
+
+    :param input_directory: Path of the input directory or archive (Path)
+    :param output_directory: Path of the output directory or archive (Path)
+    :param patients: iterable of Patient objects, instead of walking input_directory
+    :param parallel: use CPU multithreading (bool)
+    :param destination_directories: anonymize only destination directories (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs (int)
+    :param threads: number of threads per worker process (int)
+    :param hardlink: with destination_directories, hard link images instead of copying them
+    :param index: Path of the discovery index file, reused by later runs (Path)
+    :param journal: Path of the journal of anonymized images (Path)
+    :param resume: skip images already in the journal (bool)
+    :param key: secret key of the anonymized ids, by default the one kept in the key file
+        next to the conversion table, created with a random key by the first run (bytes)
+    :param id_space: number of possible anonymized ids (int)
+    :param table_format: format of the conversion table: csv, arrow or parquet (str)
+    :param table_compression: compression of the conversion table (str)
+    :param metrics: Metrics collecting timings, counters and reporting progress (Metrics)
+    :param max_in_flight: chunks of images submitted to the workers at once (int)
+    :param shard: (i, N) to anonymize only the i-th of N disjoint sets of patients
+    :param adaptive: adjust the processes and threads in use to the measured throughput
+        (pool backend only)
+    :param backend: execution backend of directory runs, "pool" or "pipeline" (str)
+    :param profile: de-identification profile: "basic" replaces the patient information
+        with the anonymized id, "ps3.15" and "ps3.15-dates" apply the DICOM PS3.15 Basic
+        Application Level Confidentiality Profile with the secret key; or Path of a JSON
+        profile (see rules.load_profile)
+    :param uid_map: Path of the directory where the UIDs remapped by the profile are
+        recorded, to be read with uids.read_uid_map; remapped UIDs depend only on the key,
+        so worker processes never wait for each other
+    :param dedup: anonymize repeated images only once (directory runs): "uid" finds the
+        images of a patient with the same SOPInstanceUID, reading only their first bytes;
+        "content" finds images with the same bytes (see dedup.Deduplicator)
+    :param dedup_policy: output of repeated images, written once the first one is done:
+        "link" hard links it to the output of the first one (copying it across file
+        systems), "copy" copies it, "skip" writes nothing and yields the output of the first
+    :param deflate_level: zlib compression level, from 0 (none) to 9 (best), of the images
+        written with the Deflated Explicit VR Little Endian transfer syntax, compressed by
+        the workers; images with encapsulated (JPEG, RLE, ...) pixel data, and all images
+        if None, keep their transfer syntax
+    :return: iterator of ImageResult, in no particular order
+    """
+    archive_input = is_archive(input_directory)
     if output_directory is None:
-        output_directory = input_directory
-    output_directory.mkdir(parents=True, exist_ok=True)
-
-    if patients is None:
-        patients = read_patients(input_directory)
-    anonymize_id_patients(patients)
-    anonymize_patients(output_directory, patients, parallel, destination_directories)
-    write_conversion_table(output_directory, patients)
-
+        output_directory = input_directory.parent if archive_input else input_directory
+    archive_output = archive_mode(output_directory) is not None
+    if resume and (archive_input or archive_output):
+        # archives are rewritten as a whole and their members have no modification time
+        raise ValueError("Runs reading or writing archives cannot be resumed")
+    if dedup is not None and (archive_input or archive_output):
+        raise ValueError("Runs reading or writing archives cannot be deduplicated")
+    table_directory = output_directory.parent if archive_output else output_directory
+    table_directory.mkdir(parents=True, exist_ok=True)
+    if metrics is None:
+        metrics = Metrics()
+    deduplicator = None
+    if dedup is not None:
+        deduplicator = Deduplicator(dedup, dedup_policy, metrics=metrics)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}: expected one of {', '.join(BACKENDS)}")
+    if deflate_level is not None and not 0 <= deflate_level <= 9:
+        raise ValueError(f"Invalid compression level {deflate_level}: expected 0 to 9")
+    if not parallel:
+        processes = threads = 1
+    table_name = TABLE_NAME
+    if shard is not None:
+        if not 0 <= shard[0] < shard[1]:
+            raise ValueError(f"Invalid shard {shard[0]}/{shard[1]}")
+        table_name = shard_table_name(*shard)
+
+    table_path = conversion_table_path(
+        table_directory, table_format, table_compression, table_name
+    )
+    with ExitStack() as stack:
+        stack.enter_context(metrics)
+        table = None
+        if table_path is None:
+            print(
+                "Cannot find a unique name for the conversion table."
+                + " The conversion table will not be written..."
+            )
+        else:
+            table = stack.enter_context(
+                ConversionTableWriter(table_path, table_format, table_compression)
+            )
+        done = set()
+        images_journal = None
+        if journal is not None:
+            if resume:
+                done = read_journal(journal)
+            images_journal = stack.enter_context(Journal(journal))
+
+        if key is None:
+            key = load_key(table_directory / KEY_NAME)
+        register = PatientRegistry(
+            id_generator(key, id_space),
+            table,
+            metrics,
+            profile=load_profile(profile, key, uid_map),
+            deflate_level=deflate_level,
+        ).register
+
+        def selected(patient: Patient) -> bool:
+            if shard is None:
+                return True
+            return shard_of(patient.patient_data["PatientID"], shard[1]) == shard[0]
+
+        def resolve(dataset: Dataset) -> Optional[Patient]:
+            patient = Patient(patient_data(dataset), [], [])
+            if selected(patient):
+                return register(patient)
+            # the image belongs to another shard
+            metrics.skipped(queued=True)
+            return None
+
+        def pending(tasks: Iterable) -> Iterator:
+            for task in tasks:
+                if done and is_done(done, task.image):
+                    metrics.skipped()
+                else:
+                    yield task
+
+        if archive_input or archive_output:
+            if archive_input:
+                members = stack.enter_context(open_archive_members(input_directory))
+            else:
+                members = iter_directory_members(input_directory)
+            writer = stack.enter_context(open_writer(output_directory))
+            results = iter_anonymize_members(
+                metrics.queued(members),
+                writer,
+                resolve,
+                destination_directories,
+                input_directory,
+                threads,
+                max_in_flight,
+            )
+        else:
+            if patients is None:
+                discovery_index = None
+                if index is not None:
+                    from .index import DiscoveryIndex  # pylint: disable=import-outside-toplevel
+
+                    discovery_index = stack.enter_context(DiscoveryIndex(index))
+                lookup_directories = iter_dicom_directories(
+                    input_directory,
+                    keywords=VALUES_TO_ANONYMIZE,
+                    index=discovery_index,
+                    on_error=metrics.directory_failed,
+                )
+                patients = (
+                    Patient(patient_data(header), [directory], [directory])
+                    for directory, header in map(
+                        read_directory, metrics.timed(lookup_directories, "read_patients")
+                    )
+                )
+            tasks = metrics.queued(
+                pending(
+                    iter_image_tasks(
+                        map(register, filter(selected, patients)),
+                        output_directory,
+                        input_directory,
+                    )
+                )
+            )
+            if deduplicator is not None:
+                tasks = deduplicator.unique(tasks)
+            if backend == "pipeline":
+                # asyncio is imported only by the runs using it
+                from .pipeline import (  # pylint: disable=import-outside-toplevel
+                    iter_pipeline_results,
+                )
 
-def look_into_study_directories(patient_images: List[Path]) -> List[Path]:
+                results = iter_pipeline_results(
+                    tasks, destination_directories, processes, threads, hardlink
+                )
+            else:
+                controller = None
+                if adaptive and parallel:
+                    controller = AdaptiveController(
+                        processes or default_processes(), threads=threads
+                    )
+                results = iter_results(
+                    tasks,
+                    destination_directories,
+                    processes,
+                    threads,
+                    hardlink=hardlink,
+                    max_in_flight=max_in_flight,
+                    controller=controller,
+                )
+            if deduplicator is not None:
+                results = deduplicator.complete(results)
+
+        with metrics.stage("anonymize_patients"):
+            for result in results:
+                metrics.record(result)
+                if images_journal is not None and result.output is not None:
+                    images_journal.add(
+                        result.source,
+                        result.size,
+                        result.mtime_ns,
+                        result.output,
+                        result.anonymized_id,
+                    )
+                yield result
+
+
+class PatientRegistry:
     """
-    Look for dicom images inside "Studies_xx" folder.
+    Give each patient its anonymized id, appending new patients to the conversion table.
 
-    :param patient_images: list of paths of folders containing dicom images
-    :return: list of directories containing dicom images inside selected study folder
+    Patients can be registered by several threads at once; each PatientID is written to
+    the table only once.
     """
-    directories_for_anonymization = []
-    for patient_image in patient_images:
-        patient_data = [patient_data.name for patient_data in patient_image.iterdir()]
-        for d in patient_data:
-            if d.endswith(".dcm"):
-                directories_for_anonymization.append(patient_image)
-                break
-    return directories_for_anonymization
-
 
-def get_directories(path: Path) -> List[Path]:
+    def __init__(
+        self,
+        generate_id: Callable[[str], int],
+        table: Optional[ConversionTableWriter] = None,
+        metrics: Optional[Metrics] = None,
+        known: Optional[Dict[str, str]] = None,
+        profile: Optional[Profile] = None,
+        deflate_level: Optional[int] = None,
+    ) -> None:
+        """
+        Create the registry.
+
+        :param generate_id: function of the PatientID returning the anonymized id
+        :param table: conversion table the new patients are appended to
+        :param metrics: Metrics collecting the duration of the stages
+        :param known: anonymized ids of the PatientIDs already in the table
+        :param profile: de-identification Profile given to each patient
+        :param deflate_level: compression level of the output given to each patient
+        """
+        self._generate_id = generate_id
+        self._table = table
+        self._metrics = Metrics() if metrics is None else metrics
+        self._anonymized_ids: Dict[str, str] = dict(known or {})
+        self._patient_ids = {
+            anonymized_id: patient_id for patient_id, anonymized_id in self._anonymized_ids.items()
+        }
+        self._profile = profile
+        self._deflate_level = deflate_level
+        self._lock = threading.Lock()
+
+    def register(self, patient: Patient) -> Patient:
+        """
+        Set the anonymized id and the output settings of a patient.
+
+        The output settings are the de-identification profile and the compression level.
+
+        :param patient: Patient object
+        :return: the same Patient
+        :raise ValueError: if the patient gets the anonymized id of another patient
+        """
+        patient.profile = self._profile
+        patient.deflate_level = self._deflate_level
+        patient_id = patient.patient_data["PatientID"]
+        with self._lock:
+            if patient_id in self._anonymized_ids:
+                patient.anonymized_id = self._anonymized_ids[patient_id]
+                return patient
+            with self._metrics.stage("anonymize_id_patients"):
+                patient.generate_anonymized_id(self._generate_id(patient_id))
+            other = self._patient_ids.setdefault(patient.anonymized_id, patient_id)
+            if other != patient_id:
+                raise ValueError(f"Patients {patient_id} and {other} share the same anonymized id")
+            self._anonymized_ids[patient_id] = patient.anonymized_id
+            if self._table is not None:
+                with self._metrics.stage("write_conversion_table"):
+                    self._table.write_patient(patient)
+        return patient
+
+
+def get_directories(path: Path, threads: Optional[int] = None) -> List[Path]:
     """
-    Get a list of subdirectories containing dicom images.
+    Get a list of subdirectories containing dicom images, at any depth.
 
     :param path: Path
+    :param threads: number of threads scanning directories
     :return: list of directories containing dicom images
     """
-    studies_or_patients = path.iterdir()
+    return [d.path for d in iter_dicom_directories(path, threads)]
 
-    directories_for_anonymization = []
 
-    for study_or_patient in studies_or_patients:
-        try:
-            patient_images = list(study_or_patient.iterdir())
-            if patient_images[0].name.endswith(".dcm"):
-                directories_for_anonymization.append(study_or_patient)
-            else:
-                directories_for_anonymization.extend(look_into_study_directories(patient_images))
-        except Exception:
-            print("Not a directory")
-
-    return directories_for_anonymization
-
-
-def get_patients(lookup_directories: List[Path]) -> List[Patient]:
+def get_patients(lookup_directories: Iterable[Union[Path, DicomDirectory]]) -> List[Patient]:
     """
     Get list of patients to be anonymized.
 
-    :param lookup_directories: list of directories
+    :param lookup_directories: iterable of directories, or of already scanned DicomDirectory
     :return: list of Patient objects
     """
-    patients = []
-    for image_directory in lookup_directories:
-        files = [image_file.name for image_file in image_directory.iterdir()]
-        images = []
-        for dicom_file in files:
-            # Keep only dicom files
-            if dicom_file.endswith(".dcm"):
-                images.append(dicom_file)
-        dicom_image = dcmread(image_directory / images[0])
-        already_defined = False
-        for patient in patients:
-            if patient.patient_data["PatientID"] == dicom_image.PatientID:
-                already_defined = True
-                patient.source_directories.append(image_directory)
-                patient.destination_directories.append(image_directory)
-                break
-        if not already_defined:
-            temp_dict = {}
-            for value_to_anonymize in VALUES_TO_ANONYMIZE:
-                try:
-                    temp_dict[value_to_anonymize] = dicom_image[value_to_anonymize].value
-                except Exception:
-                    # print(f"{value_to_anonymize} not found")
-                    temp_dict[value_to_anonymize] = None
-            patients.append(
-                Patient(
-                    temp_dict,
-                    [image_directory],
-                    [image_directory],
-                )
+    patients = {}
+    for lookup_directory in lookup_directories:
+        image_directory, dicom_image = read_directory(lookup_directory)
+
+        patient = patients.get(dicom_image.PatientID)
+        if patient is not None:
+            patient.source_directories.append(image_directory)
+            patient.destination_directories.append(image_directory)
+        else:
+            patients[dicom_image.PatientID] = Patient(
+                patient_data(dicom_image),
+                [image_directory],
+                [image_directory],
             )
 
-    return patients
+    return list(patients.values())
 
 
-@jit(void(int32[:], int32), nopython=True)
-def shuffle(array: np.ndarray, num_times: int) -> None:
+def read_directory(lookup_directory: Union[Path, DicomDirectory]) -> Tuple[Path, Dataset]:
     """
-    Shuffle the array.
+    Read the header of the first image of a directory.
 
-    :param array: np.array of int32 to be shuffled
-    :param num_times: int number of times to shuffle the array
-    :return: None
+    :param lookup_directory: directory, or already scanned DicomDirectory
+    :return: Path of the directory and header elements of its first image
     """
-    for _ in range(num_times):
-        x = random.randint(0, len(array) - 1)
-        y = random.randint(0, len(array) - 1)
-        temp = array[x]
-        array[x] = array[y]
-        array[y] = temp
+    if isinstance(lookup_directory, DicomDirectory):
+        dicom_image = lookup_directory.header
+        if dicom_image is None:
+            dicom_image = read_header(
+                lookup_directory.path / lookup_directory.images[0], VALUES_TO_ANONYMIZE
+            )
+        return lookup_directory.path, dicom_image
 
+    # Keep only dicom files
+    first_image = next(
+        image_file for image_file in lookup_directory.iterdir() if image_file.name.endswith(".dcm")
+    )
+    return lookup_directory, read_header(first_image, VALUES_TO_ANONYMIZE)
 
-def generate_ids(seed: int, length: int) -> np.ndarray:
-    """
-    Randomly generate ids.
 
-    :param seed: int
-    :param length: int length of the generated array
-    :return: list of ids
+def patient_data(dicom_image: Dataset) -> dict:
     """
-    ids = np.arange(length, dtype=np.int32)
-
-    # this ensures constant behavior
-    # comment the line if you want "more random" numbers
-    random.seed(seed)
-
-    shuffle(ids, length * 100)
+    Patient information to be anonymized.
 
-    return ids
+    :param dicom_image: header of an image of the patient
+    :return: dictionary with an entry for each of VALUES_TO_ANONYMIZE, None if missing
+    """
+    temp_dict = {}
+    for value_to_anonymize in VALUES_TO_ANONYMIZE:
+        try:
+            temp_dict[value_to_anonymize] = dicom_image[value_to_anonymize].value
+        except Exception:
+            # print(f"{value_to_anonymize} not found")
+            temp_dict[value_to_anonymize] = None
+    return temp_dict
 
 
-def anonymize_id_patients(patients: List[Patient]) -> None:
+def anonymize_id_patients(
+    patients: List[Patient],
+    key: Optional[Union[bytes, str]] = None,
+    id_space: int = DEFAULT_ID_SPACE,
+    metrics: Optional[Metrics] = None,
+) -> None:
     """
     Generate an anonymized id for each patient.
 
+    Anonymized ids depend only on the key and on the PatientID, so they are stable across
+    runs sharing the key; without a key, a random one is used.
+
     :param patients: list of Patient objects
+    :param key: secret key of the pseudonyms, random if None
+    :param id_space: number of possible anonymized ids
+    :param metrics: Metrics collecting the duration of the stage
     :return: None
     """
-    seed = 0
-    # generate enough numbers in order to have a "random" pattern
-    length = max(len(patients * 10), 1000)
-    ids = generate_ids(seed, length)
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage("anonymize_id_patients"):
+        generate_id = id_generator(key, id_space)
+        for patient in patients:
+            patient.generate_anonymized_id(generate_id(patient.patient_data["PatientID"]))
+
+
+def id_generator(
+    key: Optional[Union[bytes, str]] = None, id_space: int = DEFAULT_ID_SPACE
+) -> Callable[[str], int]:
+    """
+    Create a function giving the anonymized id of each patient.
+
+    Ids depend only on the key and on the PatientID, never on the patients seen before.
+    Without a key, a random one is used: ids are then different in every run.
 
-    for i, patient in enumerate(patients):
-        patient.generate_anonymized_id(ids[i])
+    :param key: secret key of the pseudonyms, random if None
+    :param id_space: number of possible anonymized ids
+    :return: function of the PatientID returning the anonymized id
+    :raise ValueError: if two patients get the same anonymized id
+    """
+    if key is None:
+        key = secrets.token_bytes(32)
+    pseudonymizer = Pseudonymizer(key, id_space)
+    patient_ids: Dict[int, str] = {}
+    lock = threading.Lock()
+
+    def generate_id(patient_id: str) -> int:
+        anonymized_id = pseudonymizer(patient_id)
+        with lock:
+            if patient_ids.setdefault(anonymized_id, patient_id) != patient_id:
+                # numeric ids are permuted, the others are hashed into the id space
+                raise ValueError(
+                    f"Patients {patient_id} and {patient_ids[anonymized_id]}"
+                    + " share the same anonymized id"
+                )
+        return anonymized_id
+
+    return generate_id
 
 
 def anonymize_patient(
@@ -195,85 +616,151 @@ def anonymize_patient(
 
 
 def anonymize_patients(
-    output_dir: Path, patients: List[Patient], parallel: bool, destination_dir: bool = False
+    output_dir: Path,
+    patients: List[Patient],
+    parallel: bool,
+    destination_dir: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+    journal: Optional[Path] = None,
+    resume: bool = False,
+    on_patient_done: Optional[Callable[[Patient], None]] = None,
+    metrics: Optional[Metrics] = None,
 ) -> None:
     """
-    Generate an anonymized id for each patient.
+    Anonymize the images of all patients.
+
+    Every image of every patient is scheduled as a single task on a bounded pool
+    of processes, each one running a bounded pool of threads.
 
     :param output_dir: Path of the output directory
     :param patients: list of Patient objects
     :param parallel: use CPU multithreading
     :param destination_dir: anonymize only the destination directory (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param threads: number of threads per worker process
+    :param hardlink: with destination_dir, hard link images instead of copying them (bool)
+    :param journal: Path of the journal of anonymized images
+    :param resume: skip images already in the journal
+    :param on_patient_done: function called with each patient whose images are all done
+    :param metrics: Metrics collecting timings and counters
     :return: None
     """
-    if parallel:
-        num_threads = max(len(patients), 1)
-        # Somehow multiprocessing.pool.ThreadPool is faster with just a few threads
-        # and multiprocessing.pool.Pool is significantly faster with many threads
-        if num_threads >= 8:
-            # multiprocessing.pool.Pool crashes with too many threads
-            with Pool(min(num_threads, cpu_count())) as p:
-                p.map(partial(anonymize_patient, output_dir, parallel, destination_dir), patients)
-        else:
-            with ThreadPool(num_threads) as p:
-                p.map(partial(anonymize_patient, output_dir, parallel, destination_dir), patients)
-    else:
-        for patient in patients:
-            anonymize_patient(output_dir, parallel, destination_dir, patient)
+    if not parallel:
+        processes = threads = 1
+    if metrics is None:
+        metrics = Metrics()
+
+    skip = None
+    if resume and journal is not None:
+        done = read_journal(journal)
+
+        def skip_done(image: Path) -> bool:
+            if is_done(done, image):
+                metrics.skipped()
+                return True
+            return False
+
+        skip = skip_done
+
+    tracker = PatientTracker()
+    tasks = metrics.queued(tracker.track(patients, output_dir, skip))
+
+    with ExitStack() as stack:
+        stack.enter_context(metrics.stage("anonymize_patients"))
+        images_journal = None
+        if journal is not None:
+            images_journal = stack.enter_context(Journal(journal))
+
+        for result in iter_results(tasks, destination_dir, processes, threads, hardlink=hardlink):
+            metrics.record(result)
+            if images_journal is not None and result.output is not None:
+                images_journal.add(
+                    result.source,
+                    result.size,
+                    result.mtime_ns,
+                    result.output,
+                    result.anonymized_id,
+                )
+            if on_patient_done is not None:
+                for patient in tracker.finished(result):
+                    on_patient_done(patient)
 
+    if on_patient_done is not None:
+        for patient in tracker.finished():
+            on_patient_done(patient)
 
-def read_patients(input_dir: Path) -> List[Patient]:
+
+def read_patients(
+    input_dir: Path,
+    threads: Optional[int] = None,
+    index: Optional[Path] = None,
+    metrics: Optional[Metrics] = None,
+) -> List[Patient]:
     """
     Read patients information.
 
-    :param input_dir: Path of the input directory
+    Directories are scanned concurrently and their first image is probed while the
+    directory tree is still being walked. With an index, only directories changed since
+    the previous run are probed. ZIP and TAR archives are read without being extracted.
+
+    :param input_dir: Path of the input directory or archive
+    :param threads: number of threads scanning directories
+    :param index: Path of the discovery index file
+    :param metrics: Metrics collecting the duration of the stage
     :return: list of patients
     """
-    lookup_directories = get_directories(input_dir)
+    if metrics is None:
+        metrics = Metrics()
+    with ExitStack() as stack:
+        stack.enter_context(metrics.stage("read_patients"))
+        if is_archive(input_dir):
+            lookup_directories = iter_archive_directories(
+                input_dir, VALUES_TO_ANONYMIZE, on_error=metrics.directory_failed
+            )
+        else:
+            discovery_index = None
+            if index is not None:
+                from .index import DiscoveryIndex  # pylint: disable=import-outside-toplevel
 
-    patients = get_patients(lookup_directories)
+                discovery_index = stack.enter_context(DiscoveryIndex(index))
+            lookup_directories = iter_dicom_directories(
+                input_dir, threads, VALUES_TO_ANONYMIZE, discovery_index, metrics.directory_failed
+            )
+        patients = get_patients(lookup_directories)
 
     return patients
 
 
-def write_conversion_table(output_directory: Path, patients: List[Patient]) -> None:
+def write_conversion_table(
+    output_directory: Path,
+    patients: List[Patient],
+    table_format: str = "csv",
+    compression: Optional[str] = None,
+    metrics: Optional[Metrics] = None,
+) -> None:
     """
-    Write all patient information to a csv file, in order to be able to de-anonymize data.
+    Write all patient information to a table, in order to be able to de-anonymize data.
 
     :param output_directory: Path of the output directory
     :param patients: list of Patient objects
+    :param table_format: csv, arrow or parquet
+    :param compression: compression of the table
+    :param metrics: Metrics collecting the duration of the stage
     :return: None
     """
-    df = pd.DataFrame()
-
-    position = 0
-    df.insert(position, "anonymized_id", "")
-    for i, p in enumerate(patients):
-        df.at[i, "anonymized_id"] = p.anonymized_id
-    position += 1
-
-    # df.insert(position, "destination_directories", "")
-    # for i, p in enumerate(patients):
-    #    df.at[i, "destination_directories"] = p.destination_directories
-    # position += 1
-
-    for val in VALUES_TO_ANONYMIZE:
-        df.insert(position, val, "")
-        for i, p in enumerate(patients):
-            df.at[i, val] = str(p.patient_data[val])
-        position += 1
-
-    csv_name = "Anonymization.csv"
-
-    files_list = [file_in_directory.name for file_in_directory in output_directory.iterdir()]
-
-    if csv_name in files_list:
-        csv_name = f'Anonymization-{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.csv'
-        if csv_name in [file_in_directory.name for file_in_directory in output_directory.iterdir()]:
-            print(
-                "Cannot find a unique name for the conversion table."
-                + " Aborting write_conversion_table..."
-            )
-            return
-
-    df.to_csv(output_directory / csv_name, index=False)
+    if metrics is None:
+        metrics = Metrics()
+    table_path = conversion_table_path(output_directory, table_format, compression)
+    if table_path is None:
+        print(
+            "Cannot find a unique name for the conversion table."
+            + " Aborting write_conversion_table..."
+        )
+        return
+
+    with metrics.stage("write_conversion_table"):
+        with ConversionTableWriter(table_path, table_format, compression) as table:
+            for patient in patients:
+                table.write_patient(patient)
@@ -0,0 +1,128 @@
+"""Persistent index of the headers probed during discovery."""
+
+from typing import Optional
+import json
+import os
+import sqlite3
+import threading
+
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+
+from pathlib import Path
+
+
+# number of new entries written to the index before committing them
+COMMIT_INTERVAL = 1000
+
+
+def header_to_json(header: Dataset) -> str:
+    """
+    Serialize the elements of a probed header.
+
+    :param header: pydicom dataset
+    :return: json string
+    """
+    values = {}
+    for element in header:
+        if not element.keyword or element.value is None:
+            continue
+        if isinstance(element.value, MultiValue):
+            values[element.keyword] = [str(value) for value in element.value]
+        else:
+            values[element.keyword] = str(element.value)
+    return json.dumps(values)
+
+
+def header_from_json(text: str) -> Dataset:
+    """
+    Deserialize the elements of a probed header.
+
+    :param text: json string
+    :return: pydicom dataset
+    """
+    header = Dataset()
+    for keyword, value in json.loads(text).items():
+        setattr(header, keyword, value)
+    return header
+
+
+class DiscoveryIndex:
+    """
+    SQLite index of directories already probed by previous runs.
+
+    Each directory is keyed by its path, modification time and inode: the header of its
+    first image is read again only if the directory has changed since it was indexed.
+    The index can be shared by the threads of the crawler.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """
+        Open the index, creating it if needed.
+
+        :param path: Path of the index file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, inode INTEGER, header TEXT)"
+        )
+        self._connection.commit()
+
+    def get(self, directory: Path, stat: os.stat_result) -> Optional[Dataset]:
+        """
+        Get the header indexed for a directory.
+
+        :param directory: Path of the directory
+        :param stat: current stat of the directory
+        :return: pydicom dataset, None if the directory is not indexed or has changed
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT header FROM directories WHERE path = ? AND mtime_ns = ? AND inode = ?",
+                (str(directory), stat.st_mtime_ns, stat.st_ino),
+            ).fetchone()
+        if row is None:
+            return None
+        return header_from_json(row[0])
+
+    def put(self, directory: Path, stat: os.stat_result, header: Dataset) -> None:
+        """
+        Index the header of a directory.
+
+        :param directory: Path of the directory
+        :param stat: stat of the directory taken before reading the header
+        :param header: pydicom dataset
+        :return: None
+        """
+        text = header_to_json(header)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                (str(directory), stat.st_mtime_ns, stat.st_ino, text),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._connection.commit()
+                self._pending = 0
+
+    def close(self) -> None:
+        """
+        Commit pending entries and close the index.
+
+        :return: None
+        """
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __enter__(self) -> "DiscoveryIndex":
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the index when leaving the context."""
+        self.close()
@@ -0,0 +1,312 @@
+"""Anonymization of dicom images held in memory or read from streams."""
+
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Mapping, Optional, Union
+from io import BytesIO, RawIOBase
+from itertools import chain
+import os
+
+from pydicom.dataset import Dataset
+
+from .classes import anonymize_dataset
+from .rules import Profile
+from .fileio import (
+    DEFLATE_BLOCK_SIZE,
+    can_deflate,
+    iter_range,
+    modify_image,
+    parse_header,
+    write_deflated,
+)
+
+
+# bytes read at once from non-seekable streams
+STREAM_BLOCK_SIZE = 65536
+
+# anonymized id of every image, PatientID -> anonymized id, or function of the PatientID
+Pseudonyms = Union[str, Mapping[str, Any], Callable[[str], Any]]
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class BufferReader(RawIOBase):
+    """
+    Read-only binary file over a buffer, without copying it.
+
+    Only the bytes actually read are copied, so parsing the header of a large image
+    does not duplicate its pixel data.
+    """
+
+    def __init__(self, buffer: Buffer) -> None:
+        """
+        Open the buffer.
+
+        :param buffer: bytes-like object
+        """
+        super().__init__()
+        self.view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        """Tell that the buffer can be read."""
+        return True
+
+    def seekable(self) -> bool:
+        """Tell that the buffer supports random access."""
+        return True
+
+    def readinto(self, b) -> int:
+        """
+        Read bytes into a pre-allocated buffer.
+
+        :param b: writable bytes-like object
+        :return: number of bytes read
+        """
+        count = max(min(len(b), len(self.view) - self._position), 0)
+        b[:count] = self.view[self._position : self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """
+        Change the position.
+
+        :param offset: offset relative to whence
+        :param whence: os.SEEK_SET, os.SEEK_CUR or os.SEEK_END
+        :return: new absolute position
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        """
+        Get the current position.
+
+        :return: absolute position
+        """
+        return self._position
+
+
+class StreamPrefixReader(RawIOBase):
+    """
+    Seekable binary file over a non-seekable stream, such as a pipe or a socket.
+
+    The bytes read from the stream are kept, so that the header can be parsed with the
+    seeks pydicom needs; the rest of the stream, such as the pixel data, is left unread
+    in stream and can be copied in blocks afterwards.
+    """
+
+    def __init__(self, stream: BinaryIO) -> None:
+        """
+        Wrap the stream.
+
+        :param stream: readable binary file, positioned at the start of the image
+        """
+        super().__init__()
+        self.stream = stream
+        self.buffer = bytearray()
+        self._position = 0
+
+    def readable(self) -> bool:
+        """Tell that the stream can be read."""
+        return True
+
+    def seekable(self) -> bool:
+        """Tell that the bytes already read support random access."""
+        return True
+
+    def _fill(self, size: Optional[int]) -> None:
+        """
+        Read from the stream until the buffer holds size bytes, or the stream ends.
+
+        :param size: number of bytes, None to read the whole stream
+        :return: None
+        """
+        while size is None or len(self.buffer) < size:
+            needed = STREAM_BLOCK_SIZE if size is None else size - len(self.buffer)
+            chunk = self.stream.read(max(needed, STREAM_BLOCK_SIZE))
+            if not chunk:
+                return
+            self.buffer += chunk
+
+    def readinto(self, b) -> int:
+        """
+        Read bytes into a pre-allocated buffer.
+
+        :param b: writable bytes-like object
+        :return: number of bytes read
+        """
+        self._fill(self._position + len(b))
+        count = max(min(len(b), len(self.buffer) - self._position), 0)
+        b[:count] = self.buffer[self._position : self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """
+        Change the position, reading the whole stream to seek from its end.
+
+        :param offset: offset relative to whence
+        :param whence: os.SEEK_SET, os.SEEK_CUR or os.SEEK_END
+        :return: new absolute position
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            self._fill(None)
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        """
+        Get the current position.
+
+        :return: absolute position
+        """
+        return self._position
+
+
+def _is_seekable(source: BinaryIO) -> bool:
+    """
+    Check whether a binary file supports seeking.
+
+    :param source: binary file
+    :return: True if source can seek
+    """
+    try:
+        return source.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def anonymized_id_of(dataset: Dataset, pseudonyms: Pseudonyms) -> str:
+    """
+    Anonymized id of the patient of an image.
+
+    :param dataset: header of the image
+    :param pseudonyms: anonymized id, mapping from PatientID, or function of the PatientID
+    :return: anonymized id
+    """
+    if isinstance(pseudonyms, str):
+        return pseudonyms
+    patient_id = str(dataset.get("PatientID", ""))
+    if isinstance(pseudonyms, Mapping):
+        return str(pseudonyms[patient_id])
+    return str(pseudonyms(patient_id))
+
+
+def anonymize_stream(
+    source: Union[Buffer, BinaryIO], destination: BinaryIO, pseudonyms: Pseudonyms
+) -> str:
+    """
+    Anonymize a dicom image, writing it to a stream.
+
+    Only the header is parsed and rewritten: pixel data is never decoded, and is written
+    straight from the source buffer, or copied in blocks from the source stream.
+
+    Non-seekable streams, such as pipes and sockets, are supported: only the bytes of the
+    header are kept in memory.
+
+    :param source: bytes-like object, or binary file positioned at the start of the image
+    :param destination: writable binary file
+    :param pseudonyms: anonymized id, mapping from PatientID, or function of the PatientID
+    :return: anonymized id of the image
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BufferReader(source)
+    elif not _is_seekable(source):
+        source = StreamPrefixReader(source)
+    dataset, offset = parse_header(source)
+    anonymized_id = anonymized_id_of(dataset, pseudonyms)
+    write_anonymized(source, dataset, offset, destination, anonymized_id)
+    return anonymized_id
+
+
+def write_anonymized(
+    source: BinaryIO,
+    dataset: Dataset,
+    offset: Optional[int],
+    destination: BinaryIO,
+    anonymized_id: str,
+    profile: Optional[Profile] = None,
+    deflate_level: Optional[int] = None,
+) -> None:
+    """
+    Anonymize a header returned by parse_header and write the image to a stream.
+
+    :param source: binary file the header has been parsed from (a BufferReader or a
+        StreamPrefixReader for buffers and non-seekable streams)
+    :param dataset: header of the image
+    :param offset: offset of the pixel data in source, None if the dataset is complete
+    :param destination: writable binary file
+    :param anonymized_id: anonymized id of the patient
+    :param profile: de-identification Profile, the basic one if None
+    :param deflate_level: zlib compression level of the image, written with the Deflated
+        Explicit VR Little Endian transfer syntax unless its pixel data is encapsulated;
+        None to keep its transfer syntax
+    :return: None
+    """
+    end, trailing = modify_image(
+        source,
+        dataset,
+        offset,
+        lambda header: anonymize_dataset(header, anonymized_id, profile),
+        profile is not None and profile.needs_trailer,
+    )
+    if deflate_level is not None and can_deflate(dataset):
+        tail: Iterable[bytes] = []
+        if offset is not None:
+            tail = chain(_iter_tail(source, offset, end), [trailing])
+        write_deflated(destination, dataset, tail, deflate_level)
+        return
+    dataset.save_as(destination)
+    if offset is None:
+        return
+    for block in _iter_tail(source, offset, end):
+        destination.write(block)
+    destination.write(trailing)
+
+
+def _iter_tail(source: BinaryIO, offset: int, end: Optional[int]) -> Iterator[bytes]:
+    """
+    Read the pixel data of the source, in blocks.
+
+    :param source: binary file the header has been parsed from
+    :param offset: offset of the pixel data in source
+    :param end: end of the pixel data in source, None to read up to the end of the source
+    :return: iterator of bytes-like objects
+    """
+    if isinstance(source, BufferReader):
+        view = source.view[offset:end]
+        for start in range(0, len(view), DEFLATE_BLOCK_SIZE):
+            yield view[start : start + DEFLATE_BLOCK_SIZE]
+        return
+    if isinstance(source, StreamPrefixReader):
+        yield memoryview(source.buffer)[offset:end]
+        if end is not None:
+            # the elements following the pixel data have been read: the stream is over
+            return
+        source = source.stream
+        yield from iter(lambda: source.read(DEFLATE_BLOCK_SIZE), b"")
+        return
+    yield from iter_range(source, offset, end)
+
+
+def anonymize_bytes(data: Union[Buffer, BinaryIO], pseudonyms: Pseudonyms) -> bytes:
+    """
+    Anonymize a dicom image held in memory.
+
+    :param data: bytes-like object, or binary file positioned at the start of the image
+    :param pseudonyms: anonymized id, mapping from PatientID, or function of the PatientID
+    :return: anonymized image
+    """
+    destination = BytesIO()
+    anonymize_stream(data, destination, pseudonyms)
+    return destination.getvalue()
@@ -0,0 +1,140 @@
+"""Journal of the images already anonymized, used to resume interrupted runs."""
+
+from typing import Dict, Tuple
+import csv
+import os
+import time
+
+from pathlib import Path
+
+
+# number of images kept in memory before writing them to the journal
+BATCH_SIZE = 1000
+# maximum number of seconds between two writes to the journal
+BATCH_INTERVAL = 5.0
+
+
+def read_journal(path: Path) -> Dict[Tuple[str, int, int], str]:
+    """
+    Read the images already anonymized.
+
+    Malformed lines, such as the last one of an interrupted run, are ignored.
+
+    :param path: Path of the journal
+    :return: dictionary from (source path, size, modification time) of the anonymized
+        images to the path of their output
+    """
+    done = {}
+    if not path.exists():
+        return done
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            try:
+                source, size, mtime_ns, output, _ = row
+                done[(source, int(size), int(mtime_ns))] = output
+            except ValueError:
+                pass
+    return done
+
+
+def is_done(done: Dict[Tuple[str, int, int], str], image: Path) -> bool:
+    """
+    Check whether an image is in the journal, has not changed since and its output exists.
+
+    Outputs are written atomically: an existing output is complete.
+
+    :param done: dictionary returned by read_journal
+    :param image: Path of the source image
+    :return: True if the image has already been anonymized
+    """
+    try:
+        stat = os.stat(image)
+    except OSError:
+        return False
+    output = done.get((str(image), stat.st_size, stat.st_mtime_ns))
+    return output is not None and os.path.exists(output)
+
+
+def _ends_with_newline(path: Path) -> bool:
+    """
+    Check whether the last byte of a file is a newline.
+
+    :param path: Path of the file
+    :return: True if the file ends with a newline
+    """
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class Journal:
+    """
+    Append-only journal of anonymized images.
+
+    Entries are buffered and written in batches, so that the journal does not slow down
+    the anonymization; every batch is flushed to disk before the next one is collected.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """
+        Open the journal for appending.
+
+        :param path: Path of the journal
+        """
+        self.path = path
+        self._file = open(path, "a", newline="")  # pylint: disable=consider-using-with
+        if self._file.tell() > 0 and not _ends_with_newline(path):
+            # the previous run was interrupted in the middle of a line
+            self._file.write("\n")
+        self._writer = csv.writer(self._file)
+        self._rows = []
+        self._last_write = time.monotonic()
+
+    def add(
+        self, source: Path, size: int, mtime_ns: int, output: Path, anonymized_id: str
+    ) -> None:
+        """
+        Add an anonymized image to the journal.
+
+        :param source: Path of the source image
+        :param size: size of the source image
+        :param mtime_ns: modification time of the source image
+        :param output: Path of the anonymized image
+        :param anonymized_id: anonymized id of the patient
+        :return: None
+        """
+        self._rows.append((str(source), size, mtime_ns, str(output), anonymized_id))
+        if (
+            len(self._rows) >= BATCH_SIZE
+            or time.monotonic() - self._last_write >= BATCH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write buffered entries to disk.
+
+        :return: None
+        """
+        self._writer.writerows(self._rows)
+        self._rows = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_write = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Write buffered entries and close the journal.
+
+        :return: None
+        """
+        self.flush()
+        self._file.close()
+
+    def __enter__(self) -> "Journal":
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the journal when leaving the context."""
+        self.close()
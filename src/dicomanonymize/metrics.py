@@ -0,0 +1,422 @@
+"""Instrumentation of anonymization runs: timings, counters, progress and metrics export."""
+
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from .fileio import atomic_output
+
+from pathlib import Path
+
+
+# seconds between two calls of the progress callback
+PROGRESS_INTERVAL = 1.0
+# prefix of the Prometheus metrics
+METRICS_PREFIX = "dicomanonymize"
+
+
+class Metrics:
+    """
+    Thread-safe collector of the metrics of an anonymization run.
+
+    Stages record their duration, image results update file, byte (read and written) and
+    failure counters, and the number of images queued but not yet done gives the depth of
+    the worker queue; results also report the images left in the queue of the worker
+    process that ran them.
+
+    Stage times are exclusive: the time spent in a stage running inside another one, in
+    the same thread, is not counted in the outer stage, so that lazily evaluated stages
+    (such as the crawler, pulled by the anonymization loop) are not counted twice. The
+    elapsed time of the snapshots is the wall-clock time of the run.
+
+    Used as a context manager, a background thread calls the progress callback every
+    interval seconds, even when no image completes, so that stalls are visible.
+    """
+
+    def __init__(
+        self,
+        progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        interval: float = PROGRESS_INTERVAL,
+    ) -> None:
+        """
+        Create an empty collector.
+
+        :param progress: function called with a snapshot of the metrics
+        :param interval: seconds between two calls of progress
+        """
+        self.progress = progress
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_result = self._start
+        self._stages: Dict[str, float] = {}
+        self._files = {"queued": 0, "done": 0, "failed": 0, "skipped": 0}
+        self._bytes = 0
+        self._bytes_written = 0
+        self._failures: Dict[str, int] = {}
+        self._directories_failed = 0
+        self._workers: Dict[str, int] = {}
+        self._worker_queue_depth: Dict[str, int] = {}
+        self._max_worker_queue_depth: Dict[str, int] = {}
+        self._max_queue_depth = 0
+        self._duplicates = 0
+        self._bytes_saved = 0
+        self._stop = threading.Event()
+        self._reporter = None
+        # time spent in nested stages, for each stage running in the current thread
+        self._local = threading.local()
+
+    def _nested(self) -> List[float]:
+        """
+        Time spent in nested stages, for each stage running in the current thread.
+
+        :return: stack of durations, the innermost stage last
+        """
+        if not hasattr(self._local, "nested"):
+            self._local.nested = []
+        return self._local.nested
+
+    @contextmanager
+    def _exclusive(self, name: str) -> Iterator[None]:
+        """
+        Time a stage, excluding the time of the stages nested in it.
+
+        :param name: name of the stage
+        :return: context manager
+        """
+        nested = self._nested()
+        nested.append(0.0)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.add_time(name, elapsed - nested.pop())
+            if nested:
+                nested[-1] += elapsed
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """
+        Time a stage; the durations of stages run more than once are summed.
+
+        :param name: name of the stage
+        :return: context manager
+        """
+        return self._exclusive(name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """
+        Add time spent in a stage.
+
+        :param name: name of the stage
+        :param seconds: duration
+        :return: None
+        """
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def timed(self, iterable: Iterable, name: str) -> Iterator:
+        """
+        Add the time spent producing each element of an iterable to a stage.
+
+        :param iterable: iterable, such as a generator doing the work of the stage
+        :param name: name of the stage
+        :return: iterator of the same elements
+        """
+        iterator = iter(iterable)
+        while True:
+            with self._exclusive(name):
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+            yield element
+
+    def queued(self, tasks: Iterable) -> Iterator:
+        """
+        Count the tasks sent to the workers.
+
+        :param tasks: iterable of tasks
+        :return: iterator of the same tasks
+        """
+        for task in tasks:
+            self.add_queued()
+            yield task
+
+    def add_queued(self, count: int = 1) -> None:
+        """
+        Count tasks sent to the workers, when they are not taken from an iterable.
+
+        :param count: number of tasks
+        :return: None
+        """
+        with self._lock:
+            self._files["queued"] += count
+            depth = self._files["queued"] - self._files["done"] - self._files["failed"]
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+
+    def skipped(self, count: int = 1, queued: bool = False) -> None:
+        """
+        Count images skipped, because already anonymized or belonging to another shard.
+
+        :param count: number of skipped images
+        :param queued: the images had already been counted as queued
+        :return: None
+        """
+        with self._lock:
+            self._files["skipped"] += count
+            if queued:
+                self._files["queued"] -= count
+
+    def deduplicated(self, size: int) -> None:
+        """
+        Count an image written from the output of an identical image, without being read.
+
+        :param size: size of the image, saved from being read and anonymized
+        :return: None
+        """
+        with self._lock:
+            self._duplicates += 1
+            self._bytes_saved += size
+
+    def directory_failed(self, directory: Path, error: Exception) -> None:
+        """
+        Count a directory skipped by the crawler, because it or its images cannot be read.
+
+        :param directory: Path of the directory
+        :param error: exception raised
+        :return: None
+        """
+        with self._lock:
+            self._directories_failed += 1
+            cause = type(error).__name__
+            self._failures[cause] = self._failures.get(cause, 0) + 1
+
+    def record(self, result: Any) -> None:
+        """
+        Count the result of an image.
+
+        :param result: ImageResult
+        :return: None
+        """
+        with self._lock:
+            self._last_result = time.monotonic()
+            if result.output is None:
+                self._files["failed"] += 1
+                cause = result.error or "unknown"
+                self._failures[cause] = self._failures.get(cause, 0) + 1
+            else:
+                self._files["done"] += 1
+                self._bytes += result.size
+                self._bytes_written += result.written
+            if result.worker:
+                worker = result.worker
+                self._workers[worker] = self._workers.get(worker, 0) + 1
+                depth = result.queue_depth
+                self._worker_queue_depth[worker] = depth
+                self._max_worker_queue_depth[worker] = max(
+                    self._max_worker_queue_depth.get(worker, 0), depth
+                )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the current value of every metric.
+
+        :return: JSON serializable dictionary
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._start
+            files = dict(self._files)
+            return {
+                "elapsed": elapsed,
+                "stages": dict(self._stages),
+                "files": files,
+                "bytes": self._bytes,
+                "bytes_written": self._bytes_written,
+                "failures": dict(self._failures),
+                "directories_failed": self._directories_failed,
+                "queue_depth": files["queued"] - files["done"] - files["failed"],
+                "max_queue_depth": self._max_queue_depth,
+                "workers": dict(self._workers),
+                "worker_queue_depth": dict(self._worker_queue_depth),
+                "max_worker_queue_depth": dict(self._max_worker_queue_depth),
+                "duplicates": self._duplicates,
+                "bytes_saved": self._bytes_saved,
+                "files_per_second": files["done"] / elapsed if elapsed > 0 else 0.0,
+                "megabytes_per_second": self._bytes / 1e6 / elapsed if elapsed > 0 else 0.0,
+                "seconds_since_last_result": now - self._last_result,
+            }
+
+    def report(self) -> None:
+        """
+        Call the progress callback with a snapshot of the metrics.
+
+        :return: None
+        """
+        if self.progress is not None:
+            self.progress(self.snapshot())
+
+    def _report_periodically(self) -> None:
+        """
+        Call the progress callback every interval seconds until the run is over.
+
+        :return: None
+        """
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def __enter__(self) -> "Metrics":
+        """Start reporting progress."""
+        if self.progress is not None and self._reporter is None:
+            self._stop.clear()
+            self._reporter = threading.Thread(target=self._report_periodically, daemon=True)
+            self._reporter.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Stop reporting progress, reporting the final state."""
+        if self._reporter is not None:
+            self._stop.set()
+            self._reporter.join()
+            self._reporter = None
+        self.report()
+
+    def to_prometheus(self) -> str:
+        """
+        Metrics in the Prometheus text exposition format.
+
+        :return: str to be read by the node exporter textfile collector
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: Dict[str, float]) -> None:
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+            for labels, value in samples.items():
+                lines.append(f"{METRICS_PREFIX}_{name}{labels} {value}")
+
+        metric("elapsed_seconds", "gauge", "Duration of the run.", {"": snapshot["elapsed"]})
+        metric(
+            "stage_seconds",
+            "gauge",
+            "Time spent in each stage.",
+            {f'{{stage="{name}"}}': value for name, value in snapshot["stages"].items()},
+        )
+        metric(
+            "files_total",
+            "counter",
+            "Images by status.",
+            {f'{{status="{name}"}}': value for name, value in snapshot["files"].items()},
+        )
+        metric("bytes_total", "counter", "Bytes of anonymized images.", {"": snapshot["bytes"]})
+        metric(
+            "bytes_written_total",
+            "counter",
+            "Bytes of the images written.",
+            {"": snapshot["bytes_written"]},
+        )
+        metric(
+            "failures_total",
+            "counter",
+            "Images that could not be anonymized, and directories that could not be read,"
+            + " by cause.",
+            {f'{{cause="{name}"}}': value for name, value in snapshot["failures"].items()},
+        )
+        metric(
+            "directories_failed_total",
+            "counter",
+            "Directories skipped because they, or all their images, could not be read.",
+            {"": snapshot["directories_failed"]},
+        )
+        metric("queue_depth", "gauge", "Images queued but not done.", {"": snapshot["queue_depth"]})
+        metric(
+            "max_queue_depth", "gauge", "Largest queue depth.", {"": snapshot["max_queue_depth"]}
+        )
+        metric(
+            "worker_files_total",
+            "counter",
+            "Images completed by each worker process.",
+            {f'{{worker="{name}"}}': value for name, value in snapshot["workers"].items()},
+        )
+        metric(
+            "worker_queue_depth",
+            "gauge",
+            "Images received by each worker process and not done, at its last result.",
+            {
+                f'{{worker="{name}"}}': value
+                for name, value in snapshot["worker_queue_depth"].items()
+            },
+        )
+        metric(
+            "max_worker_queue_depth",
+            "gauge",
+            "Largest queue depth of each worker process.",
+            {
+                f'{{worker="{name}"}}': value
+                for name, value in snapshot["max_worker_queue_depth"].items()
+            },
+        )
+        metric(
+            "duplicates_total",
+            "counter",
+            "Images written from the output of an identical image.",
+            {"": snapshot["duplicates"]},
+        )
+        metric(
+            "bytes_saved_total",
+            "counter",
+            "Bytes of duplicate images not read and anonymized.",
+            {"": snapshot["bytes_saved"]},
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        """
+        Dump the metrics: Prometheus text format for .prom files, JSON otherwise.
+
+        The file is replaced atomically, as required by the textfile collector.
+
+        :param path: Path of the metrics file
+        :return: None
+        """
+        if path.suffix == ".prom":
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2) + "\n"
+        with atomic_output(path) as f:
+            f.write(content.encode())
+
+
+def format_progress(snapshot: Dict[str, Any]) -> str:
+    """
+    Single line summary of a metrics snapshot.
+
+    :param snapshot: dictionary returned by Metrics.snapshot
+    :return: str
+    """
+    files = snapshot["files"]
+    line = (
+        f"{files['done']} images done, {files['failed']} failed, {files['skipped']} skipped"
+        + f" | {snapshot['files_per_second']:.1f} images/s"
+        + f" {snapshot['megabytes_per_second']:.1f} MB/s"
+        + f" | {snapshot['bytes_written'] / 1e6:.1f} MB written of"
+        + f" {snapshot['bytes'] / 1e6:.1f} MB read"
+        + f" | queue {snapshot['queue_depth']}"
+        + f" | {snapshot['elapsed']:.0f}s"
+    )
+    if snapshot["duplicates"]:
+        line += (
+            f" | {snapshot['duplicates']} duplicates,"
+            + f" {snapshot['bytes_saved'] / 1e6:.1f} MB saved"
+        )
+    if snapshot["directories_failed"]:
+        line += f" | {snapshot['directories_failed']} directories unreadable"
+    if files["queued"] > files["done"] + files["failed"] and snapshot[
+        "seconds_since_last_result"
+    ] >= 10:
+        line += f" | stalled for {snapshot['seconds_since_last_result']:.0f}s"
+    return line
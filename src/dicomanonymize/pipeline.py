@@ -0,0 +1,540 @@
+"""Pipelined anonymization: asynchronous reads, CPU bound rewriting and batched writes."""
+
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+import asyncio
+import os
+import queue
+import threading
+
+from .classes import anonymize_dataset
+from .rules import Profile
+from .fileio import PROBE_SIZE, atomic_output, copy_file, copy_range, parse_header
+from .inmemory import BufferReader
+from .scheduler import DEFAULT_THREADS, ImageResult, ImageTask, default_processes, run_task
+
+
+# images waiting between two stages
+QUEUE_SIZE = 64
+# bytes of headers held by the pipeline at once: pixel data never enters it
+MAX_BUFFERED_BYTES = 64 << 20
+# images written by a single writer call
+WRITE_BATCH = 16
+# seconds between two checks of the cancellation of the run by a blocked stage
+POLL_INTERVAL = 0.1
+
+
+class TruncatedHeader(Exception):
+    """The bytes read do not contain the whole header of the image."""
+
+
+class _Image(NamedTuple):
+    """
+    Image moving through the pipeline.
+
+    task: ImageTask of the image (ImageTask)
+    stat: os.stat_result of the source image, None if it could not be read
+    prefix: first bytes of the source image, empty with only_directory (bytes)
+    header: anonymized header, to be followed by the source bytes from offset (bytes)
+    offset: offset of the pixel data in the source, None if header is the whole image (int)
+    reserved: bytes of the _ByteBudget held by the image (int)
+    result: ImageResult of an image rewritten whole by the CPU stage (ImageResult).
+    """
+
+    task: ImageTask
+    stat: Optional[os.stat_result]
+    prefix: bytes = b""
+    header: bytes = b""
+    offset: Optional[int] = None
+    reserved: int = 0
+    result: Optional[ImageResult] = None
+
+
+def rewrite_header(
+    prefix: bytes, size: int, anonymized_id: str, profile: Optional[Profile] = None
+) -> Tuple[bytes, Optional[int]]:
+    """
+    Anonymize the header of an image from its first bytes.
+
+    Only the header is sent to, and returned from, worker processes: pixel data is
+    copied by the writers straight from the source file.
+
+    :param prefix: first bytes of the image
+    :param size: size of the image
+    :param anonymized_id: anonymized id of the patient
+    :param profile: de-identification Profile, the basic one if None
+    :return: anonymized header and offset of the pixel data in the image, None if the
+        header is the whole anonymized image
+    :raise TruncatedHeader: if more bytes of the image are needed
+    """
+    complete = len(prefix) >= size
+    reader = BufferReader(prefix)
+    try:
+        dataset, offset = parse_header(reader)
+    except Exception:
+        if complete:
+            raise
+        raise TruncatedHeader() from None
+    # parsing stops before the pixel data, otherwise it reached the end of the prefix
+    if not complete and (offset is None or offset >= len(prefix)):
+        raise TruncatedHeader()
+    anonymize_dataset(dataset, anonymized_id, profile)
+    destination = BytesIO()
+    dataset.save_as(destination)
+    return destination.getvalue(), offset
+
+
+def _rewritten_whole(task: ImageTask) -> bool:
+    """
+    Check whether an image must be rewritten whole, instead of from its first bytes.
+
+    Compressed images, and images whose profile changes the elements following the pixel
+    data, are rewritten by the CPU stage from the whole source file.
+
+    :param task: ImageTask
+    :return: True if the image is rewritten whole
+    """
+    patient = task.patient
+    if patient.deflate_level is not None:
+        return True
+    return patient.profile is not None and patient.profile.needs_trailer
+
+
+def _failed(image: _Image, error: BaseException) -> ImageResult:
+    """
+    Build the result of an image that could not be anonymized.
+
+    :param image: _Image
+    :param error: exception raised
+    :return: ImageResult
+    """
+    return ImageResult(
+        image.task.image,
+        None,
+        image.task.patient.anonymized_id,
+        image.stat.st_size if image.stat is not None else 0,
+        image.stat.st_mtime_ns if image.stat is not None else 0,
+        type(error).__name__,
+        str(os.getpid()),
+    )
+
+
+def _stat(task: ImageTask) -> _Image:
+    """
+    Get the size of a source image.
+
+    :param task: ImageTask
+    :return: _Image
+    """
+    return _Image(task, os.stat(task.image))
+
+
+def _read_prefix(image: _Image, size: int) -> _Image:
+    """
+    Read the first bytes of a source image.
+
+    :param image: _Image
+    :param size: number of bytes to be read
+    :return: _Image with its prefix
+    """
+    with open(image.task.image, "rb") as f:
+        return image._replace(prefix=f.read(size))
+
+
+def _write(images: List[_Image], only_directory: bool, hardlink: bool) -> List[ImageResult]:
+    """
+    Write a batch of anonymized images.
+
+    Anonymized headers are written first, then the pixel data is copied from the source
+    file in the kernel, as rewrite_image does. Images already written by the CPU stage are
+    only reported.
+
+    :param images: list of _Image
+    :param only_directory: copy images unchanged (bool)
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :return: list of ImageResult
+    """
+    results = []
+    worker = str(os.getpid())
+    for image in images:
+        if image.result is not None:
+            results.append(image.result)
+            continue
+        task = image.task
+        written = len(image.header)
+        try:
+            if only_directory:
+                copy_file(task.image, task.output, hardlink)
+                written = image.stat.st_size
+            elif image.offset is None:
+                with atomic_output(task.output) as destination:
+                    destination.write(image.header)
+            else:
+                with open(task.image, "rb") as source, atomic_output(task.output) as destination:
+                    destination.write(image.header)
+                    destination.flush()
+                    count = os.fstat(source.fileno()).st_size - image.offset
+                    copy_range(source.fileno(), destination.fileno(), image.offset, count)
+                    written += count
+        except Exception as e:  # pylint: disable=broad-except
+            results.append(_failed(image, e))
+            continue
+        results.append(
+            ImageResult(
+                task.image,
+                task.output,
+                task.patient.anonymized_id,
+                image.stat.st_size,
+                image.stat.st_mtime_ns,
+                worker=worker,
+                written=written,
+            )
+        )
+    return results
+
+
+class _ByteBudget:
+    """Number of bytes the pipeline may hold, shared by its stages."""
+
+    def __init__(self, limit: int) -> None:
+        """
+        Create the budget.
+
+        :param limit: number of bytes
+        """
+        self.limit = limit
+        self.used = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int, wait: bool = True) -> None:
+        """
+        Reserve bytes, waiting until they are available.
+
+        A reservation larger than the whole budget is granted when nothing else is held.
+
+        :param size: number of bytes
+        :param wait: wait for the bytes to be available; without waiting, an image already
+            in the pipeline can progress even when the budget is exhausted
+        :return: None
+        """
+        async with self._condition:
+            while wait and self.used and self.used + size > self.limit:
+                await self._condition.wait()
+            self.used += size
+
+    async def release(self, size: int) -> None:
+        """
+        Give back reserved bytes.
+
+        :param size: number of bytes
+        :return: None
+        """
+        async with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class _Pipeline:
+    """Stages of a pipelined run, connected by bounded queues."""
+
+    def __init__(
+        self,
+        tasks: Iterable[ImageTask],
+        only_directory: bool,
+        hardlink: bool,
+        io_executor: Executor,
+        cpu_executor: Executor,
+        readers: int,
+        rewriters: int,
+        writers: int,
+        results: "queue.Queue",
+        stop: threading.Event,
+    ) -> None:
+        """
+        Create the pipeline.
+
+        :param tasks: iterable of ImageTask
+        :param only_directory: anonymize only the destination directory (bool)
+        :param hardlink: with only_directory, hard link images instead of copying them (bool)
+        :param io_executor: executor running reads and writes
+        :param cpu_executor: executor rewriting headers
+        :param readers: number of images read at once
+        :param rewriters: number of headers rewritten at once
+        :param writers: number of batches written at once
+        :param results: queue receiving lists of ImageResult
+        :param stop: event set when the consumer stops iterating
+        """
+        self.tasks = iter(tasks)
+        self._tasks_lock = threading.Lock()
+        self.only_directory = only_directory
+        self.hardlink = hardlink
+        self.io_executor = io_executor
+        self.cpu_executor = cpu_executor
+        self.readers = readers
+        self.rewriters = rewriters
+        self.writers = writers
+        self.results = results
+        self.stop = stop
+
+    def _publish(self, item) -> None:
+        """
+        Hand an item to the consumer, waiting while its queue is full.
+
+        :param item: list of ImageResult, or exception to be raised by the consumer
+        :return: None
+        """
+        while not self.stop.is_set():
+            try:
+                self.results.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _next_task(self) -> Optional[ImageTask]:
+        """
+        Take the next task, if any: tasks may be generated by several readers.
+
+        :return: ImageTask, None once all tasks have been taken
+        """
+        with self._tasks_lock:
+            return next(self.tasks, None)
+
+    async def _run_io(self, function, *args):
+        """
+        Run a blocking function on the I/O executor.
+
+        :param function: function to be run
+        :param args: arguments of function
+        :return: result of function
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.io_executor, function, *args)
+
+    async def read(self, read_queue: asyncio.Queue, budget: _ByteBudget) -> None:
+        """
+        Read stage: prefetch the first bytes of images while the following stages are busy.
+
+        :param read_queue: queue of _Image to be rewritten
+        :param budget: _ByteBudget of the bytes read
+        :return: None
+        """
+        while not self.stop.is_set():
+            task = await self._run_io(self._next_task)
+            if task is None:
+                return
+            image = _Image(task, None)
+            try:
+                image = await self._run_io(_stat, task)
+                # images rewritten whole are read by the CPU stage
+                if not self.only_directory and not _rewritten_whole(task):
+                    size = min(PROBE_SIZE, image.stat.st_size)
+                    await budget.acquire(size)
+                    image = image._replace(reserved=size)
+                    try:
+                        image = await self._run_io(_read_prefix, image, size)
+                    except BaseException:
+                        await budget.release(size)
+                        raise
+            except Exception as e:  # pylint: disable=broad-except
+                await self._run_io(self._publish, [_failed(image, e)])
+                continue
+            await read_queue.put(image)
+
+    async def rewrite(
+        self, read_queue: asyncio.Queue, write_queue: asyncio.Queue, budget: _ByteBudget
+    ) -> None:
+        """
+        CPU stage: anonymize the headers of the images read.
+
+        Headers not contained in the bytes read are read again, doubling the size. Images
+        to be compressed, or whose profile changes the elements following the pixel data,
+        are rewritten whole.
+
+        :param read_queue: queue of _Image read
+        :param write_queue: queue of _Image to be written
+        :param budget: _ByteBudget of the bytes read
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            image = await read_queue.get()
+            if image is None:
+                return
+            if self.only_directory:
+                await write_queue.put(image)
+                continue
+            if _rewritten_whole(image.task):
+                # the whole image is rewritten, and written, by the CPU executor
+                result = await loop.run_in_executor(
+                    self.cpu_executor, run_task, False, False, image.task
+                )
+                await write_queue.put(image._replace(result=result))
+                continue
+            try:
+                while True:
+                    try:
+                        header, offset = await loop.run_in_executor(
+                            self.cpu_executor,
+                            rewrite_header,
+                            image.prefix,
+                            image.stat.st_size,
+                            image.task.patient.anonymized_id,
+                            image.task.patient.profile,
+                        )
+                        break
+                    except TruncatedHeader:
+                        read = len(image.prefix)
+                        size = min(2 * read, image.stat.st_size)
+                        # the image already holds part of the budget: do not wait for more
+                        await budget.acquire(size - image.reserved, wait=False)
+                        image = image._replace(reserved=size)
+                        image = await self._run_io(_read_prefix, image, size)
+                        if len(image.prefix) <= read:
+                            raise EOFError(f"{image.task.image} has been truncated")
+            except Exception as e:  # pylint: disable=broad-except
+                await budget.release(image.reserved)
+                await self._run_io(self._publish, [_failed(image, e)])
+                continue
+            # only the header is kept until the image is written
+            await budget.release(image.reserved - len(header))
+            await write_queue.put(
+                image._replace(prefix=b"", header=header, offset=offset, reserved=len(header))
+            )
+
+    async def write(self, write_queue: asyncio.Queue, budget: _ByteBudget) -> None:
+        """
+        Write stage: write the images in batches of those available.
+
+        Each writer stops at the first end of input marker it takes, leaving the others
+        to the other writers.
+
+        :param write_queue: queue of anonymized _Image
+        :param budget: _ByteBudget of the headers
+        :return: None
+        """
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < WRITE_BATCH and (not batch or not write_queue.empty()):
+                image = await write_queue.get()
+                if image is None:
+                    done = True
+                    break
+                batch.append(image)
+            if batch:
+                results = await self._run_io(_write, batch, self.only_directory, self.hardlink)
+                await budget.release(sum(image.reserved for image in batch))
+                await self._run_io(self._publish, results)
+
+    async def run(self) -> None:
+        """
+        Run every stage until all tasks are done.
+
+        :return: None
+        """
+        budget = _ByteBudget(MAX_BUFFERED_BYTES)
+        read_queue = asyncio.Queue(QUEUE_SIZE)
+        write_queue = asyncio.Queue(QUEUE_SIZE)
+        rewriters = [
+            asyncio.ensure_future(self.rewrite(read_queue, write_queue, budget))
+            for _ in range(self.rewriters)
+        ]
+        writers = [
+            asyncio.ensure_future(self.write(write_queue, budget)) for _ in range(self.writers)
+        ]
+        try:
+            await asyncio.gather(*(self.read(read_queue, budget) for _ in range(self.readers)))
+            for _ in rewriters:
+                await read_queue.put(None)
+            await asyncio.gather(*rewriters)
+            for _ in writers:
+                await write_queue.put(None)
+            await asyncio.gather(*writers)
+        finally:
+            for future in rewriters + writers:
+                future.cancel()
+
+
+def iter_pipeline_results(
+    tasks: Iterable[ImageTask],
+    only_directory: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+) -> Iterator[ImageResult]:
+    """
+    Run all tasks through a pipeline overlapping reads, header rewriting and writes.
+
+    An event loop, running in a background thread, reads the first bytes of images ahead
+    on a pool of I/O threads, rewrites their headers on a pool of worker processes and
+    writes them in batches on the I/O threads, while the caller consumes the results.
+    Pixel data never enters the pipeline: writers copy it from the source files in the
+    kernel. Images whose patient has a deflate_level, or a profile changing the elements
+    following the pixel data, are rewritten whole, and written, by the worker processes.
+    Bounded queues between the stages, and a budget of MAX_BUFFERED_BYTES bytes of
+    headers, cap the memory used. The output is the same as the one of iter_results.
+
+    :param tasks: iterable of ImageTask
+    :param only_directory: anonymize only the destination directory (bool)
+    :param processes: number of processes rewriting headers, defaults to the number of CPUs;
+        with a single process headers are rewritten by a thread
+    :param threads: number of threads reading and writing images
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :return: iterator of ImageResult, in no particular order
+    """
+    if processes is None:
+        processes = default_processes()
+    if threads is None:
+        threads = DEFAULT_THREADS
+    processes = max(processes, 1)
+    threads = max(threads, 1)
+
+    results = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    finished = object()
+
+    if processes == 1:
+        cpu_executor = ThreadPoolExecutor(1)
+    else:
+        cpu_executor = ProcessPoolExecutor(processes)
+    # readers wait for the task iterator too: one more thread lets writers always run
+    io_executor = ThreadPoolExecutor(threads + 1)
+
+    def run() -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pipeline = _Pipeline(
+            tasks,
+            only_directory,
+            hardlink,
+            io_executor,
+            cpu_executor,
+            readers=threads,
+            rewriters=2 * processes,
+            writers=max(threads // 2, 1),
+            results=results,
+            stop=stop,
+        )
+        try:
+            loop.run_until_complete(pipeline.run())
+            pipeline._publish(finished)  # pylint: disable=protected-access
+        except BaseException as e:  # pylint: disable=broad-except
+            pipeline._publish(e)  # pylint: disable=protected-access
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is finished:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+    finally:
+        stop.set()
+        thread.join()
+        io_executor.shutdown()
+        cpu_executor.shutdown()
@@ -0,0 +1,156 @@
+"""Keyed generation of pseudonyms for patient ids."""
+
+from typing import Union
+import hashlib
+import os
+import re
+import secrets
+import time
+
+from pathlib import Path
+
+
+# name of the file keeping the key generated by the first run, next to the conversion table
+KEY_NAME = "Anonymization.key"
+# numeric anonymized ids are integers in [0, DEFAULT_ID_SPACE)
+DEFAULT_ID_SPACE = 10**12
+FEISTEL_ROUNDS = 8
+
+# patient ids permuted directly: leading zeros would make two ids share the same integer
+_CANONICAL_INTEGER = re.compile("0|[1-9][0-9]*")
+
+
+class Pseudonymizer:
+    """
+    Map patient ids to anonymized ids with a keyed format-preserving permutation.
+
+    The anonymized id of a patient depends only on the key, the id space and the patient
+    id: it is computed in constant time and it is the same in every process and run.
+
+    Every anonymized id is in [0, id_space). Numeric patient ids inside the id space are
+    permuted directly, so they never share an anonymized id. Other patient ids are reduced
+    into the id space by a keyed hash, then permuted: two patients may then share an
+    anonymized id, with a probability of about n ** 2 / (2 * id_space) for n patients, and
+    such collisions are detected by the caller (see id_generator).
+    """
+
+    def __init__(self, key: Union[bytes, str], id_space: int = DEFAULT_ID_SPACE) -> None:
+        """
+        Create the permutation.
+
+        :param key: secret key
+        :param id_space: number of possible anonymized ids
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        if id_space < 2:
+            raise ValueError("The id space must contain at least two ids")
+        # blake2b keys are at most 64 bytes long
+        self._key = hashlib.blake2b(key, digest_size=32).digest()
+        self.id_space = id_space
+        self._half_bits = ((id_space - 1).bit_length() + 1) // 2
+        self._half_mask = (1 << self._half_bits) - 1
+        self._half_bytes = max((self._half_bits + 7) // 8, 1)
+        # 64 bits more than the id space: the reduction of the hash is uniform
+        self._hash_bytes = min(2 * self._half_bytes + 8, 64)
+
+    def _round(self, round_index: int, value: int) -> int:
+        """
+        Feistel round function.
+
+        :param round_index: index of the round
+        :param value: half block
+        :return: pseudo random half block
+        """
+        digest = hashlib.blake2b(
+            value.to_bytes(self._half_bytes, "big"),
+            key=self._key,
+            digest_size=min(max(self._half_bytes, 8), 64),
+            person=b"round%d" % round_index,
+        ).digest()
+        return int.from_bytes(digest, "big") & self._half_mask
+
+    def _encrypt(self, value: int) -> int:
+        """
+        Balanced Feistel network on 2 * half_bits bits.
+
+        :param value: integer smaller than 4 ** half_bits
+        :return: permuted integer smaller than 4 ** half_bits
+        """
+        left = value >> self._half_bits
+        right = value & self._half_mask
+        for round_index in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(round_index, right)
+        return (left << self._half_bits) | right
+
+    def permute(self, value: int) -> int:
+        """
+        Keyed permutation of the id space.
+
+        Values are encrypted until they fall back into the id space (cycle walking):
+        the Feistel domain is less than four times the id space.
+
+        :param value: integer in [0, id_space)
+        :return: integer in [0, id_space)
+        """
+        value = self._encrypt(value)
+        while value >= self.id_space:
+            value = self._encrypt(value)
+        return value
+
+    def __call__(self, patient_id: str) -> int:
+        """
+        Anonymized id of a patient.
+
+        :param patient_id: PatientID of the patient
+        :return: anonymized id, in [0, id_space)
+        """
+        patient_id = str(patient_id)
+        if _CANONICAL_INTEGER.fullmatch(patient_id) and int(patient_id) < self.id_space:
+            return self.permute(int(patient_id))
+        digest = hashlib.blake2b(
+            patient_id.encode(), key=self._key, digest_size=self._hash_bytes, person=b"id"
+        ).digest()
+        return self.permute(int.from_bytes(digest, "big") % self.id_space)
+
+
+def load_key(path: Path) -> bytes:
+    """
+    Read the key kept in a key file, creating the file with a random key if missing.
+
+    Runs sharing the output directory, such as shards, agree on the key: the first one
+    creates the file and the others read it.
+
+    :param path: Path of the key file
+    :return: key
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # the file may have just been created by another run, which is still writing it
+        for _ in range(50):
+            key = path.read_text().strip()
+            if key:
+                return bytes.fromhex(key)
+            time.sleep(0.1)
+        raise ValueError(f"The key file {path} is empty") from None
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, "w") as f:
+        f.write(key + "\n")
+    print(f"Generated a new key in {path}: keep it secret, later runs need it for the same ids")
+    return bytes.fromhex(key)
+
+
+def shard_of(patient_id: str, shards: int) -> int:
+    """
+    Shard of a patient, when the patients are split among several independent runs.
+
+    The shard depends only on the PatientID, so every run agrees on it without any
+    coordination, and patients are spread uniformly among the shards.
+
+    :param patient_id: PatientID of the patient
+    :param shards: number of shards
+    :return: shard index in [0, shards)
+    """
+    digest = hashlib.blake2b(str(patient_id).encode(), digest_size=8, person=b"shard").digest()
+    return int.from_bytes(digest, "big") % shards
@@ -0,0 +1,228 @@
+"""DICOM C-STORE receiver anonymizing images on ingest."""
+
+from typing import Any, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import hashlib
+import os
+import re
+import threading
+
+from pydicom.dataset import Dataset
+
+from .classes import Patient
+from .fileio import atomic_output, parse_header
+from .functions import PatientRegistry, id_generator, patient_data
+from .inmemory import BufferReader, write_anonymized
+from .metrics import Metrics
+from .pseudonym import DEFAULT_ID_SPACE, KEY_NAME, load_key
+from .rules import DEFAULT_PROFILE, load_profile
+from .scheduler import ImageResult
+from .table import TABLE_NAME, ConversionTableWriter, read_conversion_table
+
+from pathlib import Path
+
+
+DEFAULT_AE_TITLE = "DICOMANONYMIZE"
+DEFAULT_PORT = 11112
+# images anonymized at once, whatever the number of associations
+DEFAULT_WORKERS = 4
+# associations accepted at once
+MAX_ASSOCIATIONS = 32
+
+# C-STORE statuses, from PS3.4 Annex B.2.3
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+_UID = re.compile("[0-9.]{1,64}")
+
+
+def _file_name(dataset: Dataset, keyword: str, data: bytes) -> str:
+    """
+    Name of an output file or directory, from a UID of the image.
+
+    :param dataset: header of the image
+    :param keyword: keyword of the UID
+    :param data: encoded image, hashed when the UID is missing or malformed
+    :return: str
+    """
+    uid = str(dataset.get(keyword, ""))
+    if _UID.fullmatch(uid) and uid.strip("."):
+        return uid
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class StoreReceiver:
+    """
+    Storage SCP writing only the anonymized version of the images it receives.
+
+    Received images are never written as they are: each one is anonymized in memory,
+    with its pixel data passed through, and written to
+    OUTPUT/anonymized id/StudyInstanceUID/SOPInstanceUID.dcm. Every association runs on
+    its own thread, but images are anonymized by a bounded pool of threads, so that many
+    concurrent associations do not overload the host. Requires pynetdicom.
+    """
+
+    def __init__(
+        self,
+        output_directory: Path,
+        key: Optional[Union[bytes, str]] = None,
+        id_space: int = DEFAULT_ID_SPACE,
+        ae_title: str = DEFAULT_AE_TITLE,
+        workers: int = DEFAULT_WORKERS,
+        max_associations: int = MAX_ASSOCIATIONS,
+        metrics: Optional[Metrics] = None,
+        profile: Union[str, Path] = DEFAULT_PROFILE,
+        uid_map: Optional[Path] = None,
+    ) -> None:
+        """
+        Create the receiver, appending new patients to the csv conversion table.
+
+        :param output_directory: Path of the output directory
+        :param key: secret key of the anonymized ids, by default the one of the key file
+        :param id_space: number of possible anonymized ids
+        :param ae_title: application entity title of the receiver
+        :param workers: number of images anonymized at once
+        :param max_associations: number of associations accepted at once
+        :param metrics: Metrics collecting counters
+        :param profile: de-identification profile, built-in name or Path of a JSON profile
+        :param uid_map: Path of the directory where the remapped UIDs are recorded
+        """
+        try:
+            import pynetdicom  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+        except ImportError as e:
+            raise ImportError(
+                "The C-STORE receiver requires pynetdicom: pip install pynetdicom"
+            ) from e
+        self.output_directory = output_directory
+        self.ae_title = ae_title
+        self.max_associations = max_associations
+        self.metrics = Metrics() if metrics is None else metrics
+        output_directory.mkdir(parents=True, exist_ok=True)
+        if key is None:
+            key = load_key(output_directory / KEY_NAME)
+
+        table_path = output_directory / f"{TABLE_NAME}.csv"
+        known = {}
+        if table_path.exists():
+            known = {
+                row["PatientID"]: row["anonymized_id"]
+                for row in read_conversion_table(table_path)
+            }
+        self._table = ConversionTableWriter(table_path, append=True)
+        self._registry = PatientRegistry(
+            id_generator(key, id_space),
+            self._table,
+            self.metrics,
+            known,
+            load_profile(profile, key, uid_map),
+        )
+        self._executor = ThreadPoolExecutor(max(workers, 1))
+        self._server = None
+        self._lock = threading.Lock()
+
+    def store(self, data: bytes) -> ImageResult:
+        """
+        Anonymize an encoded image and write it to the output directory.
+
+        :param data: image encoded with its file meta information
+        :return: ImageResult
+        """
+        source = BufferReader(data)
+        dataset, offset = parse_header(source)
+        patient = self._registry.register(Patient(patient_data(dataset), [], []))
+        anonymized = BytesIO()
+        write_anonymized(
+            source, dataset, offset, anonymized, patient.anonymized_id, patient.profile
+        )
+        # the names come from the anonymized header, the profile may remap the UIDs
+        output = (
+            self.output_directory
+            / patient.anonymized_id
+            / _file_name(dataset, "StudyInstanceUID", data)
+            / f"{_file_name(dataset, 'SOPInstanceUID', data)}.dcm"
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_output(output) as destination:
+            destination.write(anonymized.getbuffer())
+        return ImageResult(
+            output, output, patient.anonymized_id, len(data), worker=str(os.getpid())
+        )
+
+    def handle_store(self, event: Any) -> int:
+        """
+        Handle a C-STORE request, waiting for a worker to anonymize the image.
+
+        :param event: pynetdicom C-STORE event
+        :return: C-STORE status
+        """
+        try:
+            data = event.encoded_dataset()
+        except Exception:  # pylint: disable=broad-except
+            return STATUS_CANNOT_UNDERSTAND
+        self.metrics.add_queued()
+        try:
+            result = self._executor.submit(self.store, data).result()
+        except Exception as e:  # pylint: disable=broad-except
+            self.metrics.record(
+                ImageResult(Path(), None, "", len(data), error=type(e).__name__)
+            )
+            if isinstance(e, OSError):
+                return STATUS_OUT_OF_RESOURCES
+            return STATUS_CANNOT_UNDERSTAND
+        self.metrics.record(result)
+        return STATUS_SUCCESS
+
+    def start(
+        self, address: str = "", port: int = DEFAULT_PORT, block: bool = False
+    ) -> Tuple[str, int]:
+        """
+        Start accepting associations.
+
+        Every storage SOP class is accepted, with any transfer syntax: pixel data is never
+        decoded.
+
+        :param address: address to listen on, all interfaces by default
+        :param port: TCP port, 0 for any free port
+        :param block: serve until interrupted, instead of returning at once
+        :return: address and port the receiver listens on
+        """
+        # pylint: disable=import-outside-toplevel
+        from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, AllStoragePresentationContexts, evt
+        from pynetdicom.sop_class import Verification
+
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = self.max_associations
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        ae.add_supported_context(Verification)
+        handlers = [(evt.EVT_C_STORE, self.handle_store)]
+        if block:
+            print(f"Receiving on port {port} as {self.ae_title}")
+            ae.start_server((address, port), block=True, evt_handlers=handlers)
+            return address, port
+        with self._lock:
+            self._server = ae.start_server((address, port), block=False, evt_handlers=handlers)
+            return self._server.server_address[:2]
+
+    def close(self) -> None:
+        """
+        Stop accepting associations, then write the pending images and the table.
+
+        :return: None
+        """
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server = None
+        self._executor.shutdown(wait=True)
+        self._table.close()
+
+    def __enter__(self) -> "StoreReceiver":
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Stop the receiver when leaving the context."""
+        self.close()
@@ -0,0 +1,678 @@
+"""Compiled de-identification profiles: tables of tags and actions applied in one pass."""
+
+from typing import Any, Dict, Mapping, Optional, Tuple, Union
+from functools import lru_cache
+import datetime
+import hashlib
+import json
+
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+from .uids import UIDRemapper
+
+from pathlib import Path
+
+
+# patient information, replaced with the anonymized id by the basic profile
+VALUES_TO_ANONYMIZE = [
+    "PatientName",
+    "PatientID",
+    "PatientBirthDate",
+    "PatientSex",
+    "PatientAge",
+    "AcquisitionDate",
+    "SeriesDate",
+    "StudyDate",
+    "ContentDate",
+    "StudyTime",
+    "SeriesTime",
+    "AcquisitionTime",
+    "ContentTime",
+    "AccessionNumber",
+    "ReferringPhysicianName",
+]
+
+# actions, stored as small integers in the compiled tables
+KEEP = 0
+REPLACE = 1
+BLANK = 2
+DELETE = 3
+HASH = 4
+SHIFT = 5
+UID = 6
+RECURSE = 7
+ACTIONS = {
+    "keep": KEEP,
+    "replace": REPLACE,
+    "blank": BLANK,
+    "delete": DELETE,
+    "hash": HASH,
+    "shift": SHIFT,
+    "uid": UID,
+    "recurse": RECURSE,
+}
+
+# dates are shifted by a number of days in [-MAX_DATE_SHIFT, MAX_DATE_SHIFT], the same for
+# every image of a patient
+MAX_DATE_SHIFT = 365
+# maximum length of the values of each VR, for hashed values
+_MAX_LENGTHS = {"AE": 16, "CS": 16, "SH": 16, "LO": 64, "PN": 64, "UI": 64, "DS": 16, "IS": 12}
+
+_SOP_INSTANCE_UID = Tag("SOPInstanceUID")
+_PIXEL_DATA = Tag("PixelData")
+_PATIENT_IDENTITY_REMOVED = Tag("PatientIdentityRemoved")
+_DEIDENTIFICATION_METHOD = Tag("DeidentificationMethod")
+
+# PS3.15 Annex E, Table E.1-1, Basic Application Level Confidentiality Profile: "D" actions
+# give the anonymized id to patient identifiers and blank the other elements, "Z" actions
+# blank, "X" actions delete and "U" actions remap UIDs; sequences not listed are recursed into
+_PS3_15_BLANK = [
+    "AccessionNumber",
+    "ContentCreatorName",
+    "ContentDate",
+    "ContentTime",
+    "ContrastBolusAgent",
+    "FillerOrderNumberImagingServiceRequest",
+    "GraphicAnnotationSequence",
+    "PatientBirthDate",
+    "PatientSex",
+    "PersonIdentificationCodeSequence",
+    "PersonName",
+    "PlacerOrderNumberImagingServiceRequest",
+    "ReferringPhysicianName",
+    "StudyDate",
+    "StudyID",
+    "StudyTime",
+    "VerificationDateTime",
+    "VerifyingObserverIdentificationCodeSequence",
+    "VerifyingObserverName",
+    "VerifyingObserverSequence",
+]
+_PS3_15_DELETE = [
+    "AcquisitionComments",
+    "AcquisitionContextSequence",
+    "AcquisitionDate",
+    "AcquisitionDateTime",
+    "AcquisitionDeviceProcessingDescription",
+    "AcquisitionProtocolDescription",
+    "AcquisitionTime",
+    "ActualHumanPerformersSequence",
+    "AdditionalPatientHistory",
+    "AdmissionID",
+    "AdmittingDate",
+    "AdmittingDiagnosesCodeSequence",
+    "AdmittingDiagnosesDescription",
+    "AdmittingTime",
+    "Allergies",
+    "Arbitrary",
+    "AuthorObserverSequence",
+    "BranchOfService",
+    "CassetteID",
+    "CommentsOnThePerformedProcedureStep",
+    "ConfidentialityConstraintOnPatientDataDescription",
+    "ConsultingPhysicianIdentificationSequence",
+    "ConsultingPhysicianName",
+    "ContentCreatorIdentificationCodeSequence",
+    "ContentSequence",
+    "ContributionDescription",
+    "CountryOfResidence",
+    "CurrentPatientLocation",
+    "CurveDate",
+    "CurveTime",
+    "CustodialOrganizationSequence",
+    "DataSetTrailingPadding",
+    "DerivationDescription",
+    "DetectorID",
+    "DeviceSerialNumber",
+    "DigitalSignaturesSequence",
+    "DischargeDiagnosisDescription",
+    "DistributionAddress",
+    "DistributionName",
+    "EthnicGroup",
+    "FrameComments",
+    "GantryID",
+    "GeneratorID",
+    "HumanPerformerName",
+    "HumanPerformerOrganization",
+    "IconImageSequence",
+    "IdentifyingComments",
+    "ImageComments",
+    "ImagePresentationComments",
+    "ImagingServiceRequestComments",
+    "Impressions",
+    "InstitutionAddress",
+    "InstitutionCodeSequence",
+    "InstitutionName",
+    "InstitutionalDepartmentName",
+    "InsurancePlanIdentification",
+    "IntendedRecipientsOfResultsIdentificationSequence",
+    "InterpretationApproverSequence",
+    "InterpretationAuthor",
+    "InterpretationDiagnosisDescription",
+    "InterpretationIDIssuer",
+    "InterpretationRecorder",
+    "InterpretationText",
+    "InterpretationTranscriber",
+    "IssuerOfAdmissionID",
+    "IssuerOfPatientID",
+    "IssuerOfServiceEpisodeID",
+    "LastMenstrualDate",
+    "MAC",
+    "MedicalAlerts",
+    "MedicalRecordLocator",
+    "MilitaryRank",
+    "ModifiedAttributesSequence",
+    "ModifiedImageDescription",
+    "ModifyingDeviceID",
+    "ModifyingDeviceManufacturer",
+    "NameOfPhysiciansReadingStudy",
+    "NamesOfIntendedRecipientsOfResults",
+    "Occupation",
+    "OperatorIdentificationSequence",
+    "OperatorsName",
+    "OrderCallbackPhoneNumber",
+    "OrderEnteredBy",
+    "OrderEntererLocation",
+    "OriginalAttributesSequence",
+    "OtherPatientIDs",
+    "OtherPatientIDsSequence",
+    "OtherPatientNames",
+    "OverlayDate",
+    "OverlayTime",
+    "ParticipantSequence",
+    "PatientAddress",
+    "PatientAge",
+    "PatientAlternativeCalendar",
+    "PatientBirthDateInAlternativeCalendar",
+    "PatientBirthName",
+    "PatientBirthTime",
+    "PatientComments",
+    "PatientDeathDateInAlternativeCalendar",
+    "PatientInstitutionResidence",
+    "PatientInsurancePlanCodeSequence",
+    "PatientMotherBirthName",
+    "PatientPrimaryLanguageCodeSequence",
+    "PatientPrimaryLanguageModifierCodeSequence",
+    "PatientReligiousPreference",
+    "PatientSexNeutered",
+    "PatientSize",
+    "PatientState",
+    "PatientTelephoneNumbers",
+    "PatientTransportArrangements",
+    "PatientWeight",
+    "PerformedLocation",
+    "PerformedProcedureStepDescription",
+    "PerformedProcedureStepEndDate",
+    "PerformedProcedureStepEndTime",
+    "PerformedProcedureStepID",
+    "PerformedProcedureStepStartDate",
+    "PerformedProcedureStepStartTime",
+    "PerformedStationAETitle",
+    "PerformedStationGeographicLocationCodeSequence",
+    "PerformedStationName",
+    "PerformedStationNameCodeSequence",
+    "PerformingPhysicianIdentificationSequence",
+    "PerformingPhysicianName",
+    "PersonAddress",
+    "PersonTelephoneNumbers",
+    "PhysicianApprovingInterpretation",
+    "PhysiciansOfRecord",
+    "PhysiciansOfRecordIdentificationSequence",
+    "PhysiciansReadingStudyIdentificationSequence",
+    "PlateID",
+    "PreMedication",
+    "PregnancyStatus",
+    "ProtocolName",
+    "ReasonForStudy",
+    "ReasonForTheImagingServiceRequest",
+    "ReasonForTheRequestedProcedure",
+    "ReferencedDigitalSignatureSequence",
+    "ReferencedPatientAliasSequence",
+    "ReferencedPatientPhotoSequence",
+    "ReferencedPatientSequence",
+    "ReferencedSOPInstanceMACSequence",
+    "ReferringPhysicianAddress",
+    "ReferringPhysicianIdentificationSequence",
+    "ReferringPhysicianTelephoneNumbers",
+    "RegionOfResidence",
+    "RequestAttributesSequence",
+    "RequestedContrastAgent",
+    "RequestedProcedureComments",
+    "RequestedProcedureDescription",
+    "RequestedProcedureID",
+    "RequestedProcedureLocation",
+    "RequestingPhysician",
+    "RequestingService",
+    "ResponsibleOrganization",
+    "ResponsiblePerson",
+    "ResponsiblePersonRole",
+    "ResultsComments",
+    "ResultsDistributionListSequence",
+    "ResultsIDIssuer",
+    "ScheduledHumanPerformersSequence",
+    "ScheduledPatientInstitutionResidence",
+    "ScheduledPerformingPhysicianIdentificationSequence",
+    "ScheduledPerformingPhysicianName",
+    "ScheduledProcedureStepDescription",
+    "ScheduledProcedureStepEndDate",
+    "ScheduledProcedureStepEndTime",
+    "ScheduledProcedureStepLocation",
+    "ScheduledProcedureStepStartDate",
+    "ScheduledProcedureStepStartTime",
+    "ScheduledStationAETitle",
+    "ScheduledStationGeographicLocationCodeSequence",
+    "ScheduledStationName",
+    "ScheduledStationNameCodeSequence",
+    "ScheduledStudyLocation",
+    "ScheduledStudyLocationAETitle",
+    "SeriesDate",
+    "SeriesDescription",
+    "SeriesTime",
+    "ServiceEpisodeDescription",
+    "ServiceEpisodeID",
+    "SmokingStatus",
+    "SpecialNeeds",
+    "StationName",
+    "StudyComments",
+    "StudyDescription",
+    "StudyIDIssuer",
+    "TextComments",
+    "TextString",
+    "TimezoneOffsetFromUTC",
+    "TopicAuthor",
+    "TopicKeywords",
+    "TopicSubject",
+    "TopicTitle",
+    "VerifyingOrganization",
+    "VisitComments",
+]
+_PS3_15_UID = [
+    "ConcatenationUID",
+    "CreatorVersionUID",
+    "DeviceUID",
+    "DimensionOrganizationUID",
+    "DoseReferenceUID",
+    "FiducialUID",
+    "FrameOfReferenceUID",
+    "InstanceCreatorUID",
+    "IrradiationEventUID",
+    "LargePaletteColorLookupTableUID",
+    "MultiFrameSourceSOPInstanceUID",
+    "ObservationUID",
+    "PaletteColorLookupTableUID",
+    "ReferencedFrameOfReferenceUID",
+    "ReferencedGeneralPurposeScheduledProcedureStepTransactionUID",
+    "ReferencedObservationUIDTrial",
+    "ReferencedSOPInstanceUID",
+    "RelatedFrameOfReferenceUID",
+    "SOPInstanceUID",
+    "SeriesInstanceUID",
+    "SourceFrameOfReferenceUID",
+    "SpecimenUID",
+    "StorageMediaFileSetUID",
+    "StudyInstanceUID",
+    "SynchronizationFrameOfReferenceUID",
+    "TargetUID",
+    "TemplateExtensionCreatorUID",
+    "TemplateExtensionOrganizationUID",
+    "TransactionUID",
+    "UID",
+]
+# dates kept, shifted, by the Retain Longitudinal Temporal Information with Modified Dates
+# Option (PS3.15 Annex E.3.6)
+_SHIFTED_DATES = [
+    "AcquisitionDate",
+    "AcquisitionDateTime",
+    "ContentDate",
+    "SeriesDate",
+    "StudyDate",
+]
+
+DEFAULT_PROFILE = "basic"
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "basic": {"rules": {keyword: "replace" for keyword in VALUES_TO_ANONYMIZE}},
+    "ps3.15": {
+        "rules": dict(
+            [(keyword, "blank") for keyword in _PS3_15_BLANK]
+            + [(keyword, "delete") for keyword in _PS3_15_DELETE]
+            + [(keyword, "uid") for keyword in _PS3_15_UID]
+            + [("PatientName", "replace"), ("PatientID", "replace")]
+        ),
+        "remove_private": True,
+        "recurse": True,
+        "method": "DICOM PS3.15 E.1-1 Basic Profile",
+    },
+}
+PROFILES["ps3.15-dates"] = dict(
+    PROFILES["ps3.15"],
+    rules=dict(PROFILES["ps3.15"]["rules"], **{keyword: "shift" for keyword in _SHIFTED_DATES}),
+    method=PROFILES["ps3.15"]["method"] + ", Modified Dates Option",
+)
+
+
+def _parse_tag(name: str) -> int:
+    """
+    Tag of a rule, from its keyword or from its hexadecimal group and element.
+
+    :param name: keyword, such as PatientName, or "GGGGEEEE", "(GGGG,EEEE)", "GGGG,EEEE"
+    :return: tag as an integer
+    :raise ValueError: if the name is neither a keyword nor a tag
+    """
+    tag = tag_for_keyword(name)
+    if tag is not None:
+        return tag
+    digits = name.strip("()").replace(",", "")
+    if len(digits) == 8:
+        try:
+            return int(digits, 16)
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown element {name}")
+
+
+def _vr(element: Any, tag: int) -> Optional[str]:
+    """
+    VR of an element, without decoding its value.
+
+    :param element: DataElement or RawDataElement
+    :param tag: tag of the element
+    :return: VR, None if unknown
+    """
+    if element.VR is not None:
+        return element.VR
+    try:
+        return dictionary_VR(tag)
+    except KeyError:
+        return None
+
+
+class Profile:
+    """
+    De-identification profile, compiled into a table of integer tags and actions.
+
+    Rules map keywords or tags to one of ACTIONS: replace (with the anonymized id), blank,
+    delete, hash (keyed hash of the value), shift (dates moved by a number of days that
+    depends only on the key and on the patient), uid (keyed remapping into the 2.25
+    root, the same in every process and run, see UIDRemapper), recurse (into the items of
+    a sequence) and keep. Private elements can be removed, and sequences without a rule
+    recursed into.
+
+    Each dataset is walked once, looking up the action of each element in the table: the
+    cost of an image depends on its elements, not on the size of the profile. Only the
+    elements with an action are decoded. Images are rewritten without parsing the elements
+    following their pixel data, unless needs_trailer is set: the profile removes private
+    elements or has rules for elements following the pixel data, such as trailing padding
+    and digital signatures.
+    """
+
+    def __init__(
+        self,
+        rules: Mapping[str, str],
+        key: Union[bytes, str] = b"",
+        name: str = "custom",
+        remove_private: bool = False,
+        recurse: bool = False,
+        method: Optional[str] = None,
+        uid_map: Optional[Path] = None,
+    ) -> None:
+        """
+        Compile a profile.
+
+        :param rules: dictionary from keyword or tag to action
+        :param key: secret key of hashed values, shifted dates and remapped UIDs
+        :param name: name of the profile
+        :param remove_private: remove private elements
+        :param recurse: apply the profile to the items of sequences without a rule
+        :param method: description of the profile, written to DeidentificationMethod along
+            with PatientIdentityRemoved; None to leave both unchanged
+        :param uid_map: Path of the directory where the remapped UIDs are recorded
+        :raise ValueError: if a rule has an unknown element or action
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        self.name = name
+        self.key = key
+        self.rules = dict(rules)
+        self.remove_private = remove_private
+        self.recurse = recurse
+        self.method = method
+        self.uid_map = uid_map
+        self.uids = UIDRemapper(key, uid_map)
+        self._key = hashlib.blake2b(key, digest_size=32).digest()
+        self._actions: Dict[int, int] = {}
+        for element, action in self.rules.items():
+            if action not in ACTIONS:
+                raise ValueError(f"Unknown action {action} for {element}")
+            self._actions[_parse_tag(element)] = ACTIONS[action]
+        # a few rules are faster to look up one by one than walking the dataset
+        self._walk = recurse or remove_private or len(self._actions) > 32
+        self.needs_trailer = remove_private or any(tag > _PIXEL_DATA for tag in self._actions)
+
+    def __reduce__(self) -> Tuple:
+        """Send built-in profiles to worker processes by name, compiling them once there."""
+        if self.name in PROFILES:
+            return builtin_profile, (self.name, self.key, self.uid_map)
+        return (
+            Profile,
+            (
+                self.rules,
+                self.key,
+                self.name,
+                self.remove_private,
+                self.recurse,
+                self.method,
+                self.uid_map,
+            ),
+        )
+
+    def _digest(self, value: str, person: bytes, size: int) -> bytes:
+        """
+        Keyed hash of a value.
+
+        :param value: value to be hashed
+        :param person: personalization of the hash, separating the uses of the key
+        :param size: number of bytes of the digest
+        :return: digest
+        """
+        return hashlib.blake2b(
+            value.encode(), key=self._key, digest_size=size, person=person
+        ).digest()
+
+    def remap_uid(self, uid: str) -> str:
+        """
+        UID replacing another one, in the 2.25 root.
+
+        :param uid: original UID
+        :return: remapped UID, the same in every process and run sharing the key
+        """
+        return self.uids.remap(uid)
+
+    def date_shift(self, anonymized_id: str) -> datetime.timedelta:
+        """
+        Shift of the dates of a patient.
+
+        :param anonymized_id: anonymized id of the patient
+        :return: number of days, in [-MAX_DATE_SHIFT, MAX_DATE_SHIFT]
+        """
+        days = int.from_bytes(self._digest(anonymized_id, b"date", 8), "big")
+        return datetime.timedelta(days=days % (2 * MAX_DATE_SHIFT + 1) - MAX_DATE_SHIFT)
+
+    def apply(self, dataset: Dataset, anonymized_id: str) -> None:
+        """
+        De-identify a dataset in place.
+
+        :param dataset: pydicom dataset of the image
+        :param anonymized_id: anonymized id of the patient
+        :return: None
+        """
+        if self._walk:
+            remapped_sop = self._apply(dataset, anonymized_id)
+        else:
+            remapped_sop = None
+            for tag, action in self._actions.items():
+                if tag in dataset:
+                    remapped = self._act(dataset, tag, action, anonymized_id)
+                    if tag == _SOP_INSTANCE_UID:
+                        remapped_sop = remapped
+        file_meta = getattr(dataset, "file_meta", None)
+        if remapped_sop is not None and file_meta is not None:
+            # the file meta information must reference the same instance
+            if "MediaStorageSOPInstanceUID" in file_meta:
+                file_meta.MediaStorageSOPInstanceUID = remapped_sop
+        if self.method is not None:
+            dataset.PatientIdentityRemoved = "YES"
+            dataset.DeidentificationMethod = self.method
+
+    def _apply(self, dataset: Dataset, anonymized_id: str) -> Optional[str]:
+        """
+        Walk a dataset, applying the action of each element.
+
+        :param dataset: pydicom dataset, or item of a sequence
+        :param anonymized_id: anonymized id of the patient
+        :return: remapped SOPInstanceUID of the dataset, if any
+        """
+        remapped_sop = None
+        for tag in list(dataset.keys()):
+            action = self._actions.get(tag)
+            if action is None:
+                if self.remove_private and tag >> 16 & 1:
+                    del dataset[tag]
+                    continue
+                if not self.recurse or _vr(dataset.get_item(tag), tag) != "SQ":
+                    continue
+                action = RECURSE
+            remapped = self._act(dataset, tag, action, anonymized_id)
+            if tag == _SOP_INSTANCE_UID:
+                remapped_sop = remapped
+        return remapped_sop
+
+    def _act(self, dataset: Dataset, tag: int, action: int, anonymized_id: str) -> Any:
+        """
+        Apply an action to an element of a dataset.
+
+        :param dataset: pydicom dataset containing the element
+        :param tag: tag of the element
+        :param action: one of the values of ACTIONS
+        :param anonymized_id: anonymized id of the patient
+        :return: new value of the element
+        """
+        if action == KEEP:
+            return None
+        if action == DELETE:
+            del dataset[tag]
+            return None
+        element = dataset[tag]
+        try:
+            if action == REPLACE:
+                element.value = anonymized_id
+            elif action == BLANK:
+                element.value = [] if element.VR == "SQ" else None
+            elif action == RECURSE:
+                if element.VR == "SQ":
+                    for item in element.value:
+                        self._apply(item, anonymized_id)
+            elif element.value in (None, ""):
+                pass
+            elif action == UID:
+                element.value = self._map(element.value, self.remap_uid)
+            elif action == HASH:
+                size = _MAX_LENGTHS.get(element.VR, 16) // 2
+                element.value = self._map(
+                    element.value, lambda value: self._digest(value, b"hash", size).hex()
+                )
+            elif action == SHIFT:
+                shift = self.date_shift(anonymized_id)
+                element.value = self._map(
+                    element.value, lambda value: _shift_date(value, shift)
+                )
+        except Exception:  # pylint: disable=broad-except
+            # values that cannot be set, or are malformed, are removed
+            if action != REPLACE:
+                del dataset[tag]
+            return None
+        return element.value
+
+    @staticmethod
+    def _map(value: Any, function: Any) -> Any:
+        """
+        Apply a function to a value, or to each of its values.
+
+        :param value: value of an element
+        :param function: function of a string
+        :return: new value
+        """
+        if isinstance(value, (list, MultiValue)):
+            return [function(str(item)) for item in value]
+        return function(str(value))
+
+
+def _shift_date(value: str, shift: datetime.timedelta) -> str:
+    """
+    Shift a DA value, or the date of a DT value.
+
+    :param value: YYYYMMDD, possibly followed by a time
+    :param shift: shift of the date
+    :return: shifted value
+    :raise ValueError: if the value is not a date
+    """
+    date = datetime.datetime.strptime(value[:8], "%Y%m%d") + shift
+    return date.strftime("%Y%m%d") + value[8:]
+
+
+def builtin_profile(
+    name: str, key: Union[bytes, str] = b"", uid_map: Optional[Path] = None
+) -> Profile:
+    """
+    Compile a built-in profile, once per process.
+
+    :param name: one of PROFILES
+    :param key: secret key of hashed values, shifted dates and remapped UIDs
+    :param uid_map: Path of the directory where the remapped UIDs are recorded
+    :return: Profile
+    """
+    if isinstance(key, str):
+        key = key.encode()
+    return _compile(name, key, uid_map)
+
+
+@lru_cache(maxsize=None)
+def _compile(name: str, key: bytes, uid_map: Optional[Path]) -> Profile:
+    """Compile a built-in profile; see builtin_profile."""
+    return Profile(key=key, name=name, uid_map=uid_map, **PROFILES[name])
+
+
+def load_profile(
+    profile: Union[str, Path], key: Union[bytes, str] = b"", uid_map: Optional[Path] = None
+) -> Profile:
+    """
+    Compile a built-in profile, or a profile read from a JSON file.
+
+    A profile file holds a "rules" object, from keyword or tag ("GGGGEEEE") to action,
+    and optionally "remove_private", "recurse" and "method"; with "base", the name of a
+    built-in profile, its rules are extended and overridden.
+
+    :param profile: one of PROFILES, or Path of a JSON profile
+    :param key: secret key of hashed values, shifted dates and remapped UIDs
+    :param uid_map: Path of the directory where the remapped UIDs are recorded
+    :return: Profile
+    :raise ValueError: if the profile is unknown or invalid
+    """
+    if str(profile) in PROFILES:
+        return builtin_profile(str(profile), key, uid_map)
+    path = Path(profile)
+    if not path.is_file():
+        raise ValueError(
+            f"Unknown profile {profile}: expected one of {', '.join(PROFILES)} or a JSON file"
+        )
+    with open(path) as f:
+        definition = json.load(f)
+    base = definition.pop("base", None)
+    if base is not None:
+        if base not in PROFILES:
+            raise ValueError(f"Unknown base profile {base}")
+        definition = dict(PROFILES[base], **definition)
+        definition["rules"] = dict(PROFILES[base]["rules"], **definition["rules"])
+    return Profile(key=key, name=str(path), uid_map=uid_map, **definition)
@@ -0,0 +1,547 @@
+"""Bounded file-level scheduler for image anonymization."""
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+from multiprocessing.pool import Pool, ThreadPool
+from multiprocessing import cpu_count
+from collections import deque
+from functools import partial
+from itertools import islice
+import os
+import queue
+import threading
+import time
+
+from .adaptive import MAX_THREADS, AdaptiveController
+from .classes import Patient
+from .metrics import Metrics
+
+from pathlib import Path
+
+
+# threads per worker process: images are mostly I/O bound
+DEFAULT_THREADS = 4
+# number of images sent to a worker process at once
+CHUNK_SIZE = 64
+# chunks (or single images, for threads) waiting or running for each worker
+IN_FLIGHT_PER_WORKER = 2
+
+
+class ImageTask(NamedTuple):
+    """
+    Single unit of work.
+
+    patient: Patient owning the image (Patient)
+    image: Path of the image (Path)
+    output: Path of the anonymized image (Path).
+    """
+
+    patient: Patient
+    image: Path
+    output: Path
+
+
+class ImageResult(NamedTuple):
+    """
+    Result of a single task.
+
+    source: Path of the source image (Path)
+    output: Path of the anonymized image, None if anonymization failed (Path)
+    anonymized_id: anonymized id of the patient (str)
+    size: size of the source image (int)
+    mtime_ns: modification time of the source image (int)
+    error: name of the exception raised by a failed anonymization (str)
+    worker: process id of the worker that ran the task (str)
+    queue_depth: images received by the worker and not yet done when the task completed (int)
+    written: size of the anonymized image (int).
+    """
+
+    source: Path
+    output: Optional[Path]
+    anonymized_id: str
+    size: int = 0
+    mtime_ns: int = 0
+    error: str = ""
+    worker: str = ""
+    queue_depth: int = 0
+    written: int = 0
+
+
+def default_processes() -> int:
+    """
+    Get the default number of worker processes.
+
+    :return: number of CPUs available
+    """
+    return cpu_count()
+
+
+def iter_image_tasks(
+    patients: Iterable[Patient], output_dir: Path, input_dir: Optional[Path] = None
+) -> Iterator[ImageTask]:
+    """
+    Flatten patients into a single stream of image tasks.
+
+    Output paths are computed, and output directories created, once per directory.
+
+    :param patients: iterable of Patient objects
+    :param output_dir: Path of the output directory
+    :param input_dir: Path of the input directory, output paths keep the path relative to it
+    :return: iterator of ImageTask
+    """
+    for patient in patients:
+        for image, output in patient.iter_images(output_dir, input_dir):
+            yield ImageTask(patient, image, output)
+
+
+class PatientTracker:
+    """
+    Track the images in flight of each patient, to know when a patient is done.
+
+    Tasks may be generated by a different thread than the one collecting results.
+    """
+
+    def __init__(self) -> None:
+        """Create an empty tracker."""
+        self._lock = threading.Lock()
+        self._pending: Dict[str, int] = {}
+        self._patients: Dict[str, Patient] = {}
+        self._finished: List[Patient] = []
+
+    def track(
+        self,
+        patients: Iterable[Patient],
+        output_dir: Path,
+        skip: Optional[Callable[[Path], bool]] = None,
+    ) -> Iterator[ImageTask]:
+        """
+        Flatten patients into a single stream of image tasks, counting them.
+
+        :param patients: iterable of Patient objects
+        :param output_dir: Path of the output directory
+        :param skip: function telling whether an image must be skipped
+        :return: iterator of ImageTask
+        """
+        for patient in patients:
+            with self._lock:
+                self._pending[patient.anonymized_id] = 1
+                self._patients[patient.anonymized_id] = patient
+            for task in iter_image_tasks([patient], output_dir):
+                if skip is not None and skip(task.image):
+                    continue
+                with self._lock:
+                    self._pending[patient.anonymized_id] += 1
+                yield task
+            # all tasks have been generated: remove the extra count added above
+            self._done(patient.anonymized_id)
+
+    def _done(self, anonymized_id: str) -> None:
+        """
+        Decrease the count of images in flight of a patient.
+
+        :param anonymized_id: anonymized id of the patient
+        :return: None
+        """
+        with self._lock:
+            self._pending[anonymized_id] -= 1
+            if self._pending[anonymized_id] == 0:
+                del self._pending[anonymized_id]
+                self._finished.append(self._patients.pop(anonymized_id))
+
+    def finished(self, result: Optional[ImageResult] = None) -> List[Patient]:
+        """
+        Collect the patients with no images left.
+
+        :param result: result of a task, if any
+        :return: list of patients done since the previous call
+        """
+        if result is not None:
+            self._done(result.anonymized_id)
+        with self._lock:
+            finished, self._finished = self._finished, []
+        return finished
+
+
+def chunks(tasks: Iterable[ImageTask], size: int) -> Iterator[List[ImageTask]]:
+    """
+    Split the task stream into lists of at most size elements.
+
+    :param tasks: iterable of ImageTask
+    :param size: maximum length of each chunk
+    :return: iterator of lists of ImageTask
+    """
+    iterator = iter(tasks)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def run_task(only_directory: bool, hardlink: bool, task: ImageTask) -> ImageResult:
+    """
+    Anonymize the image of a single task.
+
+    :param only_directory: anonymize only the destination directory (bool)
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param task: ImageTask to be run
+    :return: ImageResult
+    """
+    anonymized_id = task.patient.anonymized_id
+    worker = str(os.getpid())
+    try:
+        stat = os.stat(task.image)
+    except OSError as e:
+        return ImageResult(task.image, None, anonymized_id, error=type(e).__name__, worker=worker)
+    try:
+        output = task.patient.write_file(task.image, task.output, only_directory, hardlink)
+        written = os.stat(output).st_size
+    except Exception as e:  # pylint: disable=broad-except
+        return ImageResult(
+            task.image,
+            None,
+            anonymized_id,
+            stat.st_size,
+            stat.st_mtime_ns,
+            type(e).__name__,
+            worker,
+        )
+    return ImageResult(
+        task.image,
+        output,
+        anonymized_id,
+        stat.st_size,
+        stat.st_mtime_ns,
+        worker=worker,
+        written=written,
+    )
+
+
+# thread pool owned by each worker process, created by _init_worker
+_worker_threads = None
+
+
+def _init_worker(threads: int) -> None:
+    """
+    Initialize a worker process.
+
+    :param threads: number of threads of the worker process
+    :return: None
+    """
+    global _worker_threads  # pylint: disable=global-statement
+    _worker_threads = ThreadPool(threads)
+
+
+class _Backlog:
+    """Count the images received by a worker and not yet done."""
+
+    def __init__(self, size: int = 0) -> None:
+        """
+        Create the counter.
+
+        :param size: number of images already received
+        """
+        self._lock = threading.Lock()
+        self._size = size
+
+    def add(self, tasks: Iterable[ImageTask]) -> Iterator[ImageTask]:
+        """
+        Count the tasks as they are taken.
+
+        :param tasks: iterable of ImageTask
+        :return: iterator of the same tasks
+        """
+        for task in tasks:
+            with self._lock:
+                self._size += 1
+            yield task
+
+    def run(self, only_directory: bool, hardlink: bool, task: ImageTask) -> ImageResult:
+        """
+        Run a task, reporting the images left in the queue of the worker.
+
+        :param only_directory: anonymize only the destination directory (bool)
+        :param hardlink: with only_directory, hard link images instead of copying them (bool)
+        :param task: ImageTask to be run
+        :return: ImageResult
+        """
+        result = run_task(only_directory, hardlink, task)
+        with self._lock:
+            self._size -= 1
+            size = self._size
+        return result._replace(queue_depth=size)
+
+
+def _run_chunk(only_directory: bool, hardlink: bool, chunk: List[ImageTask]) -> List[ImageResult]:
+    """
+    Run a chunk of tasks on the thread pool of the current worker process.
+
+    :param only_directory: anonymize only the destination directory (bool)
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param chunk: list of ImageTask
+    :return: list of ImageResult
+    """
+    backlog = _Backlog(len(chunk))
+    return _worker_threads.map(partial(backlog.run, only_directory, hardlink), chunk)
+
+
+def _run_timed(
+    run: Callable[[ImageTask], ImageResult], task: ImageTask
+) -> Tuple[ImageResult, float]:
+    """
+    Run a single task, measuring its duration.
+
+    :param run: function running a task
+    :param task: ImageTask to be run
+    :return: ImageResult and time spent on the task
+    """
+    start = time.monotonic()
+    result = run(task)
+    return result, time.monotonic() - start
+
+
+def _run_serially(
+    run: Callable[[ImageTask], ImageResult], tasks: List[ImageTask]
+) -> List[Tuple[ImageResult, float]]:
+    """
+    Run tasks one after the other, measuring their duration.
+
+    :param run: function running a task
+    :param tasks: list of ImageTask
+    :return: list of ImageResult and time spent on each task
+    """
+    return [_run_timed(run, task) for task in tasks]
+
+
+def _run_chunk_limited(
+    only_directory: bool, hardlink: bool, item: Tuple[List[ImageTask], int]
+) -> Tuple[List[ImageResult], float]:
+    """
+    Run a chunk of tasks using at most a given number of threads of the worker process.
+
+    :param only_directory: anonymize only the destination directory (bool)
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param item: list of ImageTask and number of threads
+    :return: list of ImageResult and total time spent on its tasks
+    """
+    chunk, threads = item
+    run = partial(_Backlog(len(chunk)).run, only_directory, hardlink)
+    groups = [chunk[i::threads] for i in range(min(threads, len(chunk)))]
+    timed = [
+        pair for group in _worker_threads.map(partial(_run_serially, run), groups) for pair in group
+    ]
+    return [result for result, _ in timed], sum(seconds for _, seconds in timed)
+
+
+def imap_bounded(
+    pool: Pool,
+    function: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_in_flight: Union[int, Callable[[], int]],
+) -> Iterator[Any]:
+    """
+    Apply function to every item on a pool, with at most max_in_flight items submitted.
+
+    Unlike Pool.imap_unordered, items are taken from the iterable only when there is room
+    for them: a slow consumer stops the producer, and memory does not grow with the number
+    of items. Results are yielded as soon as they are available, in no particular order.
+
+    :param pool: process or thread pool
+    :param function: function to be applied
+    :param items: iterable of arguments of function
+    :param max_in_flight: maximum number of items submitted but not yet yielded, or function
+        returning it, read before submitting each item
+    :return: iterator of results
+    """
+    done = queue.Queue()
+    in_flight = 0
+    limit = max_in_flight if callable(max_in_flight) else lambda: max_in_flight
+
+    def collect() -> Any:
+        result = done.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    for item in items:
+        pool.apply_async(function, (item,), callback=done.put, error_callback=done.put)
+        in_flight += 1
+        while in_flight >= max(limit(), 1) or (in_flight and not done.empty()):
+            in_flight -= 1
+            yield collect()
+    while in_flight:
+        in_flight -= 1
+        yield collect()
+
+
+def imap_ordered(
+    pool: Pool, function: Callable[[Any], Any], items: Iterable[Any], max_in_flight: int
+) -> Iterator[Any]:
+    """
+    Apply function to every item on a pool, yielding results in the order of the items.
+
+    At most max_in_flight items are submitted but not yet yielded, as in imap_bounded.
+
+    :param pool: process or thread pool
+    :param function: function to be applied
+    :param items: iterable of arguments of function
+    :param max_in_flight: maximum number of items submitted but not yet yielded
+    :return: iterator of results
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_results(
+    tasks: Iterable[ImageTask],
+    only_directory: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    hardlink: bool = False,
+    max_in_flight: Optional[int] = None,
+    controller: Optional[AdaptiveController] = None,
+) -> Iterator[ImageResult]:
+    """
+    Run all tasks on a bounded pool of processes, each one with a bounded pool of threads.
+
+    Results are yielded as soon as they are available, in no particular order. Tasks are
+    consumed only when a worker is about to be free, so tasks can be generated while the
+    input is still being discovered.
+
+    With a controller, pools are created with the largest number of processes and threads
+    and the controller chooses how many of them are used, measuring the throughput.
+
+    :param tasks: iterable of ImageTask
+    :param only_directory: anonymize only the destination directory (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param threads: number of threads per worker process
+    :param chunk_size: number of tasks sent to a worker process at once
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param max_in_flight: chunks (images with a single process) submitted at once
+    :param controller: AdaptiveController choosing the processes and threads in use
+    :return: iterator of ImageResult
+    """
+    if processes is None:
+        processes = default_processes()
+    if threads is None:
+        threads = DEFAULT_THREADS
+    processes = max(processes, 1)
+    threads = max(threads, 1)
+
+    if controller is not None:
+        yield from _iter_adaptive_results(
+            tasks, only_directory, processes, chunk_size, hardlink, controller
+        )
+    elif processes == 1 and threads == 1:
+        for task in tasks:
+            yield run_task(only_directory, hardlink, task)
+    elif processes == 1:
+        if max_in_flight is None:
+            max_in_flight = IN_FLIGHT_PER_WORKER * threads
+        backlog = _Backlog()
+        with ThreadPool(threads) as p:
+            yield from imap_bounded(
+                p,
+                partial(backlog.run, only_directory, hardlink),
+                backlog.add(tasks),
+                max(max_in_flight, 1),
+            )
+    else:
+        if max_in_flight is None:
+            max_in_flight = IN_FLIGHT_PER_WORKER * processes
+        with Pool(processes, initializer=_init_worker, initargs=(threads,)) as p:
+            for results in imap_bounded(
+                p,
+                partial(_run_chunk, only_directory, hardlink),
+                chunks(tasks, chunk_size),
+                max(max_in_flight, 1),
+            ):
+                yield from results
+
+
+def _iter_adaptive_results(
+    tasks: Iterable[ImageTask],
+    only_directory: bool,
+    processes: int,
+    chunk_size: int,
+    hardlink: bool,
+    controller: AdaptiveController,
+) -> Iterator[ImageResult]:
+    """
+    Run all tasks, letting the controller choose the processes and threads in use.
+
+    :param tasks: iterable of ImageTask
+    :param only_directory: anonymize only the destination directory (bool)
+    :param processes: largest number of worker processes
+    :param chunk_size: number of tasks sent to a worker process at once
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param controller: AdaptiveController
+    :return: iterator of ImageResult
+    """
+    if processes == 1:
+        backlog = _Backlog()
+        with ThreadPool(MAX_THREADS) as p:
+            for result, seconds in imap_bounded(
+                p,
+                partial(_run_timed, partial(backlog.run, only_directory, hardlink)),
+                backlog.add(tasks),
+                lambda: controller.threads,
+            ):
+                controller.observe(1, seconds)
+                yield result
+    else:
+        with Pool(processes, initializer=_init_worker, initargs=(MAX_THREADS,)) as p:
+            for results, seconds in imap_bounded(
+                p,
+                partial(_run_chunk_limited, only_directory, hardlink),
+                ((chunk, controller.threads) for chunk in chunks(tasks, chunk_size)),
+                lambda: controller.processes,
+            ):
+                controller.observe(len(results), seconds)
+                yield from results
+    if controller.log is not None:
+        controller.log(f"Adaptive concurrency settled on {controller.summary()}")
+
+
+def run_tasks(
+    tasks: Iterable[ImageTask],
+    only_directory: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    hardlink: bool = False,
+    metrics: Optional[Metrics] = None,
+) -> None:
+    """
+    Run all tasks on a bounded pool of processes, each one with a bounded pool of threads.
+
+    :param tasks: iterable of ImageTask
+    :param only_directory: anonymize only the destination directory (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param threads: number of threads per worker process
+    :param chunk_size: number of tasks sent to a worker process at once
+    :param hardlink: with only_directory, hard link images instead of copying them (bool)
+    :param metrics: Metrics collecting the results
+    :return: None
+    """
+    if metrics is None:
+        metrics = Metrics()
+    for result in iter_results(
+        metrics.queued(tasks), only_directory, processes, threads, chunk_size, hardlink
+    ):
+        metrics.record(result)
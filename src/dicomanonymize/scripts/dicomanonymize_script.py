@@ -3,9 +3,93 @@
 import argparse
 import os.path
 from pathlib import Path
+import sys
 import time
+from typing import Tuple
 
-from dicomanonymize.functions import anonymize
+from dicomanonymize.metrics import PROGRESS_INTERVAL, Metrics, format_progress
+from dicomanonymize.pseudonym import DEFAULT_ID_SPACE, KEY_NAME
+from dicomanonymize.rules import DEFAULT_PROFILE, PROFILES
+from dicomanonymize.table import (
+    TABLE_FORMATS,
+    TABLE_NAME,
+    conversion_table_path,
+    merge_conversion_tables,
+    table_format_of,
+)
+from dicomanonymize.uids import read_uid_map
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parse a shard specification.
+
+    :param value: "i/N", with i from 0 to N - 1
+    :return: (i, N)
+    """
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}: expected i/N") from e
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}: i must be in [0, N)")
+    return shard, shards
+
+
+def parse_profile(value: str) -> str:
+    """
+    Check a de-identification profile.
+
+    :param value: name of a built-in profile, or path of a JSON profile
+    :return: value
+    """
+    if value not in PROFILES and not os.path.isfile(value):
+        raise argparse.ArgumentTypeError(
+            f"Unknown profile {value}: expected one of {', '.join(PROFILES)} or a JSON file"
+        )
+    return value
+
+
+def add_profile_argument(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the --profile and --uid_map options to a parser.
+
+    :param arg_parser: ArgumentParser
+    :return: None
+    """
+    arg_parser.add_argument(
+        "--profile",
+        help="De-identification profile: basic (patient information replaced with the"
+        + " anonymized id), ps3.15 (DICOM PS3.15 Basic Profile: also removes private"
+        + " elements and descriptions and remaps UIDs with the key), ps3.15-dates (ps3.15"
+        + f" with shifted dates), or a JSON profile (default: {DEFAULT_PROFILE})",
+        type=parse_profile,
+        default=DEFAULT_PROFILE,
+    )
+    arg_parser.add_argument(
+        "--uid_map",
+        help="Directory where the UIDs remapped by the profile are recorded, one file per"
+        + " process, for audit lookups with the uid command",
+        type=Path,
+    )
+
+
+def add_deflate_argument(arg_parser: argparse.ArgumentParser) -> None:
+    """
+    Add the --deflate option to a parser.
+
+    :param arg_parser: ArgumentParser
+    :return: None
+    """
+    arg_parser.add_argument(
+        "--deflate",
+        help="Write images with the Deflated Explicit VR Little Endian transfer syntax, at this"
+        + " zlib compression level (0-9); images with compressed pixel data (JPEG, RLE...)"
+        + " keep their transfer syntax",
+        type=int,
+        choices=range(10),
+        metavar="LEVEL",
+    )
 
 
 def parse_args(args=None):
@@ -15,18 +99,22 @@ def parse_args(args=None):
     :param args: already parsed args
     :return: arguments
     """
+    # pylint: disable=import-outside-toplevel
+    from dicomanonymize.dedup import DEDUP_METHODS, DEDUP_POLICIES
+    from dicomanonymize.functions import BACKENDS
+
     arg_parser = argparse.ArgumentParser(__doc__)
 
     arg_parser.add_argument(
         "-i",
         "--input_directory",
-        help="Input path for the original files",
+        help="Input path for the original files (directory, ZIP or TAR archive)",
         type=Path,
     )
     arg_parser.add_argument(
         "-o",
         "--output_directory",
-        help="Input path for the new files",
+        help="Output path for the new files (directory, or .zip, .tar, .tar.gz... archive)",
         type=Path,
     )
     arg_parser.add_argument(
@@ -35,24 +123,406 @@ def parse_args(args=None):
         help="Anonymize only destination directories",
         action="store_true",
     )
+    arg_parser.add_argument(
+        "-l",
+        "--hardlink",
+        help="With -d, hard link files instead of copying them",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--index",
+        help="Discovery index file: later runs probe only changed directories",
+        type=Path,
+    )
+    arg_parser.add_argument(
+        "--journal",
+        help="Journal of anonymized images, written only when given as it lists their source"
+        + " paths; with --shard, each shard adds its name to it",
+        type=Path,
+    )
+    arg_parser.add_argument(
+        "--resume",
+        help="Skip images already anonymized according to the journal (requires --journal)",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--key",
+        help="Secret key of the anonymized ids: the same key gives the same ids (default: the"
+        + f" key kept in {KEY_NAME} next to the conversion table, random on the first run)",
+    )
+    arg_parser.add_argument(
+        "--id_space",
+        help=f"Number of possible anonymized ids (default: {DEFAULT_ID_SPACE})",
+        type=int,
+        default=DEFAULT_ID_SPACE,
+    )
+    add_profile_argument(arg_parser)
+    add_deflate_argument(arg_parser)
+    arg_parser.add_argument(
+        "--dedup",
+        help="Anonymize repeated images once: uid finds the images of a patient with the same"
+        + " SOPInstanceUID, content the images with the same bytes",
+        choices=DEDUP_METHODS,
+    )
+    arg_parser.add_argument(
+        "--dedup_policy",
+        help="With --dedup, hard link repeated images to the first one, copy it, or skip them"
+        + " (default: link)",
+        choices=DEDUP_POLICIES,
+        default="link",
+    )
+    arg_parser.add_argument(
+        "--table_format",
+        help="Format of the conversion table (arrow and parquet require pyarrow)",
+        choices=TABLE_FORMATS,
+        default="csv",
+    )
+    arg_parser.add_argument(
+        "--table_compression",
+        help="Compression of the conversion table (gzip, bz2, xz for csv tables)",
+    )
     arg_parser.add_argument(
         "-s",
         "--single_thread",
         help="Run on single thread (slower but more robust)",
         action="store_true",
     )
+    arg_parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of worker processes (default: number of CPUs)",
+        type=int,
+    )
+    arg_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of threads per worker process",
+        type=int,
+    )
+    arg_parser.add_argument(
+        "-a",
+        "--adaptive",
+        help="Adjust processes and threads to the measured throughput, printing the settings"
+        + " chosen (-p is then the largest number of processes)",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--backend",
+        help="Execution backend: pool of processes anonymizing whole images, or pipeline of"
+        + " read, header rewriting and write stages (default: pool)",
+        choices=BACKENDS,
+        default="pool",
+    )
+
+    arg_parser.add_argument(
+        "--shard",
+        help="Anonymize only the i-th of N sets of patients (i from 0 to N-1), see merge",
+        type=parse_shard,
+    )
+    arg_parser.add_argument(
+        "--progress",
+        help=f"Seconds between progress lines, 0 to disable (default: {PROGRESS_INTERVAL})",
+        type=float,
+        default=PROGRESS_INTERVAL,
+    )
+    arg_parser.add_argument(
+        "--metrics",
+        help="Metrics file of the run: Prometheus text format for .prom files, JSON otherwise",
+        type=Path,
+    )
 
     args = arg_parser.parse_args(args)
+    if args.resume and args.journal is None:
+        arg_parser.error("--resume requires --journal")
 
     return args
 
 
+def print_progress(snapshot: dict) -> None:
+    """
+    Print a progress line, overwriting the previous one on terminals.
+
+    :param snapshot: metrics snapshot
+    :return: None
+    """
+    if sys.stdout.isatty():
+        print(f"\r{format_progress(snapshot)}\033[K", end="", flush=True)
+    else:
+        print(format_progress(snapshot), flush=True)
+
+
+def merge(args=None) -> None:
+    """
+    Merge the conversion tables of the shards of a run.
+
+    :param args: command line arguments following "merge"
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser(
+        "dicomanonymize merge",
+        description=f"Merge the {TABLE_NAME}* conversion tables of a directory, in any format",
+    )
+    arg_parser.add_argument("directory", help="Directory containing the tables", type=Path)
+    arg_parser.add_argument(
+        "-o",
+        "--output",
+        help="Merged table, whose extension gives its format"
+        + f" (default: DIRECTORY/{TABLE_NAME}.csv)",
+        type=Path,
+    )
+    arguments = arg_parser.parse_args(args)
+
+    tables = sorted(
+        path
+        for path in arguments.directory.glob(f"{TABLE_NAME}*")
+        if table_format_of(path) is not None
+    )
+    output = arguments.output
+    if output is None:
+        output = conversion_table_path(arguments.directory)
+        if output is None:
+            sys.exit("Cannot find a unique name for the merged table")
+    tables = [table for table in tables if table != output]
+    if not tables:
+        sys.exit(f"No conversion tables found in {arguments.directory}")
+
+    conflicts = merge_conversion_tables(tables, output)
+    print(f"Merged {len(tables)} tables into {output}")
+    for conflict in conflicts:
+        print(f"Conflict: {conflict}")
+    if conflicts:
+        sys.exit(1)
+
+
+def uid(args=None) -> None:
+    """
+    Find the original UIDs of remapped UIDs in the files written with --uid_map.
+
+    :param args: command line arguments following "uid"
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser(
+        "dicomanonymize uid", description="Print the original UIDs of remapped UIDs"
+    )
+    arg_parser.add_argument("uid_map", help="Directory given to --uid_map", type=Path)
+    arg_parser.add_argument("uids", help="Remapped UIDs", nargs="+")
+    arguments = arg_parser.parse_args(args)
+
+    originals = read_uid_map(arguments.uid_map)
+    missing = False
+    for remapped in arguments.uids:
+        original = originals.get(remapped)
+        if original is None:
+            missing = True
+            original = "not found"
+        print(f"{remapped} {original}")
+    if missing:
+        sys.exit(1)
+
+
+def watch(args=None) -> None:
+    """
+    Anonymize the images written to a directory as soon as they are complete, until killed.
+
+    :param args: command line arguments following "watch"
+    :return: None
+    """
+    # pylint: disable=import-outside-toplevel
+    from dicomanonymize.watch import POLL_INTERVAL, SETTLE_TIME, WATCH_JOURNAL
+    from dicomanonymize.watch import watch as watch_directory
+
+    arg_parser = argparse.ArgumentParser(
+        "dicomanonymize watch",
+        description="Anonymize the directories of images written to INPUT once they have not"
+        + " changed for the settle time, appending new patients to the conversion table",
+    )
+    arg_parser.add_argument("input_directory", help="Watched directory", type=Path)
+    arg_parser.add_argument(
+        "output_directory", help="Output directory, outside the watched one", type=Path
+    )
+    arg_parser.add_argument(
+        "--settle",
+        help=f"Seconds without changes before a directory is anonymized (default: {SETTLE_TIME})",
+        type=float,
+        default=SETTLE_TIME,
+    )
+    arg_parser.add_argument(
+        "--poll",
+        help=f"Seconds between checks of the watched directories (default: {POLL_INTERVAL})",
+        type=float,
+        default=POLL_INTERVAL,
+    )
+    arg_parser.add_argument(
+        "--polling",
+        help="Compare directory modification times instead of using inotify",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-d",
+        "--destination_directories",
+        help="Anonymize only destination directories",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--hardlink",
+        help="With -d, hard link files instead of copying them",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--journal",
+        help=f"Journal of anonymized images (default: OUTPUT/{WATCH_JOURNAL})",
+        type=Path,
+    )
+    arg_parser.add_argument(
+        "--key",
+        help=f"Secret key of the anonymized ids (default: the key kept in OUTPUT/{KEY_NAME})",
+    )
+    arg_parser.add_argument(
+        "--id_space",
+        help=f"Number of possible anonymized ids (default: {DEFAULT_ID_SPACE})",
+        type=int,
+        default=DEFAULT_ID_SPACE,
+    )
+    add_profile_argument(arg_parser)
+    add_deflate_argument(arg_parser)
+    arg_parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of worker processes (default: number of CPUs)",
+        type=int,
+    )
+    arg_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of threads per worker process",
+        type=int,
+    )
+    arguments = arg_parser.parse_args(args)
+
+    try:
+        watch_directory(
+            arguments.input_directory,
+            arguments.output_directory,
+            destination_directories=arguments.destination_directories,
+            processes=arguments.processes,
+            threads=arguments.threads,
+            hardlink=arguments.hardlink,
+            journal=arguments.journal,
+            key=arguments.key,
+            id_space=arguments.id_space,
+            settle=arguments.settle,
+            poll_interval=arguments.poll,
+            inotify=not arguments.polling,
+            profile=arguments.profile,
+            uid_map=arguments.uid_map,
+            deflate_level=arguments.deflate,
+        )
+    except ValueError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+def receive(args=None) -> None:
+    """
+    Receive images over DICOM C-STORE, writing only their anonymized version, until killed.
+
+    :param args: command line arguments following "receive"
+    :return: None
+    """
+    # pylint: disable=import-outside-toplevel
+    from dicomanonymize.receiver import (
+        DEFAULT_AE_TITLE,
+        DEFAULT_PORT,
+        DEFAULT_WORKERS,
+        MAX_ASSOCIATIONS,
+        StoreReceiver,
+    )
+
+    arg_parser = argparse.ArgumentParser(
+        "dicomanonymize receive",
+        description="Storage SCP anonymizing the images it receives in memory, appending new"
+        + " patients to the conversion table (requires pynetdicom)",
+    )
+    arg_parser.add_argument("output_directory", help="Output directory", type=Path)
+    arg_parser.add_argument(
+        "--port", help=f"TCP port (default: {DEFAULT_PORT})", type=int, default=DEFAULT_PORT
+    )
+    arg_parser.add_argument("--address", help="Address to listen on (default: all)", default="")
+    arg_parser.add_argument(
+        "--ae_title",
+        help=f"Application entity title (default: {DEFAULT_AE_TITLE})",
+        default=DEFAULT_AE_TITLE,
+    )
+    arg_parser.add_argument(
+        "-t",
+        "--threads",
+        help=f"Images anonymized at once (default: {DEFAULT_WORKERS})",
+        type=int,
+        default=DEFAULT_WORKERS,
+    )
+    arg_parser.add_argument(
+        "--max_associations",
+        help=f"Associations accepted at once (default: {MAX_ASSOCIATIONS})",
+        type=int,
+        default=MAX_ASSOCIATIONS,
+    )
+    arg_parser.add_argument(
+        "--key",
+        help=f"Secret key of the anonymized ids (default: the key kept in OUTPUT/{KEY_NAME})",
+    )
+    arg_parser.add_argument(
+        "--id_space",
+        help=f"Number of possible anonymized ids (default: {DEFAULT_ID_SPACE})",
+        type=int,
+        default=DEFAULT_ID_SPACE,
+    )
+    add_profile_argument(arg_parser)
+    arguments = arg_parser.parse_args(args)
+
+    try:
+        receiver = StoreReceiver(
+            arguments.output_directory,
+            key=arguments.key,
+            id_space=arguments.id_space,
+            ae_title=arguments.ae_title,
+            workers=arguments.threads,
+            max_associations=arguments.max_associations,
+            profile=arguments.profile,
+            uid_map=arguments.uid_map,
+        )
+    except ImportError as e:
+        sys.exit(str(e))
+    with receiver:
+        try:
+            receiver.start(arguments.address, arguments.port, block=True)
+        except KeyboardInterrupt:
+            print("Stopped")
+
+
 def main():
     """
     Main function.
 
     :return: None
     """
+    if sys.argv[1:2] == ["merge"]:
+        merge(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["uid"]:
+        uid(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["watch"]:
+        watch(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["receive"]:
+        receive(sys.argv[2:])
+        return
+    # the subcommands above import only the modules they need
+    # pylint: disable=import-outside-toplevel
+    from dicomanonymize.functions import anonymize
+
     anonymize_patients_start = time.time()
 
     arguments = parse_args()
@@ -68,13 +538,43 @@ def main():
         # if no output directory is specified, default to current working directory
         print(f"Using {input_dir} as output directory")
         output_dir = input_dir
+    # source paths contain patient names: the journal is written only when requested
+    journal = arguments.journal
+    if journal is not None and arguments.shard is not None:
+        # shards may share the journal path: each one needs its own journal
+        shard, shards = arguments.shard
+        journal = journal.with_name(f"{journal.stem}-shard-{shard}-of-{shards}{journal.suffix}")
+    metrics = Metrics(print_progress, arguments.progress) if arguments.progress > 0 else Metrics()
 
     anonymize(
         input_dir,
         output_dir,
         parallel=not arguments.single_thread,
         destination_directories=arguments.destination_directories,
+        processes=arguments.processes,
+        threads=arguments.threads,
+        hardlink=arguments.hardlink,
+        index=arguments.index,
+        journal=journal,
+        resume=arguments.resume,
+        key=arguments.key,
+        id_space=arguments.id_space,
+        table_format=arguments.table_format,
+        table_compression=arguments.table_compression,
+        metrics=metrics,
+        shard=arguments.shard,
+        adaptive=arguments.adaptive,
+        backend=arguments.backend,
+        profile=arguments.profile,
+        uid_map=arguments.uid_map,
+        dedup=arguments.dedup,
+        dedup_policy=arguments.dedup_policy,
+        deflate_level=arguments.deflate,
     )
+    if arguments.progress > 0 and sys.stdout.isatty():
+        print()
+    if arguments.metrics is not None:
+        metrics.write(arguments.metrics)
 
     anonymize_patients_final = time.time()
     print(f"> Anonymize_Patients took: {anonymize_patients_final - anonymize_patients_start:.4}s")
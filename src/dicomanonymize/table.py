@@ -0,0 +1,309 @@
+"""Streaming writer of the conversion table."""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import bz2
+import csv
+import datetime
+import gzip
+import lzma
+import os
+
+from .classes import Patient, VALUES_TO_ANONYMIZE
+
+from pathlib import Path
+
+
+TABLE_NAME = "Anonymization"
+TABLE_COLUMNS = ["anonymized_id"] + VALUES_TO_ANONYMIZE
+TABLE_FORMATS = ["csv", "arrow", "parquet"]
+CSV_COMPRESSIONS = {
+    "gzip": (gzip.open, ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "xz": (lzma.open, ".xz"),
+}
+# number of rows buffered before writing a columnar batch
+BATCH_SIZE = 1000
+
+
+def conversion_table_path(
+    output_directory: Path,
+    table_format: str = "csv",
+    compression: Optional[str] = None,
+    name: str = TABLE_NAME,
+) -> Optional[Path]:
+    """
+    Find a unique name for the conversion table.
+
+    :param output_directory: Path of the output directory
+    :param table_format: one of TABLE_FORMATS
+    :param compression: compression of csv tables (gzip, bz2 or xz)
+    :param name: name of the table, without extension
+    :return: Path of the conversion table, None if no unique name is available
+    """
+    extension = f".{table_format}"
+    if table_format == "csv" and compression is not None:
+        extension += CSV_COMPRESSIONS[compression][1]
+
+    path = output_directory / f"{name}{extension}"
+    if path.exists():
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        path = output_directory / f"{name}-{timestamp}{extension}"
+        if path.exists():
+            return None
+    return path
+
+
+def shard_table_name(shard: int, shards: int) -> str:
+    """
+    Name of the conversion table of a shard.
+
+    :param shard: shard index
+    :param shards: number of shards
+    :return: name of the table, without extension
+    """
+    return f"{TABLE_NAME}-shard-{shard}-of-{shards}"
+
+
+def patient_row(patient: Patient) -> Dict[str, Any]:
+    """
+    Row of the conversion table for a patient.
+
+    :param patient: Patient object
+    :return: dictionary with an entry for each column
+    """
+    row = {"anonymized_id": patient.anonymized_id}
+    for val in VALUES_TO_ANONYMIZE:
+        row[val] = patient.patient_data[val]
+    return row
+
+
+class ConversionTableWriter:
+    """
+    Append patients to the conversion table as soon as they are anonymized.
+
+    Memory usage does not depend on the number of patients. Csv tables are flushed after
+    every row and arrow (IPC stream) tables after every batch, so both stay readable if
+    the run is interrupted; parquet tables are valid only once closed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        table_format: str = "csv",
+        compression: Optional[str] = None,
+        columns: Optional[List[str]] = None,
+        append: bool = False,
+    ) -> None:
+        """
+        Create the conversion table.
+
+        :param path: Path of the table
+        :param table_format: one of TABLE_FORMATS
+        :param compression: gzip, bz2 or xz for csv tables, any pyarrow codec otherwise
+        :param columns: names of the columns, TABLE_COLUMNS by default
+        :param append: append rows to an existing csv table, writing the header only if the
+            table is new
+        """
+        if table_format not in TABLE_FORMATS:
+            raise ValueError(f"Unknown table format {table_format}")
+        if append and table_format != "csv":
+            raise ValueError(f"Rows cannot be appended to {table_format} tables")
+        self.path = path
+        self.table_format = table_format
+        self.columns = TABLE_COLUMNS if columns is None else columns
+        self._rows = []
+        self._writer = None
+
+        if table_format == "csv":
+            new = not append or not path.exists() or path.stat().st_size == 0
+            mode = "a" if append else "w"
+            if compression is None:
+                self._file = open(path, mode, newline="")  # pylint: disable=consider-using-with
+            else:
+                # compressed streams can be concatenated
+                self._file = CSV_COMPRESSIONS[compression][0](path, f"{mode}t", newline="")
+            self._writer = csv.writer(self._file, lineterminator=os.linesep)
+            if new:
+                self._writer.writerow(self.columns)
+                self._file.flush()
+            return
+
+        try:
+            import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ImportError(
+                f"Writing {table_format} tables requires pyarrow: pip install pyarrow"
+            ) from e
+        self._schema = pa.schema([(column, pa.string()) for column in self.columns])
+        if table_format == "arrow":
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self._writer = pa.ipc.new_stream(str(path), self._schema, options=options)
+        else:
+            import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+            self._writer = pq.ParquetWriter(
+                str(path), self._schema, compression=compression or "snappy"
+            )
+
+    def write_row(self, row: Dict[str, Any]) -> None:
+        """
+        Append a row to the table.
+
+        :param row: dictionary with an entry for each column
+        :return: None
+        """
+        if self.table_format == "csv":
+            self._writer.writerow([str(row[column]) for column in self.columns])
+            self._file.flush()
+            return
+
+        self._rows.append(
+            [None if row[column] is None else str(row[column]) for column in self.columns]
+        )
+        if len(self._rows) >= BATCH_SIZE:
+            self.flush()
+
+    def write_patient(self, patient: Patient) -> None:
+        """
+        Append a patient to the table.
+
+        :param patient: Patient object
+        :return: None
+        """
+        self.write_row(patient_row(patient))
+
+    def flush(self) -> None:
+        """
+        Write buffered rows.
+
+        :return: None
+        """
+        if self.table_format == "csv" or not self._rows:
+            return
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(list(column), pa.string()) for column in zip(*self._rows)],
+            schema=self._schema,
+        )
+        self._writer.write_batch(batch)
+        self._rows = []
+
+    def close(self) -> None:
+        """
+        Write buffered rows and close the table.
+
+        :return: None
+        """
+        self.flush()
+        if self.table_format == "csv":
+            self._file.close()
+        else:
+            self._writer.close()
+
+    def __enter__(self) -> "ConversionTableWriter":
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the table when leaving the context."""
+        self.close()
+
+
+def table_format_of(path: Path) -> Optional[str]:
+    """
+    Format of a conversion table, from its name.
+
+    :param path: Path of the table
+    :return: one of TABLE_FORMATS, None if path is not a conversion table name
+    """
+    name = path.name
+    if name.endswith(".csv") or any(
+        name.endswith(f".csv{extension}") for _, extension in CSV_COMPRESSIONS.values()
+    ):
+        return "csv"
+    for table_format in TABLE_FORMATS:
+        if name.endswith(f".{table_format}"):
+            return table_format
+    return None
+
+
+def read_conversion_table(path: Path) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Read the rows of a conversion table in any of TABLE_FORMATS, possibly compressed.
+
+    :param path: Path of the table
+    :return: iterator of dictionaries with an entry for each column
+    """
+    table_format = table_format_of(path)
+    if table_format in ("arrow", "parquet"):
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+        if table_format == "arrow":
+            with pa.OSFile(str(path)) as source:
+                for batch in pa.ipc.open_stream(source):
+                    yield from batch.to_pylist()
+        else:
+            for batch in pq.ParquetFile(str(path)).iter_batches():
+                yield from batch.to_pylist()
+        return
+
+    opener = open
+    for compression, extension in CSV_COMPRESSIONS.values():
+        if path.name.endswith(f".csv{extension}"):
+            opener = compression
+    with opener(path, "rt", newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def merge_conversion_tables(paths: Iterable[Path], output_path: Path) -> List[str]:
+    """
+    Merge the conversion tables of several runs, such as the shards of a single run.
+
+    Tables can be in any of TABLE_FORMATS, the merged one is written in the format given
+    by its name. Rows appearing in more than one table are written once. A conflict is
+    a PatientID with more than one anonymized id, or an anonymized id given to more than
+    one PatientID.
+
+    :param paths: Paths of the tables
+    :param output_path: Path of the merged table
+    :return: descriptions of the conflicts found, empty if the tables are consistent
+    """
+    rows = {}
+    columns = None
+    anonymized_ids: Dict[str, str] = {}
+    patient_ids: Dict[str, str] = {}
+    conflicts = []
+    for path in paths:
+        for row in read_conversion_table(path):
+            if columns is None:
+                columns = list(row)
+            key = tuple(row.values())
+            if key in rows:
+                continue
+            rows[key] = row
+            patient_id, anonymized_id = row["PatientID"], row["anonymized_id"]
+            previous = anonymized_ids.setdefault(patient_id, anonymized_id)
+            if previous != anonymized_id:
+                conflicts.append(
+                    f"PatientID {patient_id} has anonymized ids {previous} and {anonymized_id}"
+                    + f" ({path.name})"
+                )
+            previous = patient_ids.setdefault(anonymized_id, patient_id)
+            if previous != patient_id:
+                conflicts.append(
+                    f"Anonymized id {anonymized_id} is given to PatientIDs {previous} and"
+                    + f" {patient_id} ({path.name})"
+                )
+
+    compression = None
+    for name, (_, extension) in CSV_COMPRESSIONS.items():
+        if output_path.name.endswith(f".csv{extension}"):
+            compression = name
+    with ConversionTableWriter(
+        output_path, table_format_of(output_path) or "csv", compression, columns or TABLE_COLUMNS
+    ) as table:
+        for row in rows.values():
+            table.write_row(row)
+    return conflicts
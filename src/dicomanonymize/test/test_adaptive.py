@@ -0,0 +1,35 @@
+"""Test the adaptive concurrency controller."""
+
+from pathlib import Path
+
+from dicomanonymize import iter_anonymize
+from dicomanonymize.adaptive import AdaptiveController
+
+
+def test_controller_climbs_to_best_settings(monkeypatch):
+    """The controller must settle where the throughput stops improving."""
+    clock = [0.0]
+    monkeypatch.setattr("dicomanonymize.adaptive.time.monotonic", lambda: clock[0])
+    messages = []
+    controller = AdaptiveController(4, 64, processes=1, threads=2, log=messages.append)
+
+    def throughput(settings):
+        # threads help up to 16, processes up to 3
+        return min(settings["threads"], 16) * min(settings["processes"], 3)
+
+    for _ in range(40):
+        clock[0] += controller.interval
+        controller.observe(int(throughput(controller.settings()) * controller.interval))
+
+    assert controller.summary() == "--processes 3 --threads 16"
+    assert messages
+
+
+def test_adaptive_run(tmp_path):
+    """Adaptive runs must anonymize every image."""
+    named_dir = Path(__file__).parent / "Named"
+    for processes in (1, 2):
+        output = tmp_path / str(processes)
+        results = list(iter_anonymize(named_dir, output, processes=processes, adaptive=True))
+        assert results and all(result.output is not None for result in results)
+        assert len(list(output.glob("*/*/*.dcm"))) == len(results)
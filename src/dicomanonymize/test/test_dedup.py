@@ -0,0 +1,66 @@
+"""Test the deduplication of repeated images."""
+
+import shutil
+
+import pytest
+
+from dicomanonymize.functions import iter_anonymize
+from dicomanonymize.metrics import Metrics
+
+from .test_fileio import create_image
+
+
+KEY = b"test key"
+
+
+def create_input(input_dir):
+    """Create a study of 3 images, sent twice, and a study of a single image."""
+    study = input_dir / "ROSSI^MARIO" / "study"
+    study.mkdir(parents=True)
+    for index in range(3):
+        create_image(study / f"{index}.dcm")
+    shutil.copytree(study, input_dir / "ROSSI^MARIO" / "resent")
+    (input_dir / "ROSSI^MARIO" / "other").mkdir()
+    create_image(input_dir / "ROSSI^MARIO" / "other" / "0.dcm")
+
+
+@pytest.mark.parametrize(
+    "method, policy", [("uid", "link"), ("content", "copy"), ("content", "skip")]
+)
+def test_dedup(tmp_path, method, policy):
+    """Repeated images must be anonymized once, with the same outputs as without dedup."""
+    input_dir = tmp_path / "input"
+    create_input(input_dir)
+
+    expected = {}
+    for result in iter_anonymize(input_dir, tmp_path / "plain", processes=1, key=KEY):
+        expected[result.source] = result.output.read_bytes()
+
+    metrics = Metrics()
+    results = list(
+        iter_anonymize(
+            input_dir,
+            tmp_path / "output",
+            processes=1,
+            key=KEY,
+            metrics=metrics,
+            dedup=method,
+            dedup_policy=policy,
+        )
+    )
+    assert sorted(result.source for result in results) == sorted(expected)
+    for result in results:
+        assert result.output.read_bytes() == expected[result.source]
+    snapshot = metrics.snapshot()
+    assert snapshot["duplicates"] == 3
+    assert snapshot["bytes_saved"] == sum(
+        path.stat().st_size for path in (input_dir / "ROSSI^MARIO" / "study").iterdir()
+    )
+    assert snapshot["files"]["done"] == 7
+
+    outputs = list((tmp_path / "output").glob("*/*/*.dcm"))
+    if policy == "skip":
+        assert len(outputs) == 4
+    else:
+        assert len(outputs) == 7
+        assert (max(path.stat().st_nlink for path in outputs) > 1) == (policy == "link")
@@ -0,0 +1,130 @@
+"""Test dicom file operations."""
+
+from pydicom import dcmread
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    RLELossless,
+    generate_uid,
+)
+
+from dicomanonymize.fileio import copy_file, rewrite_image
+
+
+def create_image(path, transfer_syntax=ExplicitVRLittleEndian, frames=4):
+    """Create a dicom image with pixel data."""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = transfer_syntax
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.PatientName = "Rossi^Mario"
+    ds.PatientID = "123456"
+    ds.StudyDate = "20220429"
+    ds.Rows = 32
+    ds.Columns = 32
+    ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = bytes(range(256)) * (32 * 32 * 2 * frames // 256)
+    ds.save_as(path)
+    return ds
+
+
+def anonymize_header(dataset):
+    """Anonymize the header of the dataset."""
+    dataset.PatientName = "1"
+    dataset.PatientID = "1"
+
+
+def test_rewrite_image(tmp_path):
+    """Pixel data passthrough must give the same result as a full rewrite."""
+    for transfer_syntax in (ExplicitVRLittleEndian, ImplicitVRLittleEndian):
+        source = tmp_path / "source.dcm"
+        create_image(source, transfer_syntax)
+
+        rewrite_image(source, tmp_path / "fast.dcm", anonymize_header)
+
+        full = dcmread(source)
+        anonymize_header(full)
+        full.save_as(tmp_path / "full.dcm")
+
+        assert (tmp_path / "fast.dcm").read_bytes() == (tmp_path / "full.dcm").read_bytes()
+        assert dcmread(tmp_path / "fast.dcm").PatientID == "1"
+
+
+def test_rewrite_image_deflated(tmp_path):
+    """Native pixel data must be deflated, encapsulated pixel data passed through."""
+    output = tmp_path / "output.dcm"
+    for transfer_syntax in (
+        ExplicitVRLittleEndian,
+        ImplicitVRLittleEndian,
+        DeflatedExplicitVRLittleEndian,
+    ):
+        source = tmp_path / "source.dcm"
+        pixel_data = create_image(source, transfer_syntax).PixelData
+
+        rewrite_image(source, output, anonymize_header, deflate_level=6)
+
+        ds = dcmread(output)
+        assert ds.file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian
+        assert ds.PatientID == "1"
+        assert ds.PixelData == pixel_data
+        assert output.stat().st_size % 2 == 0
+
+    source = tmp_path / "encapsulated.dcm"
+    ds = create_image(source)
+    ds.file_meta.TransferSyntaxUID = RLELossless
+    ds.PixelData = encapsulate([bytes(64)] * ds.NumberOfFrames)
+    ds["PixelData"].VR = "OB"
+    ds.save_as(source)
+
+    rewrite_image(source, output, anonymize_header, deflate_level=6)
+
+    assert dcmread(output).file_meta.TransferSyntaxUID == RLELossless
+    assert dcmread(output).PixelData == ds.PixelData
+
+    # private transfer syntaxes, whose encoding pydicom does not know, are passed through
+    ds.file_meta.TransferSyntaxUID = "1.2.3.4"
+    ds.save_as(source, implicit_vr=False, little_endian=True)
+
+    rewrite_image(source, output, anonymize_header, deflate_level=6)
+
+    assert dcmread(output).file_meta.TransferSyntaxUID == "1.2.3.4"
+    assert dcmread(output).PatientID == "1"
+
+
+def test_copy_file(tmp_path):
+    """Files must be copied or hard linked unchanged."""
+    source = tmp_path / "source.dcm"
+    create_image(source)
+
+    copy_file(source, tmp_path / "copy.dcm")
+    copy_file(source, tmp_path / "link.dcm", hardlink=True)
+
+    assert (tmp_path / "copy.dcm").read_bytes() == source.read_bytes()
+    assert (tmp_path / "link.dcm").samefile(source)
+    assert not (tmp_path / "copy.dcm").samefile(source)
+
+
+def test_rewrite_image_in_place(tmp_path):
+    """Rewriting an image onto itself must not lose its pixel data."""
+    source = tmp_path / "source.dcm"
+    pixel_data = create_image(source).PixelData
+
+    rewrite_image(source, source, anonymize_header)
+
+    ds = dcmread(source)
+    assert ds.PatientID == "1"
+    assert ds.PixelData == pixel_data
+    assert [p.name for p in tmp_path.iterdir()] == ["source.dcm"]
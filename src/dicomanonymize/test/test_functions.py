@@ -1,13 +1,43 @@
 """Test script."""
 
+import csv
+import gzip
+import json
+import os
 from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+import pytest
 from pydicom import dcmread
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+)
+from pydicom.valuerep import PersonName
 
-from dicomanonymize import anonymize
+import dicomanonymize
+from dicomanonymize import Patient, anonymize, iter_anonymize
+from dicomanonymize.functions import (
+    anonymize_id_patients,
+    get_directories,
+    read_patients,
+    write_conversion_table,
+)
+from dicomanonymize.metrics import Metrics
+from dicomanonymize.scripts import dicomanonymize_script
+from dicomanonymize.table import merge_conversion_tables, read_conversion_table
+
+from .test_fileio import create_image
 
 given_names = ["Mario", "Antonio"]
 family_names = ["Rossi", "Verdi"]
 patient_ids = ["123456", "286249"]
+# runs whose outputs are compared must share the key of the anonymized ids
+KEY = b"test key"
 
 VALUES_TO_ANONYMIZE = [
     "PatientName",
@@ -72,7 +102,374 @@ def test_anonymization():
             dirs = d.iterdir()
             control_study(dirs)
         except Exception:
-            # csv files are not directories
+            # csv files and the key file are not directories
             # everything else must be a directory
             assert d.name.startswith("Anonymization") is True
-            assert d.name.endswith(".csv") is True
+            assert d.name.endswith(".csv") or d.name == "Anonymization.key"
+
+
+def test_get_directories(tmp_path):
+    """Directories with dicom images must be found at any depth."""
+    named_dir = Path(__file__).parent / "Named"
+    expected = []
+    for depth, image in enumerate(sorted(named_dir.glob("*/*/*.dcm"))):
+        directory = tmp_path.joinpath(*[f"level{i}" for i in range(depth + 1)])
+        directory.mkdir(parents=True)
+        (directory / "__init__.py").touch()
+        (directory / image.name).write_bytes(image.read_bytes())
+        expected.append(directory)
+
+    assert sorted(get_directories(tmp_path)) == expected
+
+
+def test_unreadable_headers(tmp_path):
+    """Unreadable images must not hide their directory, nor the subdirectories."""
+    input_dir = tmp_path / "input"
+    shutil.copytree(Path(__file__).parent / "Named", input_dir)
+    (input_dir / "01-06_Studies" / "aaa_broken.dcm").write_bytes(b"not a dicom image")
+    image_dir = next(input_dir.glob("*/*/*.dcm")).parent
+    (image_dir / "aaa_broken.dcm").write_bytes(b"not a dicom image")
+    broken_dir = input_dir / "broken"
+    (broken_dir / "nested").mkdir(parents=True)
+    (broken_dir / "only.dcm").write_bytes(b"not a dicom image")
+    shutil.copytree(image_dir, broken_dir / "nested" / image_dir.name)
+
+    metrics = Metrics()
+    patients = read_patients(input_dir, metrics=metrics)
+    assert sorted(p.last_name() for p in patients) == ["Rossi", "Verdi"]
+    snapshot = metrics.snapshot()
+    # the Named/01-06_Studies and broken directories contain only unreadable images
+    assert snapshot["directories_failed"] == 2
+    assert snapshot["failures"] == {"InvalidDicomError": 2}
+
+    # archives are read in the order of their members, trying each image of a directory
+    archive = tmp_path / "input.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        for path in sorted(input_dir.rglob("*.dcm")):
+            f.write(path, path.relative_to(input_dir).as_posix())
+    metrics = Metrics()
+    patients = read_patients(archive, metrics=metrics)
+    assert sorted(p.last_name() for p in patients) == ["Rossi", "Verdi"]
+    assert metrics.snapshot()["directories_failed"] == 2
+
+
+def test_discovery_index(tmp_path):
+    """Patients read through the index must match patients read from the images."""
+    named_dir = Path(__file__).parent / "Named"
+    index = tmp_path / "index.sqlite"
+
+    expected = read_patients(named_dir)
+    first_run = read_patients(named_dir, index=index)
+    second_run = read_patients(named_dir, index=index)
+
+    for patients in (first_run, second_run):
+        assert sorted(str(p.patient_data["PatientName"]) for p in patients) == sorted(
+            str(p.patient_data["PatientName"]) for p in expected
+        )
+        assert sorted(p.last_name() for p in patients) == ["Rossi", "Verdi"]
+
+
+def test_resume(tmp_path):
+    """Images already in the journal must not be anonymized again, unless their output is gone."""
+    named_dir = Path(__file__).parent / "Named"
+    output_dir = tmp_path / "output"
+    journal = tmp_path / "journal.log"
+
+    anonymize(named_dir, output_dir, journal=journal)
+    images = sorted(output_dir.glob("*/*/*.dcm"))
+    assert len(images) == 5
+    assert len(journal.read_text().splitlines()) == 5
+
+    images[0].unlink()
+    anonymize(named_dir, output_dir, journal=journal, resume=True)
+    assert images[0].exists()
+    # only the deleted output has been written again
+    assert len(journal.read_text().splitlines()) == 6
+
+
+def test_metrics(tmp_path):
+    """Failed images must be counted by cause, and progress reported at the end of the run."""
+    input_dir = tmp_path / "input"
+    shutil.copytree(Path(__file__).parent / "Named", input_dir)
+    image_dir = next(input_dir.glob("*/*/*.dcm")).parent
+    (image_dir / "zz_broken.dcm").write_bytes(b"not a dicom image")
+
+    snapshots = []
+    metrics = Metrics(snapshots.append, interval=60)
+    anonymize(input_dir, tmp_path / "output", metrics=metrics)
+
+    assert snapshots[-1]["files"]["done"] == 5
+    assert snapshots[-1]["failures"] == {"InvalidDicomError": 1}
+    assert set(snapshots[-1]["stages"]) == {
+        "read_patients",
+        "anonymize_id_patients",
+        "anonymize_patients",
+        "write_conversion_table",
+    }
+    # stages run lazily inside the anonymization loop are not counted twice
+    assert sum(snapshots[-1]["stages"].values()) <= snapshots[-1]["elapsed"]
+
+    metrics.write(tmp_path / "metrics.json")
+    assert json.loads((tmp_path / "metrics.json").read_text())["files"]["failed"] == 1
+    metrics.write(tmp_path / "metrics.prom")
+    assert 'dicomanonymize_failures_total{cause="InvalidDicomError"} 1' in (
+        tmp_path / "metrics.prom"
+    ).read_text().splitlines()
+
+
+def test_iter_anonymize(tmp_path):
+    """Results must be streamed, without taking more images than the workers can handle."""
+    named_dir = Path(__file__).parent / "Named"
+    metrics = Metrics()
+    results = iter_anonymize(
+        named_dir, tmp_path / "partial", processes=1, threads=2, metrics=metrics, max_in_flight=2
+    )
+    assert next(results).output is not None
+    assert metrics.snapshot()["files"]["queued"] <= 2
+    results.close()
+    # a single process has a single queue, of at most max_in_flight images
+    assert max(metrics.snapshot()["max_worker_queue_depth"].values()) <= 1
+
+    results = list(iter_anonymize(named_dir, tmp_path / "output"))
+    assert len(results) == 5
+    assert all(result.output.exists() for result in results)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_pipeline_backend(tmp_path, monkeypatch, processes):
+    """The pipeline backend must give the same output as the pool backend."""
+    named_dir = Path(__file__).parent / "Named"
+    anonymize(named_dir, tmp_path / "pool", key=KEY)
+    # headers must be read again when they do not fit in the first bytes read
+    monkeypatch.setattr("dicomanonymize.pipeline.PROBE_SIZE", 64)
+    anonymize(
+        named_dir, tmp_path / "pipeline", processes=processes, key=KEY, backend="pipeline"
+    )
+
+    def images(directory):
+        return {
+            path.relative_to(directory): path.read_bytes() for path in directory.glob("*/*/*.dcm")
+        }
+
+    assert images(tmp_path / "pipeline") == images(tmp_path / "pool")
+    with pytest.raises(ValueError):
+        anonymize(named_dir, tmp_path / "other", backend="other")
+
+
+@pytest.mark.parametrize("backend", ["pool", "pipeline"])
+def test_deflate(tmp_path, backend):
+    """Deflated images must hold the same data, and bytes written be counted."""
+    input_dir = tmp_path / "input"
+    for index, transfer_syntax in enumerate([ExplicitVRLittleEndian, ImplicitVRLittleEndian]):
+        study = input_dir / f"PATIENT^{index}" / "study"
+        study.mkdir(parents=True)
+        for image in range(2):
+            create_image(study / f"{image}.dcm", transfer_syntax)
+    anonymize(input_dir, tmp_path / "plain", key=KEY)
+    metrics = Metrics()
+    anonymize(
+        input_dir,
+        tmp_path / "deflated",
+        processes=2,
+        key=KEY,
+        backend=backend,
+        metrics=metrics,
+        deflate_level=6,
+    )
+
+    outputs = sorted((tmp_path / "deflated").glob("*/*/*.dcm"))
+    assert len(outputs) == 4
+    for path in outputs:
+        plain = dcmread(tmp_path / "plain" / path.relative_to(tmp_path / "deflated"))
+        deflated = dcmread(path)
+        assert deflated.file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian
+        assert deflated.PatientName == plain.PatientName
+        assert deflated.PixelData == plain.PixelData
+    snapshot = metrics.snapshot()
+    assert snapshot["bytes_written"] == sum(path.stat().st_size for path in outputs)
+    assert snapshot["bytes_written"] < snapshot["bytes"]
+    with pytest.raises(ValueError):
+        anonymize(input_dir, tmp_path / "other", deflate_level=10)
+
+
+def test_archives(tmp_path):
+    """Archives must give the same images, with the same paths, as directories."""
+    named_dir = Path(__file__).parent / "Named"
+    anonymize(named_dir, tmp_path / "directory", key=KEY)
+    expected = {
+        path.relative_to(tmp_path / "directory").as_posix(): path.read_bytes()
+        for path in (tmp_path / "directory").glob("*/*/*.dcm")
+    }
+
+    archive = tmp_path / "input.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        for path in named_dir.rglob("*.dcm"):
+            f.write(path, path.relative_to(named_dir).as_posix())
+    assert len(read_patients(archive)) == len(read_patients(named_dir))
+
+    anonymize(archive, tmp_path / "output" / "anonymized.tar.gz", key=KEY)
+    with tarfile.open(tmp_path / "output" / "anonymized.tar.gz") as f:
+        members = {member.name: f.extractfile(member).read() for member in f.getmembers()}
+    assert members == expected
+    assert (tmp_path / "output" / "Anonymization.csv").exists()
+
+    with pytest.raises(ValueError):
+        anonymize(archive, tmp_path / "resumed", journal=tmp_path / "journal.log", resume=True)
+
+
+def test_archive_path_traversal(tmp_path):
+    """Members must never be written outside of the output directory."""
+    image = next((Path(__file__).parent / "Named").rglob("*.dcm"))
+    archive = tmp_path / "input.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        for name in ("../../evil.dcm", "/tmp/evil.dcm", "a/b/good.dcm"):
+            f.writestr(zipfile.ZipInfo(name), image.read_bytes())
+
+    output = tmp_path / "x" / "y" / "output"
+    results = list(iter_anonymize(archive, output))
+    assert sorted(result.error for result in results) == ["", "ValueError", "ValueError"]
+    assert [path.name for path in tmp_path.rglob("*.dcm")] == ["good.dcm"]
+
+
+def test_shards(tmp_path):
+    """Shards sharing the output directory must anonymize every patient exactly once."""
+    named_dir = Path(__file__).parent / "Named"
+    for shard in range(3):
+        # shards sharing the output directory share the key file written by the first one
+        anonymize(named_dir, tmp_path / "sharded", shard=(shard, 3))
+    key = bytes.fromhex((tmp_path / "sharded" / "Anonymization.key").read_text())
+    anonymize(named_dir, tmp_path / "single", key=key)
+
+    tables = sorted((tmp_path / "sharded").glob("Anonymization-shard-*.csv"))
+    assert len(tables) == 3
+    assert merge_conversion_tables(tables, tmp_path / "merged.csv") == []
+
+    def rows(path):
+        return sorted(tuple(row.values()) for row in read_conversion_table(path))
+
+    def images(directory):
+        return sorted(path.relative_to(directory) for path in directory.glob("*/*/*.dcm"))
+
+    assert rows(tmp_path / "merged.csv") == rows(tmp_path / "single" / "Anonymization.csv")
+    assert images(tmp_path / "sharded") == images(tmp_path / "single")
+
+    conflicting = tmp_path / "Anonymization-conflict.csv"
+    row = next(row for table in tables for row in read_conversion_table(table))
+    with open(conflicting, "w", newline="") as f:
+        writer = csv.DictWriter(f, list(row))
+        writer.writeheader()
+        writer.writerow(dict(row, anonymized_id="1"))
+    assert len(merge_conversion_tables(tables + [conflicting], tmp_path / "merged2.csv")) == 1
+
+    # columnar tables are merged too
+    pytest.importorskip("pyarrow")
+    for shard in range(2):
+        anonymize(
+            named_dir, tmp_path / "parquet", key=key, table_format="parquet", shard=(shard, 2)
+        )
+    tables = sorted((tmp_path / "parquet").glob("Anonymization-shard-*.parquet"))
+    assert merge_conversion_tables(tables, tmp_path / "merged.arrow") == []
+    merged = read_conversion_table(tmp_path / "merged.arrow")
+    assert sorted(row["anonymized_id"] for row in merged) == sorted(
+        row[0] for row in rows(tmp_path / "merged.csv")
+    )
+
+
+def test_conversion_table_formats(tmp_path):
+    """Conversion tables must contain one row for each patient, in any format."""
+    patients = read_patients(Path(__file__).parent / "Named")
+    anonymize_id_patients(patients)
+
+    write_conversion_table(tmp_path, patients, compression="gzip")
+    with gzip.open(tmp_path / "Anonymization.csv.gz", "rt") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(row["anonymized_id"] for row in rows) == sorted(
+        p.anonymized_id for p in patients
+    )
+
+    pa = pytest.importorskip("pyarrow")
+    write_conversion_table(tmp_path, patients, table_format="arrow")
+    with pa.ipc.open_stream(str(tmp_path / "Anonymization.arrow")) as reader:
+        table = reader.read_all()
+    assert sorted(table.column("anonymized_id").to_pylist()) == sorted(
+        p.anonymized_id for p in patients
+    )
+    assert table.column("PatientBirthDate").null_count == len(patients)
+
+
+def test_anonymize_directory():
+    """Names containing regular expression metacharacters must be replaced literally."""
+    patient = Patient({"PatientName": PersonName("Rossi+^Ma.rio")}, [], [], "42")
+
+    output = patient.anonymize_directory(Path("out") / "ROSSI+^MA.RIO_1" / "ROSSI+_2022-01-01_x")
+
+    assert output == Path("out") / "42^ma.rio_1" / "42_42_x"
+    assert Patient({"PatientName": PersonName("Rossi")}, [], [], "42").anonymize_directory(
+        Path("out") / "rossi" / "a"
+    ) == Path("out") / "42" / "a"
+
+
+def test_output_paths_keep_input_tree(tmp_path):
+    """Directories of different patients with the same last two names must not collide."""
+    for name, patient_id in (("Rossi^Mario", "1"), ("Verdi^Luigi", "2")):
+        directory = tmp_path / "input" / name.replace("^", "_") / "CT_HEAD" / "SERIES_1"
+        directory.mkdir(parents=True)
+        image = create_image(directory / "IM0001.dcm")
+        image.PatientName = name
+        image.PatientID = patient_id
+        image.save_as(directory / "IM0001.dcm")
+
+    anonymize(tmp_path / "input", tmp_path / "output", key=KEY)
+    outputs = sorted((tmp_path / "output").rglob("*.dcm"))
+    assert len(outputs) == 2
+    assert len({dcmread(path).PatientID for path in outputs}) == 2
+    for path in outputs:
+        parts = path.relative_to(tmp_path / "output").parts
+        assert parts[1:] == ("ct_head", "series_1", "IM0001.dcm")
+        assert not any(name in parts[0] for name in ("rossi", "mario", "verdi", "luigi"))
+
+    anonymize(tmp_path / "input", tmp_path / "archive" / "anonymized.zip", key=KEY)
+    with zipfile.ZipFile(tmp_path / "archive" / "anonymized.zip") as f:
+        names = sorted(f.namelist())
+    assert names == [path.relative_to(tmp_path / "output").as_posix() for path in outputs]
+
+
+def test_script_journal(tmp_path, monkeypatch):
+    """The script must write the journal, listing source paths, only when requested."""
+    named_dir = Path(__file__).parent / "Named"
+    output_dir = tmp_path / "output"
+    arguments = ["dicomanonymize", "-i", str(named_dir), "-o", str(output_dir), "-s"]
+    monkeypatch.setattr(sys, "argv", arguments + ["--key", KEY.decode(), "--progress", "0"])
+    dicomanonymize_script.main()
+    assert len(list(output_dir.rglob("*.dcm"))) == 5
+    assert not list(tmp_path.rglob("*journal*"))
+
+    monkeypatch.setattr(sys, "argv", arguments + ["--resume"])
+    with pytest.raises(SystemExit):
+        dicomanonymize_script.main()
+
+
+def run_python(statement):
+    """Run a Python statement in a new interpreter, importing this copy of dicomanonymize."""
+    environment = dict(os.environ, PYTHONPATH=str(Path(dicomanonymize.__file__).parent.parent))
+    result = subprocess.run(
+        [sys.executable, "-c", statement], check=True, stdout=subprocess.PIPE, env=environment
+    )
+    return result.stdout.decode().split()
+
+
+def test_lazy_imports():
+    """Modules of optional features must not be imported until they are used."""
+    lazy = ["asyncio", "sqlite3", "pyarrow", "pynetdicom", "dicomanonymize.watch"]
+    check = f"import sys; print(*(m for m in {lazy!r} if m in sys.modules))"
+    for statement in (
+        "import dicomanonymize",
+        "import dicomanonymize.functions",
+        "import dicomanonymize.scripts.dicomanonymize_script",
+    ):
+        assert run_python(f"{statement}; {check}") == [], statement
+    # the package itself imports its modules only when their functions are used, on the
+    # Python versions supporting module __getattr__
+    if sys.version_info >= (3, 7):
+        statement = "import dicomanonymize, sys; print('pydicom' in sys.modules)"
+        assert run_python(statement) == ["False"]
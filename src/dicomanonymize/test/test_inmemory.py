@@ -0,0 +1,66 @@
+"""Test in-memory anonymization."""
+
+from io import BytesIO
+import os
+import threading
+
+from pydicom import dcmread
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+from dicomanonymize.fileio import rewrite_image
+from dicomanonymize.inmemory import anonymize_bytes, anonymize_stream
+
+from .test_fileio import create_image
+
+
+def set_anonymized_id(dataset):
+    """Anonymize the header of the dataset as the file based anonymization does."""
+    for keyword in ("PatientName", "PatientID", "StudyDate"):
+        dataset[keyword].value = "42"
+
+
+def test_anonymize_bytes(tmp_path):
+    """Buffers must give the same bytes as the file based anonymization."""
+    source = tmp_path / "source.dcm"
+    create_image(source)
+    rewrite_image(source, tmp_path / "file.dcm", set_anonymized_id)
+    expected = (tmp_path / "file.dcm").read_bytes()
+    data = source.read_bytes()
+
+    assert anonymize_bytes(data, "42") == expected
+    assert anonymize_bytes(memoryview(bytearray(data)), {"123456": 42}) == expected
+    assert anonymize_bytes(BytesIO(data), lambda patient_id: 42) == expected
+
+    destination = BytesIO()
+    assert anonymize_stream(BytesIO(data), destination, {"123456": "42"}) == "42"
+    assert destination.getvalue() == expected
+
+
+def test_anonymize_deflated_bytes(tmp_path):
+    """Deflated images have no pixel data to pass through and must be fully rewritten."""
+    source = tmp_path / "source.dcm"
+    create_image(source, DeflatedExplicitVRLittleEndian)
+
+    dataset = dcmread(BytesIO(anonymize_bytes(source.read_bytes(), "42")))
+    assert dataset.PatientID == "42"
+    assert dataset.PixelData == dcmread(source).PixelData
+
+
+def test_anonymize_pipe(tmp_path):
+    """Non-seekable streams, such as pipes, must give the same bytes as files."""
+    source = tmp_path / "source.dcm"
+    create_image(source)
+    data = source.read_bytes()
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with open(write_fd, "wb") as pipe:
+            pipe.write(data)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    with open(read_fd, "rb") as pipe:
+        assert not pipe.seekable()
+        anonymized = anonymize_bytes(pipe, "42")
+    feeder.join()
+    assert anonymized == anonymize_bytes(data, "42")
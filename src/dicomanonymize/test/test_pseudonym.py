@@ -0,0 +1,53 @@
+"""Test anonymized id generation."""
+
+import pytest
+
+from dicomanonymize import Patient
+from dicomanonymize.functions import PatientRegistry, id_generator
+from dicomanonymize.pseudonym import Pseudonymizer, load_key
+
+
+def test_permutation():
+    """Numeric patient ids must be mapped to distinct anonymized ids."""
+    for id_space in (2, 10, 1000, 4097):
+        pseudonymizer = Pseudonymizer(b"key", id_space)
+        ids = [pseudonymizer(str(patient_id)) for patient_id in range(id_space)]
+        assert sorted(ids) == list(range(id_space))
+
+
+def test_stability():
+    """Anonymized ids must depend only on the key and on the patient id."""
+    patient_ids = ["123456", "286249", "ABC-001", "00123"]
+    first = [Pseudonymizer("key")(patient_id) for patient_id in patient_ids]
+    second = [Pseudonymizer(b"key")(patient_id) for patient_id in reversed(patient_ids)]
+    other_key = [Pseudonymizer(b"other key")(patient_id) for patient_id in patient_ids]
+
+    assert first == list(reversed(second))
+    assert first != other_key
+    assert len(set(first)) == len(first)
+
+
+def test_alphanumeric_ids():
+    """Patient ids that are not numbers, or too large, must stay inside the id space."""
+    pseudonymizer = Pseudonymizer(b"key", 1000)
+    patient_ids = ["ABC-001", "00123", "1000", "99999999999999999999", "Rossi Mario"]
+    ids = [pseudonymizer(patient_id) for patient_id in patient_ids]
+    assert all(0 <= anonymized_id < 1000 for anonymized_id in ids)
+
+    # collisions are certain with more patients than ids
+    generate_id = id_generator(b"key", 10)
+    with pytest.raises(ValueError):
+        for patient_id in range(11):
+            generate_id(f"P{patient_id}")
+    # also with the patients of the conversion table written by previous runs
+    registry = PatientRegistry(lambda patient_id: 7, known={"A": "7"})
+    with pytest.raises(ValueError):
+        registry.register(Patient({"PatientID": "B"}, [], []))
+
+
+def test_key_file(tmp_path):
+    """The first run must create a random key, reused by later runs."""
+    key = load_key(tmp_path / "Anonymization.key")
+    assert len(key) == 32
+    assert load_key(tmp_path / "Anonymization.key") == key
+    assert load_key(tmp_path / "other.key") != key
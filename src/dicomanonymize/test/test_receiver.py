@@ -0,0 +1,57 @@
+"""Test the C-STORE receiver."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from dicomanonymize.receiver import STATUS_SUCCESS, StoreReceiver
+
+from .test_fileio import create_image
+
+
+pynetdicom = pytest.importorskip("pynetdicom")
+
+
+def send(port, datasets):
+    """Send images with a local storage SCU, returning the statuses."""
+    ae = pynetdicom.AE()
+    for transfer_syntax in (ExplicitVRLittleEndian, ImplicitVRLittleEndian):
+        ae.add_requested_context(datasets[0].SOPClassUID, transfer_syntax)
+    association = ae.associate("127.0.0.1", port)
+    assert association.is_established
+    try:
+        return [association.send_c_store(dataset).Status for dataset in datasets]
+    finally:
+        association.release()
+
+
+def test_receiver(tmp_path):
+    """Images received over concurrent associations must be written only once anonymized."""
+    datasets = []
+    for index in range(8):
+        path = tmp_path / f"{index}.dcm"
+        transfer_syntax = ExplicitVRLittleEndian if index % 2 else ImplicitVRLittleEndian
+        dataset = create_image(path, transfer_syntax)
+        datasets.append(dcmread(path))
+    output_dir = tmp_path / "output"
+
+    with StoreReceiver(output_dir, key=b"test key", workers=2) as receiver:
+        _, port = receiver.start("127.0.0.1", 0)
+        with ThreadPoolExecutor(4) as executor:
+            statuses = [
+                status
+                for batch in executor.map(send, [port] * 4, [datasets[i::4] for i in range(4)])
+                for status in batch
+            ]
+    assert statuses == [STATUS_SUCCESS] * len(datasets)
+
+    outputs = sorted(output_dir.glob("*/*/*.dcm"))
+    assert len(outputs) == len(datasets)
+    for output in outputs:
+        anonymized = dcmread(output)
+        assert anonymized.PatientName == anonymized.PatientID == output.parent.parent.name
+        assert anonymized.PixelData == dataset.PixelData
+    assert receiver.metrics.snapshot()["files"]["done"] == len(datasets)
+    assert len((output_dir / "Anonymization.csv").read_text().splitlines()) == 2
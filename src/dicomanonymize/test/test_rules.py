@@ -0,0 +1,155 @@
+"""Test the de-identification profiles."""
+
+import json
+import pickle
+
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from dicomanonymize.fileio import parse_header
+from dicomanonymize.functions import anonymize
+from dicomanonymize.inmemory import BufferReader, anonymize_bytes, write_anonymized
+from dicomanonymize.rules import VALUES_TO_ANONYMIZE, builtin_profile, load_profile
+
+from .test_fileio import create_image
+
+
+def create_dataset(path):
+    """Create an image with private elements, descriptions and nested UIDs, and read it."""
+    dataset = create_image(path)
+    dataset.InstitutionName = "Ospedale"
+    dataset.StudyInstanceUID = "1.2.3.4"
+    dataset.SeriesDate = "20220429"
+    dataset.add_new(0x00090010, "LO", "PRIVATE CREATOR")
+    dataset.add_new(0x00091001, "LO", "secret")
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
+    item.add_new(0x00110010, "LO", "NESTED CREATOR")
+    dataset.ReferencedImageSequence = Sequence([item])
+    dataset.save_as(path)
+    return dcmread(path)
+
+
+def test_basic_profile(tmp_path):
+    """The basic profile must only replace the patient information with the anonymized id."""
+    dataset = create_dataset(tmp_path / "image.dcm")
+    builtin_profile("basic").apply(dataset, "42")
+    assert dataset.PatientName == dataset.PatientID == dataset.SeriesDate == "42"
+    assert dataset.InstitutionName == "Ospedale"
+    assert dataset.StudyInstanceUID == "1.2.3.4"
+    assert 0x00091001 in dataset
+    assert len(builtin_profile("basic").rules) == len(VALUES_TO_ANONYMIZE)
+
+
+def test_ps3_15_profile(tmp_path):
+    """The PS3.15 profile must delete, blank and remap consistently, at any depth."""
+    profile = builtin_profile("ps3.15", b"test key")
+    assert pickle.loads(pickle.dumps(profile)) is profile
+    dataset = create_dataset(tmp_path / "image.dcm")
+    sop_instance_uid = dataset.SOPInstanceUID
+    profile.apply(dataset, "42")
+
+    assert dataset.PatientName == dataset.PatientID == "42"
+    assert "StudyDate" in dataset and not dataset.StudyDate
+    assert "InstitutionName" not in dataset and "SeriesDate" not in dataset
+    assert not any(element.tag.is_private for element in dataset.iterall())
+    assert dataset.StudyInstanceUID == profile.remap_uid("1.2.3.4")
+    assert dataset.StudyInstanceUID.startswith("2.25.")
+    remapped = profile.remap_uid(sop_instance_uid)
+    assert dataset.SOPInstanceUID == dataset.file_meta.MediaStorageSOPInstanceUID == remapped
+    assert dataset.ReferencedImageSequence[0].ReferencedSOPInstanceUID == remapped
+    assert dataset.PatientIdentityRemoved == "YES"
+    # UIDs depend only on the key
+    assert builtin_profile("ps3.15", b"other key").remap_uid("1.2.3.4") != profile.remap_uid(
+        "1.2.3.4"
+    )
+
+
+def test_shifted_dates(tmp_path):
+    """Dates of the same patient must be shifted by the same number of days."""
+    profile = builtin_profile("ps3.15-dates", b"test key")
+    dataset = create_dataset(tmp_path / "image.dcm")
+    profile.apply(dataset, "42")
+    assert dataset.StudyDate == dataset.SeriesDate != "20220429"
+    assert len(dataset.StudyDate) == 8
+
+
+def test_custom_profile(tmp_path):
+    """JSON profiles must extend their base profile."""
+    path = tmp_path / "profile.json"
+    path.write_text(
+        json.dumps({"base": "basic", "rules": {"InstitutionName": "hash", "00091001": "delete"}})
+    )
+    profile = load_profile(path, b"test key")
+    assert pickle.loads(pickle.dumps(profile)).rules == profile.rules
+
+    source = create_dataset(tmp_path / "image.dcm")
+    output = tmp_path / "output.dcm"
+    output.write_bytes(anonymize_bytes((tmp_path / "image.dcm").read_bytes(), "42"))
+    assert dcmread(output).InstitutionName == "Ospedale"
+
+    profile.apply(source, "42")
+    assert source.PatientName == "42"
+    assert source.InstitutionName not in ("", "Ospedale")
+    assert 0x00091001 not in source and 0x00090010 in source
+
+    with pytest.raises(ValueError):
+        load_profile(tmp_path / "missing.json")
+
+
+@pytest.mark.parametrize("transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+def test_elements_after_pixel_data(tmp_path, transfer_syntax):
+    """Private elements and padding following the pixel data must be removed by every writer."""
+    source = tmp_path / "input" / "ROSSI^MARIO" / "study" / "image.dcm"
+    source.parent.mkdir(parents=True)
+    dataset = create_image(source, transfer_syntax)
+    dataset.add_new(0x7FE10010, "LO", "PRIVATE CREATOR")
+    dataset.add_new(0x7FE11010, "LO", "ROSSI")
+    dataset.add_new(0xFFFCFFFC, "OB", bytes(16))
+    dataset.save_as(source)
+
+    outputs = []
+    for backend in ("pool", "pipeline"):
+        for deflate_level in (None, 6):
+            output_dir = tmp_path / f"{backend}-{deflate_level}"
+            anonymize(
+                tmp_path / "input",
+                output_dir,
+                processes=1,
+                key=b"test key",
+                profile="ps3.15",
+                backend=backend,
+                deflate_level=deflate_level,
+            )
+            outputs.extend(output_dir.glob("*/*/*.dcm"))
+    data = source.read_bytes()
+    for deflate_level in (None, 6):
+        reader = BufferReader(data)
+        header, offset = parse_header(reader)
+        output = tmp_path / f"memory-{deflate_level}.dcm"
+        with open(output, "wb") as destination:
+            write_anonymized(
+                reader,
+                header,
+                offset,
+                destination,
+                "42",
+                builtin_profile("ps3.15", b"test key"),
+                deflate_level,
+            )
+        outputs.append(output)
+
+    assert len(outputs) == 6
+    for output in outputs:
+        anonymized = dcmread(output)
+        assert anonymized.PatientID != dataset.PatientID
+        assert anonymized.PixelData == dataset.PixelData
+        assert 0x7FE11010 not in anonymized and 0xFFFCFFFC not in anonymized
+        if anonymized.file_meta.TransferSyntaxUID == transfer_syntax:
+            assert b"ROSSI" not in output.read_bytes()
+
+    # profiles leaving them unchanged pass them through
+    assert b"ROSSI" in anonymize_bytes(data, "42")
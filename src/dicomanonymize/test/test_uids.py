@@ -0,0 +1,55 @@
+"""Test the remapping of UIDs."""
+
+from multiprocessing import get_context
+
+from pydicom import dcmread
+
+from dicomanonymize.functions import anonymize
+from dicomanonymize.uids import UIDRemapper, read_uid_map
+
+from .test_fileio import create_image
+
+
+def remap(uids):
+    """Remap UIDs in a worker process, recording them in the audit directory."""
+    uid_map, values = uids
+    remapper = UIDRemapper(b"test key", uid_map)
+    return [remapper.remap(value) for value in values]
+
+
+def test_remapping_across_processes(tmp_path):
+    """Processes sharing the key must remap UIDs the same way, and record them for audit."""
+    uids = [f"1.2.3.{index}" for index in range(100)]
+    with get_context("spawn").Pool(2) as pool:
+        results = pool.map(remap, [(tmp_path, uids), (tmp_path, uids[::-1])])
+    assert results[0] == results[1][::-1] == remap((None, uids))
+    assert len(set(results[0])) == len(uids)
+    assert all(value.startswith("2.25.") and len(value) <= 64 for value in results[0])
+    assert read_uid_map(tmp_path) == dict(zip(results[0], uids))
+    assert len(list(tmp_path.glob("uids-*.csv"))) == 2
+
+
+def test_anonymize_uid_map(tmp_path):
+    """Images of a series split between patients must keep sharing their remapped UIDs."""
+    input_dir = tmp_path / "input"
+    for index in range(4):
+        directory = input_dir / f"patient{index}" / "study"
+        directory.mkdir(parents=True)
+        dataset = create_image(directory / "image.dcm")
+        dataset.PatientID = str(index)
+        dataset.StudyInstanceUID = "1.2.3.4"
+        dataset.SeriesInstanceUID = "1.2.3.4.5"
+        dataset.save_as(directory / "image.dcm")
+    output_dir = tmp_path / "output"
+    uid_map = tmp_path / "uids"
+
+    anonymize(
+        input_dir, output_dir, processes=2, key=b"test key", profile="ps3.15", uid_map=uid_map
+    )
+
+    outputs = [dcmread(path) for path in output_dir.glob("*/*/*.dcm")]
+    assert len(outputs) == 4
+    assert len({dataset.SeriesInstanceUID for dataset in outputs}) == 1
+    originals = read_uid_map(uid_map)
+    assert originals[outputs[0].StudyInstanceUID] == "1.2.3.4"
+    assert originals[outputs[0].SeriesInstanceUID] == "1.2.3.4.5"
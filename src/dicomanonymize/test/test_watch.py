@@ -0,0 +1,87 @@
+"""Test the watch-folder daemon."""
+
+import csv
+import shutil
+import threading
+import time
+
+import pytest
+
+from dicomanonymize.watch import watch
+
+from pathlib import Path
+
+
+def wait_for(condition, timeout=30.0):
+    """Wait until condition() is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def start(input_dir, output_dir, inotify):
+    """Start the daemon in a thread, returning the event stopping it and the thread."""
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=watch,
+        args=(input_dir, output_dir),
+        kwargs={
+            "processes": 1,
+            "threads": 2,
+            "settle": 0.2,
+            "poll_interval": 0.05,
+            "inotify": inotify,
+            "stop": stop,
+        },
+    )
+    thread.start()
+    return stop, thread
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch(tmp_path, inotify):
+    """Studies must be anonymized once complete, and only once across restarts."""
+    studies = Path(__file__).parent / "Named" / "01-06_Studies"
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    (input_dir / "inbox").mkdir(parents=True)
+    table = output_dir / "Anonymization.csv"
+
+    def outputs():
+        return sorted(output_dir.glob("*/*/*.dcm"))
+
+    stop, thread = start(input_dir, output_dir, inotify)
+    try:
+        shutil.copytree(studies / "ROSSI^MARIO_0138u9284", input_dir / "inbox" / "ROSSI^MARIO_1")
+        wait_for(lambda: len(outputs()) == 2)
+        shutil.copytree(
+            studies / "VERDI^ANTONIO_uhd7wh478h", input_dir / "inbox" / "VERDI^ANTONIO_2"
+        )
+        wait_for(lambda: len(outputs()) == 4)
+    finally:
+        stop.set()
+        thread.join()
+    assert not any("ROSSI" in str(path) or "VERDI" in str(path) for path in outputs())
+
+    # images written while the daemon is stopped are anonymized at restart, the others not
+    mtimes = {path: path.stat().st_mtime_ns for path in outputs()}
+    shutil.copytree(studies / "ROSSI^MARIO_0138u9284 - Copia", input_dir / "inbox" / "ROSSI^3")
+    stop, thread = start(input_dir, output_dir, inotify)
+    try:
+        wait_for(lambda: len(outputs()) == 5)
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+    assert all(path.stat().st_mtime_ns == mtime for path, mtime in mtimes.items())
+
+    with open(table, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len({row["PatientID"] for row in rows}) == 2
+
+
+def test_watch_output_inside_input(tmp_path):
+    """The daemon must not watch its own output."""
+    with pytest.raises(ValueError):
+        watch(tmp_path, tmp_path / "output", stop=threading.Event())
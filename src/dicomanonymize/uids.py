@@ -0,0 +1,104 @@
+"""Remapping of UIDs, the same in every worker process and run sharing the key."""
+
+from typing import Dict, Optional, Union
+import csv
+import hashlib
+import os
+import threading
+
+from pathlib import Path
+
+
+# root of the UIDs derived from a UUID (PS3.5 Annex B.2)
+UID_ROOT = "2.25."
+# UIDs remembered by each process, cleared once full
+CACHE_SIZE = 1 << 16
+# prefix of the audit files, one for each process
+UID_MAP_PREFIX = "uids-"
+
+
+class UIDRemapper:
+    """
+    Replace UIDs with UIDs in the 2.25 root derived from a keyed hash.
+
+    Remapped UIDs depend only on the key and on the original UID: every thread and process,
+    in this run and in later ones, gives the same UID without sharing any state, so a
+    series split across workers or across runs stays consistent. There is no lock on the
+    hot path; each process only keeps a cache of the UIDs it has already remapped.
+
+    With an audit directory, each process appends the UIDs it remaps for the first time to
+    its own file in the directory, to be looked up with read_uid_map.
+    """
+
+    def __init__(
+        self, key: Union[bytes, str] = b"", audit_directory: Optional[Path] = None
+    ) -> None:
+        """
+        Create the remapper.
+
+        :param key: secret key: anyone holding it can tell which UID a remapped UID replaces
+        :param audit_directory: Path of the directory of the audit files, None for no audit
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        self.audit_directory = audit_directory
+        self._key = hashlib.blake2b(key, digest_size=32).digest()
+        self._cache: Dict[str, str] = {}
+        self._audit = None
+        self._audit_pid = None
+        self._lock = threading.Lock()
+
+    def remap(self, uid: str) -> str:
+        """
+        UID replacing another one.
+
+        :param uid: original UID
+        :return: remapped UID, at most 44 characters long
+        """
+        remapped = self._cache.get(uid)
+        if remapped is not None:
+            return remapped
+        digest = hashlib.blake2b(uid.encode(), key=self._key, digest_size=16, person=b"uid")
+        remapped = UID_ROOT + str(int.from_bytes(digest.digest(), "big"))
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[uid] = remapped
+        if self.audit_directory is not None:
+            self._record(uid, remapped)
+        return remapped
+
+    def _record(self, uid: str, remapped: str) -> None:
+        """
+        Append a remapped UID to the audit file of this process.
+
+        :param uid: original UID
+        :param remapped: remapped UID
+        :return: None
+        """
+        with self._lock:
+            if self._audit_pid != os.getpid():
+                # forked worker processes must not write to the file of their parent
+                self.audit_directory.mkdir(parents=True, exist_ok=True)
+                path = self.audit_directory / f"{UID_MAP_PREFIX}{os.getpid()}.csv"
+                # line buffered: a worker killed at any time loses no complete entry
+                self._audit = open(path, "a", newline="", buffering=1)
+                self._audit_pid = os.getpid()
+            self._audit.write(f"{uid},{remapped}\n")
+
+
+def read_uid_map(directory: Path) -> Dict[str, str]:
+    """
+    Read the audit files written by UIDRemapper.
+
+    Malformed lines, such as the last one of a killed process, are ignored.
+
+    :param directory: Path of the audit directory
+    :return: dictionary from remapped UID to original UID
+    """
+    originals = {}
+    for path in sorted(directory.glob(f"{UID_MAP_PREFIX}*.csv")):
+        with open(path, newline="") as f:
+            for row in csv.reader(f):
+                if len(row) == 2 and row[1].startswith(UID_ROOT):
+                    originals[row[1]] = row[0]
+    return originals
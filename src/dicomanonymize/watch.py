@@ -0,0 +1,541 @@
+"""Watch-folder daemon anonymizing studies as soon as they are complete."""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from contextlib import ExitStack
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from .classes import Patient, VALUES_TO_ANONYMIZE
+from .crawler import first_header
+from .functions import PatientRegistry, id_generator, patient_data
+from .journal import Journal, is_done, read_journal
+from .metrics import Metrics
+from .pseudonym import DEFAULT_ID_SPACE, KEY_NAME, load_key
+from .rules import DEFAULT_PROFILE, load_profile
+from .scheduler import ImageTask, iter_image_tasks, iter_results
+from .table import TABLE_NAME, ConversionTableWriter, read_conversion_table
+
+from pathlib import Path
+
+
+# seconds without changes after which the images of a directory are anonymized
+SETTLE_TIME = 10.0
+# seconds between two checks of the watched directories
+POLL_INTERVAL = 1.0
+# journal of the anonymized images, in the output directory
+WATCH_JOURNAL = "Anonymization-journal.log"
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+def _walk(directory: Path) -> Iterator[Path]:
+    """
+    Walk a directory tree, without following symbolic links.
+
+    :param directory: Path of the root directory
+    :return: iterator of the Paths of the root directory and of its subdirectories
+    """
+    pending = [directory]
+    while pending:
+        directory = pending.pop()
+        yield directory
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(Path(entry.path))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+
+class InotifyWatcher:
+    """Report the directories changed below a root directory, with Linux inotify."""
+
+    def __init__(self, root: Path) -> None:
+        """
+        Watch a directory tree.
+
+        :param root: Path of the root directory
+        :raise OSError: if inotify is not available
+        """
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is available only on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.root = root
+        self._watches: Dict[int, Path] = {}
+        self._add_tree(root)
+
+    def _add_tree(self, directory: Path) -> List[Path]:
+        """
+        Watch a directory and its subdirectories.
+
+        Watches are added before the directories are listed: files created in the meantime
+        are reported by the caller, which checks every directory returned.
+
+        :param directory: Path of the directory
+        :return: Paths of the directories now watched
+        """
+        directories = []
+        for subdirectory in _walk(directory):
+            descriptor = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(subdirectory), WATCH_MASK
+            )
+            if descriptor >= 0:
+                self._watches[descriptor] = subdirectory
+                directories.append(subdirectory)
+        return directories
+
+    def directories(self) -> List[Path]:
+        """
+        Directories watched.
+
+        :return: list of Paths
+        """
+        return list(self._watches.values())
+
+    def wait(self, timeout: float) -> Set[Path]:
+        """
+        Wait for changes.
+
+        :param timeout: maximum number of seconds to wait
+        :return: Paths of the directories changed, empty if none changed before the timeout
+        """
+        changed: Set[Path] = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            position = 0
+            while position < len(data):
+                descriptor, mask, _, length = _EVENT.unpack_from(data, position)
+                name = data[position + _EVENT.size : position + _EVENT.size + length]
+                position += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events have been lost: check the whole tree again
+                    changed.update(self._add_tree(self.root))
+                    continue
+                directory = self._watches.get(descriptor)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the directory has been removed
+                    del self._watches[descriptor]
+                    continue
+                changed.add(directory)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    child = directory / os.fsdecode(name.rstrip(b"\0"))
+                    changed.update(self._add_tree(child))
+
+    def close(self) -> None:
+        """
+        Stop watching.
+
+        :return: None
+        """
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Report the directories changed below a root directory, comparing modification times.
+
+    Only directories are checked, with a stat each: images are listed only in the
+    directories whose entries changed.
+    """
+
+    def __init__(self, root: Path) -> None:
+        """
+        Watch a directory tree.
+
+        :param root: Path of the root directory
+        """
+        self.root = root
+        self._mtimes: Dict[Path, int] = {}
+        self._add_tree(root)
+
+    def _add_tree(self, directory: Path) -> List[Path]:
+        """
+        Watch a directory and its subdirectories.
+
+        :param directory: Path of the directory
+        :return: Paths of the directories now watched
+        """
+        directories = []
+        for subdirectory in _walk(directory):
+            try:
+                self._mtimes[subdirectory] = os.stat(subdirectory).st_mtime_ns
+            except OSError:
+                continue
+            directories.append(subdirectory)
+        return directories
+
+    def directories(self) -> List[Path]:
+        """
+        Directories watched.
+
+        :return: list of Paths
+        """
+        return list(self._mtimes)
+
+    def wait(self, timeout: float) -> Set[Path]:
+        """
+        Wait, then check the directories.
+
+        :param timeout: number of seconds to wait
+        :return: Paths of the directories changed
+        """
+        time.sleep(timeout)
+        changed: Set[Path] = set()
+        for directory, mtime in list(self._mtimes.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self._mtimes[directory]
+                continue
+            if current == mtime:
+                continue
+            self._mtimes[directory] = current
+            changed.add(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    children = [
+                        Path(entry.path)
+                        for entry in entries
+                        if entry.is_dir(follow_symlinks=False)
+                    ]
+            except OSError:
+                continue
+            for child in children:
+                if child not in self._mtimes:
+                    changed.update(self._add_tree(child))
+        return changed
+
+    def close(self) -> None:
+        """
+        Stop watching.
+
+        :return: None
+        """
+
+
+def open_watcher(root: Path, inotify: bool = True) -> Union[InotifyWatcher, PollingWatcher]:
+    """
+    Watch a directory tree, with inotify where available.
+
+    :param root: Path of the root directory
+    :param inotify: try inotify before falling back to polling
+    :return: InotifyWatcher or PollingWatcher
+    """
+    if inotify:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            # not on Linux, or out of inotify instances or watches
+            pass
+    return PollingWatcher(root)
+
+
+def image_names(directory: Path) -> List[str]:
+    """
+    Names of the dicom images of a directory.
+
+    :param directory: Path of the directory
+    :return: sorted list of names, empty if the directory cannot be read
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(
+                entry.name
+                for entry in entries
+                if entry.name.endswith(".dcm") and entry.is_file(follow_symlinks=False)
+            )
+    except OSError:
+        return []
+
+
+def _signature(directory: Path, images: List[str]) -> Tuple:
+    """
+    Signature of the images of a directory, changing whenever an image is written.
+
+    :param directory: Path of the directory
+    :param images: names of the images
+    :return: tuple of names, sizes and modification times
+    """
+    signature = []
+    for name in images:
+        try:
+            stat = os.stat(directory / name)
+        except OSError:
+            continue
+        signature.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+class SettleTracker:
+    """
+    Track the directories being written, until they have not changed for a while.
+
+    A directory is complete once the names, sizes and modification times of its images
+    have not changed for the settle time.
+    """
+
+    def __init__(self, settle: float = SETTLE_TIME) -> None:
+        """
+        Create the tracker.
+
+        :param settle: seconds without changes after which a directory is complete
+        """
+        self.settle = settle
+        self._pending: Dict[Path, Tuple[Tuple, float]] = {}
+
+    def __len__(self) -> int:
+        """Count the directories being tracked."""
+        return len(self._pending)
+
+    def touch(self, directory: Path) -> None:
+        """
+        Start tracking a directory, or restart its settle time.
+
+        :param directory: Path of the directory
+        :return: None
+        """
+        self._pending[directory] = ((), time.monotonic())
+
+    def settled(self) -> List[Path]:
+        """
+        Collect the directories complete since the previous call.
+
+        :return: Paths of the complete directories containing images
+        """
+        now = time.monotonic()
+        complete = []
+        for directory, (signature, since) in list(self._pending.items()):
+            images = image_names(directory)
+            current = _signature(directory, images)
+            if current != signature:
+                self._pending[directory] = (current, now)
+            elif now - since >= self.settle:
+                del self._pending[directory]
+                if images:
+                    complete.append(directory)
+        return complete
+
+
+def _pending(tasks: Iterable[ImageTask], done: Dict[Tuple[str, int, int], str]) -> Iterator:
+    """
+    Skip the tasks of the images already anonymized.
+
+    :param tasks: iterable of ImageTask
+    :param done: dictionary returned by read_journal
+    :return: iterator of ImageTask
+    """
+    for task in tasks:
+        if not is_done(done, task.image):
+            yield task
+
+
+def anonymize_directories(
+    directories: List[Path],
+    output_directory: Path,
+    registry: PatientRegistry,
+    images_journal: Journal,
+    done: Dict[Tuple[str, int, int], str],
+    destination_directories: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+    metrics: Optional[Metrics] = None,
+    input_directory: Optional[Path] = None,
+) -> Tuple[int, int]:
+    """
+    Anonymize the images of complete directories not anonymized yet.
+
+    :param directories: Paths of the directories
+    :param output_directory: Path of the output directory
+    :param registry: PatientRegistry giving the anonymized ids
+    :param images_journal: Journal of the anonymized images
+    :param done: dictionary returned by read_journal, updated with the new images
+    :param destination_directories: anonymize only destination directories (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs (int)
+    :param threads: number of threads per worker process (int)
+    :param hardlink: with destination_directories, hard link images instead of copying them
+    :param metrics: Metrics collecting timings and counters (Metrics)
+    :param input_directory: Path of the watched directory, output paths keep the path
+        relative to it
+    :return: number of images anonymized and of images that could not be anonymized
+    """
+    if metrics is None:
+        metrics = Metrics()
+    patients = []
+    for directory in directories:
+        try:
+            header = first_header(directory, image_names(directory), VALUES_TO_ANONYMIZE)
+        except Exception as e:  # pylint: disable=broad-except
+            metrics.directory_failed(directory, e)
+            continue
+        patients.append(registry.register(Patient(patient_data(header), [directory], [directory])))
+
+    anonymized = failed = 0
+    tasks = iter_image_tasks(patients, output_directory, input_directory)
+    tasks = metrics.queued(_pending(tasks, done))
+    for result in iter_results(
+        tasks, destination_directories, processes, threads, hardlink=hardlink
+    ):
+        metrics.record(result)
+        if result.output is None:
+            failed += 1
+            continue
+        anonymized += 1
+        images_journal.add(
+            result.source, result.size, result.mtime_ns, result.output, result.anonymized_id
+        )
+        done[(str(result.source), result.size, result.mtime_ns)] = str(result.output)
+    images_journal.flush()
+    return anonymized, failed
+
+
+def watch(
+    input_directory: Path,
+    output_directory: Path,
+    destination_directories: bool = False,
+    processes: Optional[int] = None,
+    threads: Optional[int] = None,
+    hardlink: bool = False,
+    journal: Optional[Path] = None,
+    key: Optional[Union[bytes, str]] = None,
+    id_space: int = DEFAULT_ID_SPACE,
+    settle: float = SETTLE_TIME,
+    poll_interval: float = POLL_INTERVAL,
+    inotify: bool = True,
+    metrics: Optional[Metrics] = None,
+    stop: Optional[threading.Event] = None,
+    profile: Union[str, Path] = DEFAULT_PROFILE,
+    uid_map: Optional[Path] = None,
+    deflate_level: Optional[int] = None,
+) -> None:
+    """
+    Anonymize the images of a directory tree as soon as they are written, until stopped.
+
+    Directories changed below input_directory are reported by inotify, or found by
+    polling their modification times where inotify is not available; the whole tree is
+    walked only once, at start. A directory is anonymized once its images have not
+    changed for settle seconds, and again if more images are added to it later.
+
+    Anonymized ids depend only on the key, kept in the key file of the output directory
+    as in anonymize; new patients are appended to the csv conversion table of the output
+    directory, and anonymized images to the journal, so that a restarted daemon
+    anonymizes only the images it has not anonymized yet.
+
+    :param input_directory: Path of the watched directory
+    :param output_directory: Path of the output directory, outside input_directory
+    :param destination_directories: anonymize only destination directories (bool)
+    :param processes: number of worker processes, defaults to the number of CPUs (int)
+    :param threads: number of threads per worker process (int)
+    :param hardlink: with destination_directories, hard link images instead of copying them
+    :param journal: Path of the journal, WATCH_JOURNAL in output_directory by default
+    :param key: secret key of the anonymized ids, by default the one of the key file
+    :param id_space: number of possible anonymized ids (int)
+    :param settle: seconds without changes after which a directory is anonymized
+    :param poll_interval: seconds between two checks of the watched directories
+    :param inotify: use inotify where available, instead of polling
+    :param metrics: Metrics collecting timings and counters (Metrics)
+    :param stop: event stopping the daemon once set
+    :param profile: de-identification profile, built-in name or Path of a JSON profile
+    :param uid_map: Path of the directory where the remapped UIDs are recorded
+    :param deflate_level: zlib compression level of the images written with the Deflated
+        Explicit VR Little Endian transfer syntax, None to keep their transfer syntax
+    :return: None
+    """
+    input_directory = input_directory.resolve()
+    output_directory = output_directory.resolve()
+    if output_directory == input_directory or input_directory in output_directory.parents:
+        # the daemon would anonymize its own output
+        raise ValueError("The output directory must be outside the watched directory")
+    output_directory.mkdir(parents=True, exist_ok=True)
+    if metrics is None:
+        metrics = Metrics()
+    if stop is None:
+        stop = threading.Event()
+    if journal is None:
+        journal = output_directory / WATCH_JOURNAL
+    if key is None:
+        key = load_key(output_directory / KEY_NAME)
+    compiled_profile = load_profile(profile, key, uid_map)
+
+    table_path = output_directory / f"{TABLE_NAME}.csv"
+    known = {}
+    if table_path.exists():
+        known = {
+            row["PatientID"]: row["anonymized_id"] for row in read_conversion_table(table_path)
+        }
+    done = read_journal(journal)
+
+    with ExitStack() as stack:
+        watcher = open_watcher(input_directory, inotify)
+        stack.callback(watcher.close)
+        table = stack.enter_context(ConversionTableWriter(table_path, append=True))
+        images_journal = stack.enter_context(Journal(journal))
+        registry = PatientRegistry(
+            id_generator(key, id_space), table, metrics, known, compiled_profile, deflate_level
+        )
+        print(f"Watching {input_directory} ({type(watcher).__name__})")
+
+        tracker = SettleTracker(settle)
+        # images written while the daemon was not running; images directly inside the
+        # watched directory are not considered, as in anonymize
+        changed = set(watcher.directories())
+        while not stop.is_set():
+            for directory in changed - {input_directory}:
+                tracker.touch(directory)
+            directories = tracker.settled()
+            if directories:
+                start = time.monotonic()
+                anonymized, failed = anonymize_directories(
+                    directories,
+                    output_directory,
+                    registry,
+                    images_journal,
+                    done,
+                    destination_directories,
+                    processes,
+                    threads,
+                    hardlink,
+                    metrics,
+                    input_directory,
+                )
+                if anonymized or failed:
+                    print(
+                        f"Anonymized {anonymized} images ({failed} failed) of"
+                        + f" {len(directories)} directories in {time.monotonic() - start:.2f}s"
+                    )
+            changed = watcher.wait(poll_interval)